@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Adaptive, boundary-seeking frame sampler for the cropped subtitle video.
+#
+# Instead of a fixed `fps=1` snapshot every second, the video is first sampled coarsely
+# (one frame every --interval seconds). Wherever two adjacent samples differ in the
+# subtitle band, the interval is bisected by extracting single frames at the needed
+# timestamps until every subtitle change is located to within one video frame.
+#
+# The kept frames are written as `snap_<milliseconds>ms.png`, so do-ocr.py produces results
+# keyed by millisecond timestamps, which gensrt.py turns into frame-accurate cue boundaries.
+
+# DEPENDENCIES:
+# ffmpeg + ffprobe on PATH
+# pip install -U numpy pillow
+
+# USAGE:
+# adaptive_sample.py video-cropped.mp4 video_img --interval 1
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import frame_signature
+from frame_stream import probe_video
+
+
+class FrameSampler:
+
+    def __init__(self, video, threshold, output_dir):
+        self.video = video
+        self.threshold = threshold
+        self.output_dir = Path(output_dir)
+        self.width, self.height, self.fps, self.duration = probe_video(video)
+        self.frame_size = self.width * self.height
+        self.last_frame = int(self.duration * self.fps) - 1
+        # only the signatures are kept for every sample; pixels are held just until written
+        self.signatures = {}
+        self.unsaved = {}
+        self.saved = set()
+        self.extracted = 0
+
+    def frame_time(self, frame_number) -> float:
+        return float(frame_number / self.fps)
+
+    def _decode(self, frame_number, raw: bytes):
+        gray = np.frombuffer(raw, dtype=np.uint8).reshape(self.height, self.width)
+        self.signatures[frame_number] = frame_signature.signature(gray)
+        self.extracted += 1
+        return gray
+
+    def save(self, frame_number, gray=None):
+        if frame_number in self.saved:
+            return
+        if gray is None:
+            gray = self.unsaved.pop(frame_number)
+        ms = round(self.frame_time(frame_number) * 1000)
+        Image.fromarray(gray).save(self.output_dir / f'snap_{ms:08d}ms.png')
+        self.saved.add(frame_number)
+
+    def sample_coarse(self, interval):
+        # one ffmpeg pass over the whole video, every step-th frame is piped as a raw gray buffer
+        step = max(1, round(interval * self.fps))
+        proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', str(self.video),
+                                 '-vf', f'select=not(mod(n\\,{step}))', '-vsync', '0',
+                                 '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                                stdout=subprocess.PIPE)
+
+        # read until the pipe ends: the probed duration is only a hint and is often short for VFR or
+        # badly muxed files
+        frame_number = 0
+        last_read = None
+        while True:
+            raw = proc.stdout.read(self.frame_size)
+            if len(raw) < self.frame_size:
+                break
+            self.save(frame_number, self._decode(frame_number, raw))
+            last_read = frame_number
+            frame_number += step
+
+        proc.stdout.close()
+        proc.wait()
+
+        if last_read is None:
+            return []
+
+        # the stream ends between the last coarse sample and the next one, which ffmpeg did not deliver
+        probed_last = self.last_frame
+        self.last_frame = self.find_last_frame(last_read, last_read + step - 1)
+        self.save(self.last_frame)
+
+        if self.last_frame > probed_last:
+            print(f'WARN: the video runs past its probed duration ({self.duration:.1f}s); sampled up to '
+                  f'{self.frame_time(self.last_frame + 1):.1f}s')
+        self.duration = self.frame_time(self.last_frame + 1)
+
+        return sorted(self.signatures)
+
+    def find_last_frame(self, known, limit) -> int:
+        """The last frame that decodes in [known, limit]; `known` decodes."""
+        # the probed last frame is right in the common case: check it and the frame after it first
+        hint = self.last_frame
+        if known <= hint <= limit and self.sample_at(hint) is not None \
+                and (hint == limit or self.sample_at(hint + 1) is None):
+            lo, hi = hint, hint
+        else:
+            lo, hi = known, limit + 1
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.sample_at(mid) is None:
+                hi = mid
+            else:
+                lo = mid
+
+        # only the last frame joins the coarse samples; the other probes are dropped
+        for frame_number in set(self.unsaved) - {lo}:
+            del self.signatures[frame_number]
+            del self.unsaved[frame_number]
+
+        return lo
+
+    def sample_at(self, frame_number):
+        """Signature of the frame, or None if the video stream ends before it."""
+        if frame_number not in self.signatures:
+            # seeking before -i with a transcode is frame-accurate in ffmpeg >= 2.1
+            proc = subprocess.run(['ffmpeg', '-v', 'error',
+                                   '-ss', f'{self.frame_time(frame_number):.6f}', '-i', str(self.video),
+                                   '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                                  stdout=subprocess.PIPE,
+                                  check=True)
+            # a seek past the end of the stream returns no frame
+            if len(proc.stdout) < self.frame_size:
+                return None
+            self.unsaved[frame_number] = self._decode(frame_number, proc.stdout[:self.frame_size])
+
+        return self.signatures[frame_number]
+
+    def same(self, frame1, frame2) -> bool:
+        return frame_signature.distance(self.sample_at(frame1), self.sample_at(frame2)) <= self.threshold
+
+    def find_boundaries(self, left, right):
+        """Save the frames (last before / first after) of every change in (left, right]."""
+        boundaries = 0
+
+        while not self.same(left, right):
+            lo, hi = left, right
+
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.same(lo, mid):
+                    lo = mid
+                else:
+                    hi = mid
+
+            self.save(lo)
+            self.save(hi)
+            boundaries += 1
+
+            # keep searching in case the band changed more than once within the coarse interval
+            left = hi
+
+        # frames probed during bisection that turned out to be in the middle of a run
+        self.unsaved.clear()
+
+        return boundaries
+
+
+def adaptive_sample(args):
+    out_dir = Path(args.output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    sampler = FrameSampler(args.video, args.threshold, out_dir)
+
+    coarse = sampler.sample_coarse(args.interval)
+    boundaries = 0
+
+    for left, right in zip(coarse, coarse[1:]):
+        boundaries += sampler.find_boundaries(left, right)
+
+    print(f'Video: {args.video} ({sampler.width}x{sampler.height} @ {float(sampler.fps):.3f} fps, {sampler.duration:.1f}s)')
+    print(f'Coarse samples: {len(coarse)}; subtitle changes: {boundaries}; '
+          f'extracted frames: {sampler.extracted}; kept frames: {len(sampler.saved)}')
+    print(f'Wrote snapshots to {out_dir.absolute()}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Adaptive boundary-seeking snapshot sampler',
+                                     usage="""
+    Sample a cropped subtitle video with frame-accurate subtitle boundaries:
+    \t{0} video-cropped.mp4 video_img --interval 1
+ """.format(Path(sys.argv[0]).name))
+
+    parser.add_argument('video',
+                        help='cropped subtitle video')
+    parser.add_argument('output_dir',
+                        help='folder for the snap_<ms>ms.png snapshots')
+    parser.add_argument('--interval', '-i',
+                        default=1.0,
+                        type=float,
+                        help='coarse sampling interval in seconds')
+    parser.add_argument('--threshold',
+                        default=2,
+                        type=int,
+                        help='frames whose signatures differ in more than this many cells (of 24x192) are '
+                             'considered to show a different subtitle')
+    args = parser.parse_args(sys.argv[1:])
+
+    adaptive_sample(args)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Detect the subtitle band of a video and print the ffmpeg crop geometry for it.
+#
+# A few hundred frames are sampled evenly across the video. In every frame, pixels with a strong
+# horizontal gradient (the vertical strokes of outlined subtitle glyphs) are counted per block.
+# Blocks that show edges in (almost) every frame are static overlays -- logos, letterbox borders --
+# and are ignored. Rows where the remaining edge density stands out from the rest of the picture
+# form candidate bands; the strongest band is kept, and it must be found again in most time slices
+# of the video (temporal stability). Its horizontal extent covers every column that is active inside it
+# in at least 1% of the sampled frames, so rare long lines are not cut off.
+#
+# A smaller, tighter crop makes every later step (decoding, snapshots, OCR) cheaper per frame.
+
+# DEPENDENCIES:
+# ffmpeg + ffprobe on PATH
+# pip install -U numpy
+
+# USAGE:
+# autocrop.py video.mp4                               -> 1738:115:100:965
+# autocrop.py video.mp4 --format ffmpeg               -> crop=1738:115:100:965
+# autocrop.py video.mp4 --output video.mp4_video-cropped.mp4 --fallback 1738:115:100:965
+# autocrop.py video.mp4 --crop 1738:115:100:965       (manual override, no detection)
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from frame_stream import probe_video
+
+PATTERN_GEOMETRY = re.compile(r'^(?:crop=)?(\d+):(\d+):(\d+):(\d+)$')
+
+BLOCK = 8
+
+# a column belongs to the band once text reaches it in at least 1% of the sampled frames
+COLUMN_PERCENTILE = 99
+
+
+def parse_geometry(value: str):
+    """'W:H:X:Y' (optionally prefixed with 'crop=') -> (w, h, x, y)"""
+    match = PATTERN_GEOMETRY.match(value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid crop geometry {value!r}, expected W:H:X:Y')
+    return tuple(int(n) for n in match.groups())
+
+
+def format_geometry(geometry, fmt='geometry') -> str:
+    w, h, x, y = geometry
+    if fmt == 'ffmpeg':
+        return f'crop={w}:{h}:{x}:{y}'
+    if fmt == 'json':
+        return json.dumps({'w': w, 'h': h, 'x': x, 'y': y})
+    return f'{w}:{h}:{x}:{y}'
+
+
+def edge_blocks(gray: np.ndarray, edge_threshold=48, block=BLOCK) -> np.ndarray:
+    """Fraction of pixels with a strong horizontal gradient in every block x block cell."""
+    edges = np.abs(np.diff(gray.astype(np.int16), axis=1)) > edge_threshold
+    rows, cols = edges.shape[0] // block, edges.shape[1] // block
+    cells = edges[:rows * block, :cols * block].reshape(rows, block, cols, block)
+    return cells.mean(axis=(1, 3), dtype=np.float32)
+
+
+def find_band(row_scores: np.ndarray, sensitivity=3.0, max_gap=1):
+    """(first, last) block row of the strongest run of rows standing out from the baseline, or None."""
+    median = np.median(row_scores)
+    mad = np.median(np.abs(row_scores - median)) or 1e-6
+    excess = row_scores - (median + sensitivity * 1.4826 * mad)
+    candidate = excess > 0
+
+    best, best_score = None, 0.0
+    start = None
+    gap = 0
+
+    # runs of candidate rows; a gap of up to max_gap rows joins the two lines of a 2-line subtitle
+    for row in range(len(candidate) + 1):
+        if row < len(candidate) and candidate[row]:
+            if start is None:
+                start = row
+            last, gap = row, 0
+            continue
+
+        if start is None:
+            continue
+
+        gap += 1
+        if row < len(candidate) and gap <= max_gap:
+            continue
+
+        score = float(excess[start:last + 1].clip(min=0).sum())
+        if score > best_score:
+            best, best_score = (start, last), score
+        start = None
+
+    return best
+
+
+class BandDetector:
+
+    def __init__(self, edge_threshold=48, static_fraction=0.9, sensitivity=3.0, slices=4):
+        self.edge_threshold = edge_threshold
+        self.static_fraction = static_fraction
+        self.sensitivity = sensitivity
+        self.slices = slices
+        self.frames = []
+        self.shape = None
+
+    def add(self, gray: np.ndarray):
+        self.shape = gray.shape
+        self.frames.append(edge_blocks(gray, self.edge_threshold))
+
+    def detect(self, margin=8):
+        """(w, h, x, y) crop geometry of the subtitle band, and a dict of diagnostics; (None, ...) if not found."""
+        stack = np.stack(self.frames)
+        active = stack > 0.05
+
+        # edges in (nearly) every sampled frame: logo, watermark, letterbox border -- never a subtitle
+        static = active.mean(axis=0) >= self.static_fraction
+        stack = np.where(static, 0.0, stack)
+
+        band = find_band(stack.mean(axis=(0, 2)), self.sensitivity)
+        info = {'frames': len(self.frames), 'static_blocks': int(static.sum())}
+        if band is None:
+            return None, info
+
+        # temporal stability: the band must also be found in most slices of the video on their own
+        agreeing = 0
+        for part in np.array_split(stack, self.slices):
+            found = find_band(part.mean(axis=(0, 2)), self.sensitivity) if len(part) else None
+            if found and found[0] <= band[1] and found[1] >= band[0]:
+                agreeing += 1
+        info['agreeing_slices'] = f'{agreeing}/{self.slices}'
+        if agreeing * 2 < self.slices:
+            return None, info
+
+        # per-frame column activity: a long line shown in a few frames only must widen the crop as much
+        # as the short lines shown in most of them, so take a high percentile instead of the mean
+        columns = np.percentile(stack[:, band[0]:band[1] + 1, :].mean(axis=1), COLUMN_PERCENTILE, axis=0)
+        active_columns = np.flatnonzero(columns > columns.max() * 0.1)
+
+        height, width = self.shape
+        y0 = max(0, band[0] * BLOCK - margin)
+        y1 = min(height, (band[1] + 1) * BLOCK + margin)
+        x0 = max(0, active_columns[0] * BLOCK - margin)
+        x1 = min(width, (active_columns[-1] + 1) * BLOCK + margin)
+
+        # even sizes and offsets keep yuv420p chroma subsampling happy
+        x0, y0 = x0 // 2 * 2, y0 // 2 * 2
+        w, h = (x1 - x0) // 2 * 2, (y1 - y0) // 2 * 2
+        info['band_rows'] = [band[0] * BLOCK, (band[1] + 1) * BLOCK]
+
+        return (int(w), int(h), int(x0), int(y0)), info
+
+
+def sample_frames(video, samples=200, jobs=8):
+    """Yield gray frames at `samples` evenly spaced timestamps, seeking instead of decoding the whole video."""
+    width, height, _, duration = probe_video(video)
+    # skip the first and last 5%: opening titles and end credits
+    times = np.linspace(duration * 0.05, duration * 0.95, samples)
+
+    def grab(t):
+        proc = subprocess.run(['ffmpeg', '-v', 'error', '-ss', f'{t:.3f}', '-i', str(video),
+                               '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                              stdout=subprocess.PIPE)
+        if len(proc.stdout) < width * height:
+            return None
+        return np.frombuffer(proc.stdout[:width * height], dtype=np.uint8).reshape(height, width)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for gray in executor.map(grab, times):
+            if gray is not None:
+                yield gray
+
+
+def detect_crop(video, samples=200, jobs=8, edge_threshold=48, sensitivity=3.0, margin=8):
+    detector = BandDetector(edge_threshold=edge_threshold, sensitivity=sensitivity)
+    for gray in sample_frames(video, samples, jobs):
+        detector.add(gray)
+
+    if not detector.frames:
+        return None, {'frames': 0}
+
+    return detector.detect(margin)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Detect the subtitle band of a video and print its ffmpeg crop geometry')
+    parser.add_argument('video',
+                        help='input video with hard-burned subtitles')
+    parser.add_argument('--crop',
+                        type=parse_geometry,
+                        default=None,
+                        help='manual override W:H:X:Y: skip detection and use this geometry')
+    parser.add_argument('--fallback',
+                        type=parse_geometry,
+                        default=None,
+                        help='geometry W:H:X:Y to use when no subtitle band is found (default: fail)')
+    parser.add_argument('--samples', '-n',
+                        default=200,
+                        type=int,
+                        help='frames sampled evenly across the video')
+    parser.add_argument('--jobs', '-j',
+                        default=8,
+                        type=int,
+                        help='ffmpeg seeks running in parallel')
+    parser.add_argument('--edge-threshold',
+                        default=48,
+                        type=int,
+                        help='gray level step between neighbouring pixels that counts as a glyph edge')
+    parser.add_argument('--sensitivity',
+                        default=3.0,
+                        type=float,
+                        help='rows whose edge density is this many (robust) standard deviations above the '
+                             'median row belong to the subtitle band; lower finds fainter text')
+    parser.add_argument('--margin',
+                        default=8,
+                        type=int,
+                        help='pixels of padding around the detected band')
+    parser.add_argument('--format', '-f',
+                        default='geometry',
+                        choices=('geometry', 'ffmpeg', 'json'),
+                        help='geometry = W:H:X:Y, ffmpeg = crop=W:H:X:Y, json = {"w":..,"h":..,"x":..,"y":..}')
+    parser.add_argument('--output', '-o',
+                        default=None,
+                        help='also write the cropped video to this file with ffmpeg')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.crop:
+        geometry = args.crop
+        sys.stderr.write(f'Using manual crop {format_geometry(geometry)}\n')
+    else:
+        geometry, info = detect_crop(args.video, args.samples, args.jobs, args.edge_threshold, args.sensitivity,
+                                     args.margin)
+        sys.stderr.write(f'Detection: {info}\n')
+
+        if geometry is None:
+            if not args.fallback:
+                sys.exit(f'ERROR: no stable subtitle band found in {args.video}; pass --crop or --fallback')
+            geometry = args.fallback
+            sys.stderr.write(f'WARN: no stable subtitle band found, using fallback crop {format_geometry(geometry)}\n')
+
+    print(format_geometry(geometry, args.format))
+
+    if args.output:
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', args.video,
+                        '-filter:v', format_geometry(geometry, 'ffmpeg'), '-c:a', 'copy', args.output],
+                       check=True)
+        sys.stderr.write(f'Wrote {args.output}\n')
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# End-to-end pipeline benchmark on synthetic frames.
+#
+# Renders a synthetic script of subtitle frames (benchmarks/synthetic_frames.py), then runs
+# do-ocr.py (stub backend), gensrt.py, srt_subs_zh2pinyin.py, deepl.py (against a local DeepL
+# stand-in) and srt_merge.py as subprocesses, --repeat times each. Reports per-stage throughput,
+# wall time percentiles, CPU time and peak memory, plus the accuracy of the generated cues against
+# the ground truth. Results can be saved as JSON and compared with an earlier run.
+
+# USAGE:
+# benchmarks/bench_pipeline.py --cues 300 --repeat 5 --json results.json
+# benchmarks/bench_pipeline.py --cues 300 --repeat 5 --compare results.json
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import srt  # noqa: E402
+
+import deepl_stub_server  # noqa: E402
+import synthetic_frames  # noqa: E402
+
+# stages slower than this (median wall time ratio) are flagged by --compare
+REGRESSION_RATIO = 1.10
+
+
+def percentile(values, p):
+    # nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run_measured(command, cwd):
+    """Run a command; returns (wall seconds, CPU seconds, peak RSS MiB) of the child process."""
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode:
+        raise RuntimeError(f'{" ".join(map(str, command))} failed with exit code {process.returncode}:\n'
+                           f'{stderr.decode("utf-8", "replace")}')
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_mib = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return wall, usage.ru_utime + usage.ru_stime, peak_mib
+
+
+def script(name):
+    return [sys.executable, str(REPO_DIR / name)]
+
+
+def cue_accuracy(truth, generated):
+    """Match every true cue to the generated cue overlapping it most and score text and timings."""
+    matched = set()
+    exact = 0
+    start_errors, end_errors = [], []
+
+    for cue in truth:
+        best, best_overlap = None, 0.0
+        for i, sub in enumerate(generated):
+            overlap = (min(cue.end, sub.end) - max(cue.start, sub.start)).total_seconds()
+            if overlap > best_overlap:
+                best, best_overlap = i, overlap
+
+        if best is None:
+            continue
+
+        matched.add(best)
+        sub = generated[best]
+        exact += sub.content.strip() == cue.content
+        start_errors.append(abs((sub.start - cue.start).total_seconds()) * 1000)
+        end_errors.append(abs((sub.end - cue.end).total_seconds()) * 1000)
+
+    return {
+        'truth_cues': len(truth),
+        'generated_cues': len(generated),
+        'found_cues': len(start_errors),
+        'exact_text': exact / len(truth) if truth else 0.0,
+        # generated cues that are not the best match of any true cue: fragments, noise
+        'spurious_cues': len(generated) - len(matched),
+        'start_error_ms_p50': percentile(start_errors, 50) if start_errors else None,
+        'start_error_ms_p90': percentile(start_errors, 90) if start_errors else None,
+        'end_error_ms_p50': percentile(end_errors, 50) if end_errors else None,
+        'end_error_ms_p90': percentile(end_errors, 90) if end_errors else None,
+    }
+
+
+def bench(args, work: Path):
+    script_cues = synthetic_frames.make_script(args.cues, args.seed, max_gap=args.max_gap)
+    img_dir = work / 'img'
+
+    started = time.perf_counter()
+    frames = synthetic_frames.write_frames(script_cues, img_dir, args.fps, noise=args.noise,
+                                           ocr_error_rate=args.ocr_error_rate, seed=args.seed)
+    print(f'rendered {frames} frames of {len(script_cues)} cues in {time.perf_counter() - started:.1f}s')
+
+    truth_srt = work / 'ground_truth.srt'
+    synthetic_frames.write_ground_truth(script_cues, truth_srt)
+
+    server, endpoint, deepl_stats = deepl_stub_server.start_server(latency=args.deepl_latency,
+                                                                   throttle_every=args.throttle_every)
+
+    results = work / 'results.json'
+    stages = [
+        ('ocr', frames,
+         script('do-ocr.py') + [img_dir, results, '--backend', 'stub', '--no-cache', '--stub-delay', args.stub_delay,
+                                '--threads', args.threads]),
+        ('gensrt', frames,
+         script('gensrt.py') + [results, 'ocr.srt', '--fps', args.fps]),
+        ('pinyin', len(script_cues),
+         script('srt_subs_zh2pinyin.py') + ['ocr.srt', '--force-normalize-input-to-simplified', '-t',
+                                            '-o', 'pinyin.srt']),
+        ('translate', len(script_cues),
+         script('deepl.py') + ['zh:en', 'ocr.srt', '--srt', '-o', 'en.srt', '--endpoint', endpoint,
+                               '--auth-key', 'bench', '--no-tm']),
+        ('merge', len(script_cues),
+         script('srt_merge.py') + ['pinyin.srt', 'en.srt', '-o', 'merged.srt']),
+    ]
+
+    runs = {name: [] for name, _, _ in stages}
+    try:
+        for repeat in range(args.repeat):
+            # OCR resumes from existing results: start every repeat from scratch
+            results.unlink(missing_ok=True)
+
+            for name, _, command in stages:
+                runs[name].append(run_measured([str(arg) for arg in command] + ['--metrics', f'{name}.metrics.json'],
+                                               cwd=work))
+
+            print(f'repeat {repeat + 1}/{args.repeat}: ' +
+                  ', '.join(f'{name} {runs[name][-1][0]:.2f}s' for name, _, _ in stages))
+    finally:
+        server.shutdown()
+
+    report = {}
+    for name, items, _ in stages:
+        walls = [wall for wall, _, _ in runs[name]]
+        median = percentile(walls, 50)
+        report[name] = {
+            'items': items,
+            'items_per_second': items / median if median else None,
+            'wall_s_p50': median,
+            'wall_s_p90': percentile(walls, 90),
+            'wall_s_p99': percentile(walls, 99),
+            'cpu_s_p50': percentile([cpu for _, cpu, _ in runs[name]], 50),
+            'peak_rss_mib': max(peak for _, _, peak in runs[name]),
+            # latency histograms, counters and queue depths the script reported for its last run
+            'metrics': json.loads((work / f'{name}.metrics.json').read_text(encoding='utf-8')),
+        }
+
+    accuracy = cue_accuracy(list(srt.parse(truth_srt.read_text(encoding='utf-8'))),
+                            list(srt.parse((work / 'ocr.srt').read_text(encoding='utf-8'))))
+
+    return {
+        'stages': report,
+        'accuracy': accuracy,
+        'deepl_stub': {'requests': deepl_stats.requests, 'throttled': deepl_stats.throttled,
+                       'texts': deepl_stats.texts, 'characters': deepl_stats.characters},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result):
+    print(f"{'stage':<10} {'items':>7} {'items/s':>9} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'cpu s':>7} {'RSS MiB':>8}")
+    for name, stage in result['stages'].items():
+        print(f"{name:<10} {stage['items']:>7} {stage['items_per_second']:>9.1f} {stage['wall_s_p50']:>7.2f} "
+              f"{stage['wall_s_p90']:>7.2f} {stage['wall_s_p99']:>7.2f} {stage['cpu_s_p50']:>7.2f} "
+              f"{stage['peak_rss_mib']:>8.1f}")
+
+    ocr_latency = result['stages']['ocr']['metrics']['histograms'].get('ocr_frame_seconds')
+    if ocr_latency:
+        print(f"OCR latency per frame: p50 <= {ocr_latency[0]['p50'] * 1000:.1f} ms, "
+              f"p99 <= {ocr_latency[0]['p99'] * 1000:.1f} ms")
+
+    accuracy = result['accuracy']
+    print(f"cues: {accuracy['generated_cues']} generated for {accuracy['truth_cues']} true, "
+          f"{accuracy['found_cues']} found, {accuracy['spurious_cues']} spurious; "
+          f"exact text {100 * accuracy['exact_text']:.1f}%; "
+          f"start error p50/p90 {accuracy['start_error_ms_p50']}/{accuracy['start_error_ms_p90']} ms, "
+          f"end error p50/p90 {accuracy['end_error_ms_p50']}/{accuracy['end_error_ms_p90']} ms")
+    print(f"DeepL stand-in: {result['deepl_stub']['requests']} requests "
+          f"({result['deepl_stub']['throttled']} throttled)")
+
+
+def compare(old, new):
+    print(f"compared with {old.get('git_commit')} ({old.get('timestamp')}):")
+
+    for name, stage in new['stages'].items():
+        before = old['stages'].get(name)
+        if not before:
+            continue
+        ratio = stage['wall_s_p50'] / before['wall_s_p50'] if before['wall_s_p50'] else float('inf')
+        flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+        print(f"{name:<10} p50 {before['wall_s_p50']:.2f}s -> {stage['wall_s_p50']:.2f}s ({ratio:.2f}x){flag}")
+
+    before, after = old['accuracy']['exact_text'], new['accuracy']['exact_text']
+    flag = '  REGRESSION' if after < before else ''
+    print(f"exact text {100 * before:.1f}% -> {100 * after:.1f}%{flag}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark on synthetic subtitle frames')
+    parser.add_argument('--cues', '-n',
+                        default=200,
+                        type=int)
+    parser.add_argument('--fps',
+                        default=1.0,
+                        type=float)
+    parser.add_argument('--max-gap',
+                        default=2.0,
+                        type=float)
+    parser.add_argument('--noise',
+                        default=4.0,
+                        type=float)
+    parser.add_argument('--ocr-error-rate',
+                        default=0.1,
+                        type=float,
+                        help='fraction of frames the stub OCR misreads')
+    parser.add_argument('--stub-delay',
+                        default=0.02,
+                        type=float,
+                        help='simulated seconds of OCR per frame')
+    parser.add_argument('--threads',
+                        default=20,
+                        type=int,
+                        help='do-ocr.py --threads')
+    parser.add_argument('--deepl-latency',
+                        default=0.05,
+                        type=float,
+                        help='simulated seconds per DeepL request')
+    parser.add_argument('--throttle-every',
+                        default=0,
+                        type=int,
+                        help='DeepL stand-in answers every Nth request with HTTP 429')
+    parser.add_argument('--repeat', '-r',
+                        default=3,
+                        type=int)
+    parser.add_argument('--seed',
+                        default=42,
+                        type=int)
+    parser.add_argument('--work-dir',
+                        default=None,
+                        help='keep the generated frames and outputs here (default: temporary folder)')
+    parser.add_argument('--json',
+                        default=None,
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare',
+                        default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(args.work_dir or tmp)
+        work.mkdir(parents=True, exist_ok=True)
+        result = bench(args, work)
+
+    result.update(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), git_commit=git_commit(),
+                  python=platform.python_version(), platform=platform.platform(), params=vars(args))
+
+    print_report(result)
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text(encoding='utf-8')), result)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2), encoding='utf-8')
+        print(f'Wrote {args.json}')
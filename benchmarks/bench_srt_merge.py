@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Benchmark srt_merge.py on synthetic SRT files.
+#
+# Generates two tracks of N cues (B drifts randomly against A), times merge_files() with the
+# sorted start-time index and the streaming merge_tracks() pass, and checks on a smaller sample
+# that both outputs are byte-identical to the original linear nearest() scan.
+
+# USAGE:
+# benchmarks/bench_srt_merge.py --cues 100000 --reference-cues 2000
+
+import argparse
+import contextlib
+import io
+import random
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import srt  # noqa: E402
+
+import srt_merge  # noqa: E402
+
+
+class LinearSlotIndex(srt_merge.SlotIndex):
+    # the pre-index behaviour: a full min() scan over file A for every cue of file B
+    def __init__(self, slots):
+        super().__init__(slots)
+        self.slots = slots
+
+    def nearest(self, pivot):
+        return srt_merge.nearest(self.slots, pivot)
+
+
+def write_tracks(folder: Path, cues: int, seed: int):
+    rnd = random.Random(seed)
+    subs_a, subs_b = [], []
+    t = 0.0
+
+    for i in range(1, cues + 1):
+        t += rnd.uniform(0.5, 4.0)
+        duration = rnd.uniform(1.0, 3.0)
+        drift = rnd.uniform(-4.0, 4.0)
+        subs_a.append(srt.Subtitle(i, timedelta(seconds=t), timedelta(seconds=t + duration), f'A line {i}'))
+        subs_b.append(srt.Subtitle(i, timedelta(seconds=max(0.0, t + drift)), timedelta(seconds=max(0.0, t + drift) + duration),
+                                   f'B line {i}'))
+
+    path_a, path_b = folder / f'a_{cues}.srt', folder / f'b_{cues}.srt'
+    path_a.write_text(srt.compose(subs_a, reindex=False), encoding='utf-8')
+    path_b.write_text(srt.compose(subs_b, reindex=False), encoding='utf-8')
+
+    return path_a, path_b
+
+
+def run_merge(path_a, path_b, output, match='start'):
+    args = argparse.Namespace(srt1=str(path_a), srt2=str(path_b), output_file=str(output), nearest_slot=True,
+                              match=match, encoding1='utf-8', encoding2='utf-8')
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        srt_merge.merge_files(args)
+
+    return time.perf_counter() - started
+
+
+def run_stream(path_a, path_b, output):
+    args = argparse.Namespace(nearest_slot=True)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        srt_merge.merge_tracks(args, [path_a, path_b], ['utf-8', 'utf-8'], [None, srt_merge.MAX_NEAREST_SECONDS],
+                               output)
+
+    return time.perf_counter() - started
+
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+
+        ref_a, ref_b = write_tracks(folder, args.reference_cues, args.seed)
+        indexed_seconds = run_merge(ref_a, ref_b, folder / 'indexed.srt')
+
+        original_index = srt_merge.SlotIndex
+        srt_merge.SlotIndex = LinearSlotIndex
+        try:
+            linear_seconds = run_merge(ref_a, ref_b, folder / 'linear.srt')
+        finally:
+            srt_merge.SlotIndex = original_index
+
+        stream_seconds = run_stream(ref_a, ref_b, folder / 'stream.srt')
+
+        identical = (folder / 'indexed.srt').read_bytes() == (folder / 'linear.srt').read_bytes() \
+            == (folder / 'stream.srt').read_bytes()
+
+        print(f'{args.reference_cues} x {args.reference_cues} cues: linear {linear_seconds:.2f}s, '
+              f'indexed {indexed_seconds:.2f}s, stream {stream_seconds:.2f}s, identical output: {identical}')
+
+        big_a, big_b = write_tracks(folder, args.cues, args.seed)
+        for match in ('start', 'overlap'):
+            seconds = run_merge(big_a, big_b, folder / f'big_{match}.srt', match=match)
+            print(f'{args.cues} x {args.cues} cues, --match {match}: {seconds:.2f}s '
+                  f'({args.cues / seconds:.0f} cues/s)')
+
+        seconds = run_stream(big_a, big_b, folder / 'big_stream.srt')
+        print(f'{args.cues} x {args.cues} cues, --stream: {seconds:.2f}s ({args.cues / seconds:.0f} cues/s)')
+
+        # the linear scan is quadratic: extrapolate instead of running it for hours
+        estimate = linear_seconds * (args.cues / args.reference_cues) ** 2
+        print(f'{args.cues} x {args.cues} cues, linear scan (extrapolated): ~{estimate:.0f}s')
+
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='srt_merge.py benchmark on synthetic SRT files')
+    parser.add_argument('--cues', '-n',
+                        default=100_000,
+                        type=int,
+                        help='cues per track for the indexed merge')
+    parser.add_argument('--reference-cues', '-r',
+                        default=2000,
+                        type=int,
+                        help='cues per track for the comparison against the linear scan')
+    parser.add_argument('--seed',
+                        default=42,
+                        type=int)
+    args = parser.parse_args(sys.argv[1:])
+
+    bench(args)
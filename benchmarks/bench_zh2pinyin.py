@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Benchmark srt_subs_zh2pinyin.py with and without the memoized conversion engine.
+#
+# Pass a large real-world Chinese SRT file for meaningful numbers; without one a synthetic
+# file with OCR-like repetition is generated. Both runs must produce identical output.
+
+# USAGE:
+# benchmarks/bench_zh2pinyin.py movie.zh.srt -t
+# benchmarks/bench_zh2pinyin.py --cues 20000
+
+import argparse
+import contextlib
+import io
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import srt  # noqa: E402
+
+import srt_subs_zh2pinyin  # noqa: E402
+
+LINES = ['你好', '嗯', '谢谢你', '我们走吧', '你在干什么？', '这是我的朋友', '重庆的火锅很好吃',
+         '他长大了以后想当医生', '没关系，我们明天再说', '快点！', '我不知道', '银行在哪里？']
+
+
+def write_synthetic(path: Path, cues: int, seed: int):
+    rnd = random.Random(seed)
+    subs = []
+    for i in range(1, cues + 1):
+        content = rnd.choice(LINES) if rnd.random() < 0.7 else ''.join(rnd.sample(LINES, 3))
+        subs.append(srt.Subtitle(i, timedelta(seconds=2 * i), timedelta(seconds=2 * i + 1.5), content))
+    path.write_text(srt.compose(subs), encoding='utf-8')
+
+
+def run(srt_file: Path, output: Path, memo_size: int, simp_to_trad: bool):
+    options = [str(srt_file), '--output-file', str(output), '--force-normalize-input-to-simplified',
+               '--memo-size', str(memo_size), '--no-echo']
+    if simp_to_trad:
+        options.append('--simp-to-trad')
+    args = srt_subs_zh2pinyin.make_parser().parse_args(options)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        srt_subs_zh2pinyin.append_pinyin_subs(args)
+
+    return time.perf_counter() - started
+
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        srt_file = folder / 'input.srt'
+
+        if args.srt_file:
+            shutil.copy(args.srt_file, srt_file)
+        else:
+            write_synthetic(srt_file, args.cues, args.seed)
+
+        cues = len(list(srt.parse(srt_file.read_text(encoding='utf-8'))))
+
+        before = run(srt_file, folder / 'before.srt', memo_size=0, simp_to_trad=args.simp_to_trad)
+        after = run(srt_file, folder / 'after.srt', memo_size=args.memo_size, simp_to_trad=args.simp_to_trad)
+
+        identical = (folder / 'before.srt').read_bytes() == (folder / 'after.srt').read_bytes()
+
+    print(f'{cues} cues from {args.srt_file or "synthetic input"}')
+    print(f'before (no memo): {before:.2f}s ({cues / before:.0f} cues/s)')
+    print(f'after  (memo):    {after:.2f}s ({cues / after:.0f} cues/s), {before / after:.1f}x')
+    print(f'identical output: {identical}')
+
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='srt_subs_zh2pinyin.py conversion benchmark')
+    parser.add_argument('srt_file',
+                        nargs='?',
+                        default=None,
+                        help='real-world Chinese SRT file (default: synthetic input)')
+    parser.add_argument('--cues', '-n',
+                        default=20000,
+                        type=int,
+                        help='synthetic input only: number of cues')
+    parser.add_argument('--simp-to-trad', '-t',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--memo-size',
+                        default=100_000,
+                        type=int)
+    parser.add_argument('--seed',
+                        default=42,
+                        type=int)
+    args = parser.parse_args(sys.argv[1:])
+
+    bench(args)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Check that gensrt.py --incremental produces the same cues as a full rebuild.
+#
+# Random OCR results (runs of the same line with misreads and blank gaps) are mutated step by
+# step the way re-runs see them: OCR filling in more frames, a range re-OCR'ed with other text,
+# frames deleted, single frames blanked or misread. After every step the incremental build from
+# the state file must equal a full build of the same results, for frame-number and millisecond keys.
+
+# USAGE:
+# benchmarks/check_gensrt_incremental.py --frames 400 --steps 200
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gensrt  # noqa: E402
+
+LINES = ['你好', '谢谢你', '我们走吧', '你在干什么？', '这是我的朋友', '没关系，我们明天再说', '我不知道']
+
+
+def misread(text: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(text))
+    return text[:i] + rnd.choice('的了是') + text[i + 1:]
+
+
+def make_texts(frames: int, rnd: random.Random) -> list:
+    texts = []
+    while len(texts) < frames:
+        line = rnd.choice(LINES) if rnd.random() < 0.8 else ''
+        for _ in range(rnd.randint(1, 8)):
+            texts.append(misread(line, rnd) if line and rnd.random() < 0.15 else line)
+    return texts[:frames]
+
+
+def make_keys(frames: int, ms_keys: bool, rnd: random.Random) -> list:
+    if not ms_keys:
+        return [f'{n:04d}' for n in range(1, frames + 1)]
+
+    # adaptive_sample.py keys: irregular millisecond timestamps
+    keys, t = [], 0
+    for _ in range(frames):
+        t += rnd.randint(40, 1000)
+        keys.append(f'{t:08d}ms')
+    return keys
+
+
+def mutate(results: dict, all_keys: list, texts: list, rnd: random.Random) -> str:
+    present = sorted(results, key=gensrt.frame_sort_key)
+    kind = rnd.choice(['extend', 'reocr', 'delete', 'blank', 'misread', 'none'])
+
+    if kind == 'extend' and len(present) < len(all_keys):
+        # OCR is still running: the next frames arrive
+        for key in all_keys[len(present):len(present) + rnd.randint(1, 30)]:
+            results[key] = texts[all_keys.index(key)]
+    elif kind == 'reocr' and present:
+        first = rnd.randrange(len(present))
+        line = rnd.choice(LINES + [''])
+        for key in present[first:first + rnd.randint(1, 12)]:
+            results[key] = line
+    elif kind == 'delete' and len(present) > 1:
+        for key in rnd.sample(present, rnd.randint(1, min(3, len(present) - 1))):
+            del results[key]
+    elif kind == 'blank' and present:
+        results[rnd.choice(present)] = ''
+    elif kind == 'misread' and present:
+        key = rnd.choice(present)
+        results[key] = misread(results[key], rnd) if results[key] else rnd.choice(LINES)
+    else:
+        kind = 'none'
+
+    return kind
+
+
+def run(results: dict, folder: Path, fps: float, incremental: bool):
+    json_file = folder / 'results.json'
+    json_file.write_text(json.dumps(results, ensure_ascii=False), encoding='utf-8')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if incremental:
+            return gensrt.generate_srt_incremental(json_file, folder / 'state.gensrt.json', fps=fps)
+        return gensrt.generate_srt(json_file, fps=fps)
+
+
+def check(frames: int, steps: int, ms_keys: bool, seed: int) -> list:
+    rnd = random.Random(seed)
+    texts = make_texts(frames, rnd)
+    all_keys = make_keys(frames, ms_keys, rnd)
+    fps = 2.0
+
+    # start part-way through the OCR run
+    results = dict(zip(all_keys[:frames // 3], texts[:frames // 3]))
+    errors = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        for step in range(steps):
+            kind = mutate(results, all_keys, texts, rnd) if step else 'first run'
+            incremental = run(results, folder, fps, incremental=True)
+            full = run(results, folder, fps, incremental=False)
+
+            got = [(sub.start, sub.end, sub.content) for sub in incremental]
+            want = [(sub.start, sub.end, sub.content) for sub in full]
+            if got != want:
+                first = next((i for i, (a, b) in enumerate(zip(got, want)) if a != b), min(len(got), len(want)))
+                errors.append(f'step {step} ({kind}): {len(got)} incremental vs {len(want)} full-build cues, '
+                              f'first difference at cue {first + 1}')
+
+    return errors
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check gensrt.py --incremental against full rebuilds')
+    parser.add_argument('--frames', '-n',
+                        default=400,
+                        type=int)
+    parser.add_argument('--steps',
+                        default=200,
+                        type=int,
+                        help='random mutations of the results, each followed by an incremental and a full build')
+    parser.add_argument('--seeds',
+                        default=3,
+                        type=int,
+                        help='independent runs per key style')
+    args = parser.parse_args(sys.argv[1:])
+
+    failed = False
+    for ms_keys in (False, True):
+        for seed in range(args.seeds):
+            errors = check(args.frames, args.steps, ms_keys, seed)
+            print(f'{"millisecond" if ms_keys else "frame-number"} keys, seed {seed}: '
+                  f'{"FAIL" if errors else "ok"} ({args.steps} steps)')
+            for error in errors[:10]:
+                print(f'  {error}')
+            failed = failed or bool(errors)
+
+    if failed:
+        sys.exit(1)
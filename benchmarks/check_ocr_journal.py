@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Check crash recovery of the OCR results journal (ocr_journal.py).
+#
+# A journal of random records is cut at every byte offset, as a crash in the middle of a write
+# would leave it. Loading it must return exactly the records that were complete before the cut
+# plus the compacted results, cut the torn tail off the file, and accept further appends that a
+# later load sees. A corrupt record in the middle is skipped, and a crash between compaction and
+# deleting the journal must not change the results.
+
+# USAGE:
+# benchmarks/check_ocr_journal.py --records 40
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ocr_journal import OcrJournal  # noqa: E402
+
+LINES = ['你好', '嗯', '', '谢谢你', '我们走吧', '你在干什么？', '这是我的朋友', 'OK "quoted"\\n']
+
+
+def quiet():
+    # load() reports replayed and dropped records; keep the check output readable
+    stack = contextlib.ExitStack()
+    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+    return stack
+
+
+def make_records(count: int, seed: int):
+    rnd = random.Random(seed)
+    # keys repeat: a re-OCR'ed frame is journaled again and the last record wins
+    return [(f'{rnd.randrange(count):04d}', rnd.choice(LINES)) for _ in range(count)]
+
+
+def expected(compacted: dict, records) -> dict:
+    result = dict(compacted)
+    result.update(records)
+    return result
+
+
+def check_truncation(folder: Path, compacted: dict, records) -> list:
+    results_file = folder / 'video_results.json'
+    results_file.write_text(json.dumps(compacted, ensure_ascii=False), encoding='utf-8')
+
+    journal = OcrJournal(results_file, fsync_every=1)
+    for key, text in records:
+        journal.append(key, text)
+    journal.close()
+
+    full = journal.journal_path.read_bytes()
+    # byte offset at which every record ends
+    ends = [i + 1 for i, byte in enumerate(full) if byte == ord('\n')]
+    errors = []
+
+    for cut in range(len(full) + 1):
+        journal.journal_path.write_bytes(full[:cut])
+        complete = sum(1 for end in ends if end <= cut)
+        good_offset = ends[complete - 1] if complete else 0
+
+        with quiet():
+            loaded = OcrJournal(results_file).load()
+        if loaded != expected(compacted, records[:complete]):
+            errors.append(f'cut at byte {cut}: loaded {len(loaded)} keys, expected the first {complete} records')
+            continue
+        if journal.journal_path.stat().st_size != good_offset:
+            errors.append(f'cut at byte {cut}: torn tail not removed '
+                          f'({journal.journal_path.stat().st_size} bytes left, expected {good_offset})')
+            continue
+
+        # appending after recovery must not glue the new record onto the torn one
+        resumed = OcrJournal(results_file)
+        resumed.append('resumed', 'after crash')
+        resumed.close()
+        with quiet():
+            reloaded = OcrJournal(results_file).load()
+        if reloaded != dict(expected(compacted, records[:complete]), resumed='after crash'):
+            errors.append(f'cut at byte {cut}: record appended after recovery was lost')
+
+    return errors
+
+
+def check_corrupt_record(folder: Path, records) -> list:
+    results_file = folder / 'corrupt_results.json'
+    journal = OcrJournal(results_file)
+    lines = [json.dumps({'key': key, 'text': text}, ensure_ascii=False) for key, text in records]
+    middle = len(lines) // 2
+    lines[middle] = lines[middle][:len(lines[middle]) // 2]
+    journal.journal_path.write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+
+    with quiet():
+        loaded = journal.load()
+
+    if loaded != expected({}, records[:middle] + records[middle + 1:]):
+        return ['a corrupt record in the middle of the journal was not skipped on its own']
+    return []
+
+
+def check_compaction_crash(folder: Path, compacted: dict, records) -> list:
+    results_file = folder / 'compact_results.json'
+    results_file.write_text(json.dumps(compacted, ensure_ascii=False), encoding='utf-8')
+
+    journal = OcrJournal(results_file)
+    for key, text in records:
+        journal.append(key, text)
+    with quiet():
+        full = journal.load()
+
+    # the results file is replaced, but the process dies before the journal is deleted
+    kept = journal.journal_path.read_bytes()
+    journal.compact(full)
+    journal.journal_path.write_bytes(kept)
+
+    errors = []
+    with quiet():
+        if OcrJournal(results_file).load() != full:
+            errors.append('replaying the journal on top of the compacted results changed them')
+
+    journal.compact(full)
+    if journal.journal_path.exists():
+        errors.append('journal not removed after compaction')
+    if json.loads(results_file.read_text(encoding='utf-8')) != full:
+        errors.append('compacted results differ from the loaded dictionary')
+
+    return errors
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check crash recovery of the OCR results journal')
+    parser.add_argument('--records', '-n',
+                        default=40,
+                        type=int,
+                        help='journal records; the journal is cut at every byte offset')
+    parser.add_argument('--seed',
+                        default=42,
+                        type=int)
+    args = parser.parse_args(sys.argv[1:])
+
+    records = make_records(args.records, args.seed)
+    compacted = {f'{i:04d}': 'compacted' for i in range(0, args.records, 3)}
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        for name, errors in (('truncated last record', check_truncation(folder, compacted, records)),
+                             ('corrupt record', check_corrupt_record(folder, records)),
+                             ('crash during compaction', check_compaction_crash(folder, compacted, records))):
+            print(f'{name}: {"FAIL" if errors else "ok"}')
+            for error in errors[:10]:
+                print(f'  {error}')
+            failed = failed or bool(errors)
+
+    if failed:
+        sys.exit(1)
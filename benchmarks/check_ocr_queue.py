@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Check lease expiry of the distributed OCR job queue (ocr_queue.py).
+#
+# With short leases, a worker that leases a job and vanishes must get the job handed to the next
+# worker after the lease runs out, while a renewed lease keeps its job. Whichever lease delivers
+# first stores the result exactly once; later deliveries, renewals and failures on the stale lease
+# are refused, and the coordinator only finishes once every job is done or given up. The same
+# sequence is then replayed through the HTTP coordinator.
+
+# USAGE:
+# benchmarks/check_ocr_queue.py --lease-seconds 0.2
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ocr_queue import JobQueue  # noqa: E402
+from ocr_queue import Worker  # noqa: E402
+from ocr_queue import make_handler  # noqa: E402
+
+
+class Checker:
+
+    def __init__(self):
+        self.errors = []
+
+    def expect(self, condition, message):
+        if not condition:
+            self.errors.append(message)
+
+
+def check_expiry(lease_seconds) -> list:
+    check = Checker()
+    jobs = JobQueue(lease_seconds=lease_seconds, max_attempts=2)
+    stored = []
+    for frame in ('0001', '0002', '0003'):
+        jobs.add(frame)
+
+    (lost_id, lost_token, _), = jobs.lease('vanished', 1)
+    (kept_id, kept_token, _), = jobs.lease('slow', 1)
+
+    # half a lease later neither lease has run out
+    time.sleep(lease_seconds / 2)
+    check.expect(jobs.renew(kept_id, kept_token), 'renewing a live lease was refused')
+    (other_id, other_token, _), = jobs.lease('third', 1)
+    check.expect(other_id not in (lost_id, kept_id), 'a live lease was handed out again')
+
+    time.sleep(lease_seconds * 0.75)
+    releases = jobs.lease('rescuer', 3)
+    check.expect([job_id for job_id, _, _ in releases] == [lost_id],
+                 f'after expiry expected job {lost_id} again, got {[job_id for job_id, _, _ in releases]}')
+    check.expect(jobs.status()['expired_leases'] == 1, f"expected 1 expired lease, got {jobs.status()['expired_leases']}")
+    if not releases:
+        return check.errors
+    _, new_token, _ = releases[0]
+    check.expect(new_token != lost_token, 'the re-leased job kept its old token')
+
+    # the vanished worker turns out to be slow and delivers first: stored once, the rescuer is refused
+    check.expect(not jobs.renew(lost_id, lost_token), 'an expired lease was renewed')
+    check.expect(jobs.complete(lost_id, lost_token, stored.append), 'the first result (expired lease) was refused')
+    check.expect(not jobs.complete(lost_id, new_token, stored.append), 'a second result for a done job was accepted')
+    check.expect(not jobs.fail(lost_id, new_token, 'late'), 'a failure for a done job was accepted')
+    check.expect(stored == ['0001'], f'expected job 0001 stored once, stored {stored}')
+    check.expect(not jobs.is_finished(), 'finished with leased jobs left')
+
+    jobs.complete(kept_id, kept_token, stored.append)
+
+    # the third job fails on every attempt and is given up
+    check.expect(jobs.fail(other_id, other_token, 'boom'), 'the first failure was refused')
+    (retry_id, retry_token, _), = jobs.lease('third', 1)
+    check.expect(retry_id == other_id, 'a failed job was not re-queued')
+    check.expect(jobs.fail(retry_id, retry_token, 'boom'), 'the second failure was refused')
+
+    waiter = threading.Thread(target=jobs.wait, kwargs={'poll': lease_seconds / 4}, daemon=True)
+    waiter.start()
+    waiter.join(lease_seconds * 10)
+    check.expect(not waiter.is_alive(), 'wait() did not return after every job was done or given up')
+    check.expect(jobs.status()['failed'] == 1 and jobs.status()['done'] == 2, f'unexpected final status {jobs.status()}')
+
+    return check.errors
+
+
+def check_expiry_over_http(lease_seconds) -> list:
+    check = Checker()
+    jobs = JobQueue(lease_seconds=lease_seconds)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        frame = Path(tmp) / 'snap_0001.png'
+        frame.write_bytes(b'png')
+        jobs.add(str(frame))
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(jobs, lambda payload: payload,
+                                                                     lambda payload, text: results.update({payload: text})))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            worker = Worker(f'http://127.0.0.1:{server.server_address[1]}', backend=None, retries=1)
+
+            def lease(name):
+                _, body = worker.call('/lease', {'worker': name, 'max': 1})
+                return json.loads(body)['jobs']
+
+            first, = lease('vanished')
+            check.expect(lease('rescuer') == [], 'a live lease was handed out again over HTTP')
+
+            time.sleep(lease_seconds * 1.5)
+            second = lease('rescuer')
+            check.expect(len(second) == 1 and second[0]['id'] == first['id'],
+                         f'expired lease not handed out again over HTTP: {second}')
+            if not second:
+                return check.errors
+
+            status, _ = worker.call(f"/frame/{first['id']}?lease={first['lease']}")
+            check.expect(status == 200, f'frame download on the old lease of an unfinished job: HTTP {status}')
+            status, _ = worker.call('/renew', {'id': first['id'], 'lease': first['lease']})
+            check.expect(status == 409, f'renewing the expired lease: HTTP {status}, expected 409')
+
+            status, _ = worker.call('/result', {'id': second[0]['id'], 'lease': second[0]['lease'], 'text': 'rescued'})
+            check.expect(status == 200, f'result on the new lease: HTTP {status}')
+            status, _ = worker.call('/result', {'id': first['id'], 'lease': first['lease'], 'text': 'late'})
+            check.expect(status == 409, f'late result on the expired lease: HTTP {status}, expected 409')
+
+            _, body = worker.call('/lease', {'worker': 'rescuer', 'max': 1})
+            check.expect(json.loads(body)['finished'], 'coordinator not finished after the last result')
+            check.expect(results == {str(frame): 'rescued'}, f'unexpected stored results {results}')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    return check.errors
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check lease expiry of the OCR job queue')
+    parser.add_argument('--lease-seconds',
+                        default=0.2,
+                        type=float,
+                        help='lease length used by the check; raise it on a slow or loaded machine')
+    args = parser.parse_args(sys.argv[1:])
+
+    failed = False
+    for name, check in (('lease expiry', check_expiry), ('lease expiry over HTTP', check_expiry_over_http)):
+        # the queue reports every expired lease
+        with contextlib.redirect_stdout(io.StringIO()):
+            errors = check(args.lease_seconds)
+        print(f'{name}: {"FAIL" if errors else "ok"}')
+        for error in errors:
+            print(f'  {error}')
+        failed = failed or bool(errors)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the DeepL /v2/translate endpoint, for benchmarking deepl.py offline.
+#
+# Every text is "translated" deterministically to `[<TARGET_LANG>] <text>`. Network latency and
+# rate limiting are simulated with --latency and --throttle-every (HTTP 429 with Retry-After: 0).
+
+# USAGE:
+# benchmarks/deepl_stub_server.py --port 8765 --latency 0.05
+# deepl.py zh:en movie.srt --endpoint http://127.0.0.1:8765/v2/translate --auth-key x --no-tm
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+class StubStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.texts = 0
+        self.characters = 0
+
+
+def make_handler(stats: StubStats, latency=0.0, throttle_every=0):
+
+    class DeeplStubHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            params = urllib.parse.parse_qs(body, keep_blank_values=True)
+            texts = params.get('text', [])
+
+            with stats.lock:
+                stats.requests += 1
+                throttled = throttle_every and stats.requests % throttle_every == 0
+                if throttled:
+                    stats.throttled += 1
+                else:
+                    stats.texts += len(texts)
+                    stats.characters += sum(len(text) for text in texts)
+
+            if latency:
+                time.sleep(latency)
+
+            if throttled:
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            target_lang = params.get('target_lang', ['EN'])[0]
+            payload = json.dumps({'translations': [{'detected_source_language': params.get('source_lang', [''])[0],
+                                                    'text': f'[{target_lang}] {text}'}
+                                                   for text in texts]}).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return DeeplStubHandler
+
+
+def start_server(port=0, latency=0.0, throttle_every=0):
+    """Serve in a background thread; returns (server, endpoint URL, stats)."""
+    stats = StubStats()
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(stats, latency, throttle_every))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v2/translate', stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local DeepL API stand-in')
+    parser.add_argument('--port', '-p',
+                        default=8765,
+                        type=int)
+    parser.add_argument('--latency',
+                        default=0.0,
+                        type=float,
+                        help='simulated seconds per request')
+    parser.add_argument('--throttle-every',
+                        default=0,
+                        type=int,
+                        help='answer every Nth request with HTTP 429 (0 = never)')
+    args = parser.parse_args(sys.argv[1:])
+
+    server, endpoint, stats = start_server(args.port, args.latency, args.throttle_every)
+    print(f'DeepL stand-in listening on {endpoint}')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f'{stats.requests} requests ({stats.throttled} throttled), {stats.texts} texts, '
+              f'{stats.characters} characters')
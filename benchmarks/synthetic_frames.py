@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Synthetic cropped subtitle frames with known ground truth.
+#
+# A random script of cues (text, duration, gap) is rendered as gray subtitle strips: every
+# character is drawn as a fixed pseudo-glyph derived from its code point, on a noisy dark
+# background. PNG snapshots carry the text they show in a `subtitle` text chunk, which the
+# `stub` OCR backend returns verbatim; --ocr-error-rate corrupts that text on some frames to
+# mimic OCR misreads. The same frames can be encoded into a video with ffmpeg instead.
+
+# USAGE:
+# benchmarks/synthetic_frames.py /tmp/synthetic --cues 200 --noise 4
+# benchmarks/synthetic_frames.py /tmp/synthetic --video --fps 5
+
+import argparse
+import random
+import subprocess
+import sys
+import zlib
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import srt
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+LINES = ['你好', '嗯', '谢谢你', '我们走吧', '你在干什么？', '这是我的朋友', '重庆的火锅很好吃',
+         '他长大了以后想当医生', '没关系，我们明天再说', '快点！', '我不知道', '银行在哪里？',
+         '今天天气真好', '你吃饭了吗', '我马上就来', '别担心，一切都会好的']
+
+GLYPH_CELLS = 8
+
+
+def make_script(cues=100, seed=42, min_duration=1.0, max_duration=5.0, max_gap=2.0):
+    """[(start seconds, end seconds, text)] with no two consecutive cues showing the same text."""
+    rnd = random.Random(seed)
+    script = []
+    t = rnd.uniform(0, max_gap)
+
+    for _ in range(cues):
+        text = rnd.choice(LINES)
+        while script and text == script[-1][2]:
+            text = rnd.choice(LINES)
+
+        duration = rnd.uniform(min_duration, max_duration)
+        script.append((t, t + duration, text))
+        t += duration + rnd.choice((0.0, rnd.uniform(0, max_gap)))
+
+    return script
+
+
+def text_at(script, t):
+    for start, end, text in script:
+        if start <= t < end:
+            return text
+        if start > t:
+            break
+    return ''
+
+
+def glyph(char: str, size: int):
+    # the same character always gets the same pattern, different characters (almost always) differ
+    cells = np.random.default_rng(zlib.crc32(char.encode('utf-8'))).random((GLYPH_CELLS, GLYPH_CELLS)) < 0.45
+    return np.kron(cells, np.ones((size // GLYPH_CELLS, size // GLYPH_CELLS), dtype=bool))
+
+
+def render(text: str, width=960, height=80, noise=4.0, rng=None):
+    rng = rng or np.random.default_rng()
+    frame = np.full((height, width), 24.0)
+
+    size = (int(height * 0.6) // GLYPH_CELLS) * GLYPH_CELLS
+    advance = size + size // 4
+    x = max(0, (width - advance * len(text)) // 2)
+    y = (height - size) // 2
+
+    for char in text:
+        if x + size > width:
+            break
+        frame[y:y + size, x:x + size][glyph(char, size)] = 230.0
+        x += advance
+
+    if noise:
+        frame += rng.normal(0, noise, frame.shape)
+
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def misread(text: str, rnd: random.Random) -> str:
+    # one substituted character, like a typical OCR misread
+    if not text:
+        return text
+    i = rnd.randrange(len(text))
+    return text[:i] + rnd.choice(rnd.choice(LINES)) + text[i + 1:]
+
+
+def frame_count(script, fps):
+    return int((script[-1][1] + 1.0) * fps)
+
+
+def iter_frames(script, fps=1.0, width=960, height=80, noise=4.0, ocr_error_rate=0.0, seed=42):
+    """Yield (frame number, true text, text the stub OCR will read, gray pixels) at ffmpeg -start_number 1 timings."""
+    rnd = random.Random(seed)
+    rng = np.random.default_rng(seed)
+
+    for n in range(1, frame_count(script, fps) + 1):
+        text = text_at(script, (n - 1) / fps)
+        read = misread(text, rnd) if text and rnd.random() < ocr_error_rate else text
+        yield n, text, read, render(text, width, height, noise, rng)
+
+
+def write_frames(script, folder: Path, fps=1.0, **kwargs) -> int:
+    folder.mkdir(parents=True, exist_ok=True)
+    count = 0
+
+    for n, _, read, pixels in iter_frames(script, fps, **kwargs):
+        info = PngInfo()
+        info.add_text('subtitle', read)
+        Image.fromarray(pixels).save(folder / f'snap_{n:04d}.png', pnginfo=info, compress_level=1)
+        count += 1
+
+    return count
+
+
+def write_video(script, video: Path, fps=1.0, width=960, height=80, **kwargs) -> int:
+    ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'gray',
+                               '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', str(video)],
+                              stdin=subprocess.PIPE)
+    count = 0
+
+    with ffmpeg.stdin:
+        for _, _, _, pixels in iter_frames(script, fps, width, height, **kwargs):
+            ffmpeg.stdin.write(pixels.tobytes())
+            count += 1
+
+    if ffmpeg.wait():
+        raise RuntimeError(f'ffmpeg failed with exit code {ffmpeg.returncode}')
+
+    return count
+
+
+def write_ground_truth(script, srt_file: Path):
+    subs = [srt.Subtitle(i, timedelta(seconds=start), timedelta(seconds=end), text)
+            for i, (start, end, text) in enumerate(script, 1)]
+    srt_file.write_text(srt.compose(subs), encoding='utf-8')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render synthetic subtitle frames with known ground truth')
+    parser.add_argument('output_dir',
+                        help='folder for snap_NNNN.png (or video.mp4) and ground_truth.srt')
+    parser.add_argument('--cues', '-n',
+                        default=100,
+                        type=int)
+    parser.add_argument('--fps',
+                        default=1.0,
+                        type=float,
+                        help='snapshot rate, as ffmpeg -vf fps=N')
+    parser.add_argument('--min-duration',
+                        default=1.0,
+                        type=float)
+    parser.add_argument('--max-duration',
+                        default=5.0,
+                        type=float)
+    parser.add_argument('--max-gap',
+                        default=2.0,
+                        type=float,
+                        help='cues are either back to back or separated by a random gap up to this many seconds')
+    parser.add_argument('--width',
+                        default=960,
+                        type=int)
+    parser.add_argument('--height',
+                        default=80,
+                        type=int)
+    parser.add_argument('--noise',
+                        default=4.0,
+                        type=float,
+                        help='standard deviation of the gaussian pixel noise')
+    parser.add_argument('--ocr-error-rate',
+                        default=0.0,
+                        type=float,
+                        help='fraction of frames whose embedded text has one misread character')
+    parser.add_argument('--video',
+                        action='store_true',
+                        default=False,
+                        help='encode the frames into video.mp4 with ffmpeg instead of writing PNGs')
+    parser.add_argument('--seed',
+                        default=42,
+                        type=int)
+    args = parser.parse_args(sys.argv[1:])
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    script = make_script(args.cues, args.seed, args.min_duration, args.max_duration, args.max_gap)
+    options = dict(width=args.width, height=args.height, noise=args.noise, ocr_error_rate=args.ocr_error_rate,
+                   seed=args.seed)
+
+    if args.video:
+        frames = write_video(script, output_dir / 'video.mp4', args.fps, **options)
+    else:
+        frames = write_frames(script, output_dir, args.fps, **options)
+
+    write_ground_truth(script, output_dir / 'ground_truth.srt')
+    print(f'{len(script)} cues, {frames} frames in {output_dir}')
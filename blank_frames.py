@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Tell blank subtitle frames from text-bearing ones without OCR.
+#
+# Two vectorized features of the cropped frame (every other row is enough):
+#   glyph ratio   fraction of pixels in the subtitle color (bright for light text)
+#   edge density  fraction of strong horizontal gradients (the outlined strokes of glyphs)
+# A frame is blank when either feature stays below its minimum: bright sky or a blown-out scene
+# has glyph-colored pixels but few sharp edges, a busy dark scene has edges but no glyph color.
+# --sensitivity divides both minimums: higher values call fewer frames blank.
+
+# DEPENDENCIES:
+# pip install -U numpy pillow
+
+# USAGE (calibrate against an earlier OCR run of the same video):
+# blank_frames.py video_img --results video_results.json --sensitivity 1.0
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+GLYPH_LEVEL = 200
+EDGE_THRESHOLD = 48
+
+MIN_GLYPH_RATIO = 0.001
+MIN_EDGE_DENSITY = 0.002
+
+ROW_STEP = 2
+
+
+class BlankDetector:
+
+    def __init__(self, sensitivity=1.0, text_color='light', glyph_level=GLYPH_LEVEL, edge_threshold=EDGE_THRESHOLD):
+        self.min_glyph_ratio = MIN_GLYPH_RATIO / sensitivity
+        self.min_edge_density = MIN_EDGE_DENSITY / sensitivity
+        self.text_color = text_color
+        self.glyph_level = glyph_level
+        self.edge_threshold = edge_threshold
+
+    def features(self, gray: np.ndarray):
+        """(glyph ratio, edge density) of a gray frame."""
+        rows = gray[::ROW_STEP]
+
+        if self.text_color == 'dark':
+            glyph = rows <= 255 - self.glyph_level
+        else:
+            glyph = rows >= self.glyph_level
+        edges = np.abs(np.diff(rows.astype(np.int16), axis=1)) > self.edge_threshold
+
+        return float(glyph.mean()), float(edges.mean())
+
+    def classify(self, glyph_ratio, edge_density) -> bool:
+        return glyph_ratio < self.min_glyph_ratio or edge_density < self.min_edge_density
+
+    def is_blank(self, gray: np.ndarray) -> bool:
+        return self.classify(*self.features(gray))
+
+
+if __name__ == '__main__':
+
+    from frame_signature import load_gray
+
+    parser = argparse.ArgumentParser(description='Classify subtitle snapshots as blank or text-bearing, and check '
+                                                 'the classification against earlier OCR results')
+    parser.add_argument('folder',
+                        help='folder with snap_NNNN.png images')
+    parser.add_argument('--results', '-r',
+                        default=None,
+                        help='OCR results JSON of the same snapshots: report blank frames that have text '
+                             '(false negatives) and text-bearing frames without')
+    parser.add_argument('--sensitivity', '-s',
+                        default=1.0,
+                        type=float,
+                        help='higher = fewer frames classified blank')
+    parser.add_argument('--text-color',
+                        default='light',
+                        choices=('light', 'dark'))
+    parser.add_argument('--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        help='print the features of every frame')
+    args = parser.parse_args(sys.argv[1:])
+
+    detector = BlankDetector(args.sensitivity, args.text_color)
+    results = json.loads(Path(args.results).read_text(encoding='utf-8')) if args.results else {}
+
+    images = sorted(Path(args.folder).glob('*.png'))
+    blank = 0
+    false_negatives = []
+    false_positives = 0
+
+    for image in images:
+        glyph_ratio, edge_density = detector.features(load_gray(image))
+        is_blank = detector.classify(glyph_ratio, edge_density)
+        blank += is_blank
+
+        if args.verbose:
+            print(f'{image.name} glyph={glyph_ratio:.5f} edges={edge_density:.5f} {"blank" if is_blank else "text"}')
+
+        text = results.get(image.stem.replace('snap_', ''))
+        if text is None:
+            continue
+        if is_blank and text.strip():
+            false_negatives.append(image.name)
+            print(f'FALSE NEGATIVE {image.name} glyph={glyph_ratio:.5f} edges={edge_density:.5f}: {text.strip()}')
+        elif not is_blank and not text.strip():
+            false_positives += 1
+
+    print(f'{blank} of {len(images)} frames blank (would skip OCR)')
+    if results:
+        print(f'{len(false_negatives)} false negatives (blank, but OCR found text), '
+              f'{false_positives} false positives (OCR\'ed, but no text)')
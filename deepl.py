@@ -4,20 +4,46 @@
 # ALSO SEE: https://www.deepl.com/docs-api/translate-text/translate-text/
 
 import argparse
+import email.utils
+import os
+import random
 import re
 import string
+import threading
+import time
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
+from urllib.parse import quote_plus
 
 import requests
+import srt
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+from instrumentation import metrics
+from translation_memory import DEFAULT_TM_FILE
+from translation_memory import TranslationMemory
 
 PATTERN_ENGLISH = re.compile('([a-zA-Z]+)')
 PATTERN_PUNCTUATION = re.compile('([_ {re.escape(string.punctuation)}]+)')
 NOTR_START = '<notr>'
 NOTR_END = '</notr>'
 
+DEFAULT_ENDPOINT = 'https://api-free.deepl.com/v2/translate'
+################################# TODO: USE A VALID API KEY (or set DEEPL_AUTH_KEY) ##################
+################################# SEE: https://www.deepl.com/docs-api/api-access
+DEFAULT_AUTH_KEY = '55555555-5555-5555-5555-555555555555:fx'
+
+# DeepL rejects requests over 128 KiB or with more than 50 texts
+MAX_REQUEST_BYTES = 120 * 1024
+MAX_TEXTS_PER_REQUEST = 50
+
+# 429 Too Many Requests, 503 Service Unavailable (plus other transient 5xx) are retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
 def mark_untranslatable_lines(lines: List, source_lang: str, target_lang: str):
     marked_lines = []
     for line in lines:
@@ -37,6 +63,10 @@ def mark_untranslatable_lines(lines: List, source_lang: str, target_lang: str):
 def generate_chunks(_lines, chunk_size=20, src_lang=None, trg_lang=None):
     lines = mark_untranslatable_lines(_lines, src_lang, trg_lang)
 
+    yield from chunked(lines, chunk_size)
+
+
+def chunked(lines, chunk_size=20):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lines), chunk_size):
         yield lines[i:i + chunk_size]
@@ -46,72 +76,302 @@ def has_text(s: str):
     return any(c.isalpha() for c in s)
 
 
-def do_translate(args):
+class TokenBucket:
+    """Allow `rate` requests per second on average, with bursts of up to `burst` requests."""
 
-    input_file = Path(args.input_file)
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    source_language: str
-    target_language: str
-    source_language, target_language = args.lang_pair.split(':')
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
 
-    input_text = input_file.read_text(encoding='utf-8')
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class TranslationError(Exception):
+    pass
+
+
+def retry_after_seconds(response: requests.Response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+
+    # HTTP-date form
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class DeeplClient:
+    """Thread pool over one pooled HTTP session; chunks come back in their original order."""
 
-    chunks = list(generate_chunks(input_text.split('\n'), chunk_size=args.chunk_size, src_lang=target_language))
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, auth_key=DEFAULT_AUTH_KEY, concurrency=4, rate=None,
+                 max_retries=5, backoff=1.0, timeout=60):
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst=concurrency) if rate else None
+        self.retries = 0
 
-    translated_chunks = []
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'DeepL-Auth-Key {auth_key}'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    for chunk in chunks:
+    def translate(self, texts: List[str], params: dict) -> List[str]:
+        payload = dict(params, text=texts)
 
-        payload = {
-            'text': chunk,
-            'target_lang': target_language.upper(),
-            'tag_handling': 'xml',
-            'ignore_tags': 'notr',
-            'outline_detection': '0',
-            'split_sentences': 'nonewlines',
-        }
+        for attempt in range(self.max_retries + 1):
+            if self.bucket:
+                with metrics.timer('rate_limit_wait_seconds'):
+                    self.bucket.acquire()
 
-        if source_language:
-            payload['source_lang'] = source_language.upper()
+            try:
+                with metrics.timer('http_request_seconds'):
+                    response = self.session.post(self.endpoint, data=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                metrics.inc('http_responses', status='error')
+                response, error = None, str(e)
+            else:
+                metrics.inc('http_responses', status=response.status_code)
+                if response.status_code == requests.codes.ok:
+                    try:
+                        return [translation.get('text') for translation in response.json()['translations']]
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        # a 200 from a proxy or captive portal, or an API change: fail the chunk, not the run
+                        raise TranslationError(f'unexpected response ({e!r}): {response.text[:200]}')
+                error = f'HTTP STATUS: {response.status_code}\nRESPONSE: {response.text}'
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise TranslationError(error)
+
+            if attempt == self.max_retries:
+                raise TranslationError(error)
+
+            delay = retry_after_seconds(response) if response is not None else None
+            if delay is None:
+                # exponential backoff with jitter
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+            self.retries += 1
+            metrics.inc('http_retries')
+            reason = (error.splitlines() or ['no error message'])[0]
+            print(f'WARNING: retrying chunk in {delay:.1f}s ({reason})')
+            time.sleep(delay)
+
+    def translate_chunks(self, chunks: List[List[str]], params: dict) -> list:
+        """Translate all chunks concurrently; failed chunks are returned as TranslationError instances."""
+
+        def work(chunk):
+            try:
+                return self.translate(chunk, params)
+            except TranslationError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # map() yields results in submission order, which keeps the chunks in place
+            return list(executor.map(work, chunks))
+
+    def close(self):
+        self.session.close()
+
+
+def pack_by_size(texts, max_bytes=MAX_REQUEST_BYTES, max_texts=MAX_TEXTS_PER_REQUEST):
+    """Yield batches of texts whose url-encoded request body stays within max_bytes."""
+    batch, size = [], 0
 
-        if args.formality != 'default':
-            if args.formality in ('more', 'less', 'prefer_more', 'prefer_less'):
-                payload['formality'] = args.formality
+    for text in texts:
+        text_size = len('&text=') + len(quote_plus(text))
+
+        if batch and (size + text_size > max_bytes or len(batch) >= max_texts):
+            yield batch
+            batch, size = [], 0
+
+        batch.append(text)
+        size += text_size
+
+    if batch:
+        yield batch
+
+
+def strip_notr(text: str) -> str:
+    return text.replace(NOTR_START, '').replace(NOTR_END, '')
+
+
+def translate_units(units, make_batches, client, params, tm=None):
+    """Translate every distinct unit once, reusing the translation memory; returns {unit: translation}."""
+    # blank units need no translation at all
+    translations = {'': ''}
+    misses = []
+
+    with metrics.stage('tm_lookup'):
+        for unit in dict.fromkeys(units):
+            if unit in translations:
+                continue
+            known = tm.get(unit) if tm and not unit.startswith(NOTR_START) else None
+            if known is not None:
+                translations[unit] = known
             else:
-                print(f'WARNING: invalid formality value {args.formality}!')
-
-        # print(f'Sending {len(chunk)} characters for translation...')
-        response = requests.post('https://api-free.deepl.com/v2/translate',
-                                 headers={
-                                     ################################# TODO: USE A VALID API KEY ##################
-                                     ################################# SEE: https://www.deepl.com/docs-api/api-access
-                                     'Authorization': 'DeepL-Auth-Key 55555555-5555-5555-5555-555555555555:fx'
-                                 },
-                                 data=payload)
-
-        if response.status_code is not requests.codes.ok:
+                misses.append(unit)
+
+    batches = list(make_batches(misses))
+    with metrics.stage('translate'):
+        results = client.translate_chunks(batches, params)
+    failed_batches = 0
+
+    for batch, result in zip(batches, results):
+        if not isinstance(result, TranslationError) and len(result) != len(batch):
+            # zip() would silently pair the wrong lines, or drop the last ones
+            result = TranslationError(f'DeepL returned {len(result)} translations for {len(batch)} texts '
+                                      f'(first text: {batch[0][:80]!r})')
+
+        if isinstance(result, TranslationError):
+            # keep the source text so that everything else that was translated is not lost
+            failed_batches += 1
             print(f'''ERROR
-HTTP STATUS: {response.status_code}
-RESPONSE: {response.text}
+{result}
 ''')
-            raise Exception(f'Bad server response while processing {input_file.absolute()}')
+            translations.update(zip(batch, batch))
+            continue
 
-        data = response.json()
-
-        for translated_chunk in data['translations']:
-            translated = translated_chunk.get('text')
+        for translated in result:
             print(translated)
-            translated_chunks.append(translated)
+
+        translations.update(zip(batch, result))
+
+        if tm:
+            # <notr> lines (indices, timings) are unique per file and not worth remembering
+            tm.put_many([(unit, translated) for unit, translated in zip(batch, result) if not unit.startswith(NOTR_START)])
+
+    sent_chars = sum(len(unit) for unit in misses)
+    total_chars = sum(len(unit) for unit in units)
+    print(f'Sent {len(misses)} of {len(units)} texts in {len(batches)} requests; '
+          f'{total_chars - sent_chars} of {total_chars} characters saved by dedup and translation memory')
+
+    return translations, failed_batches, len(batches), sent_chars
+
+
+def srt_units(input_text: str, source_language, target_language):
+    """Parse the SRT and return its cues plus one translation unit per cue ('' = nothing to translate)."""
+    subs = list(srt.parse(input_text))
+    units = []
+
+    for sub in subs:
+        lines = mark_untranslatable_lines(sub.content.split('\n'), source_language, target_language)
+
+        if all(not line or line.startswith(NOTR_START) for line in lines):
+            # indices, timings and untranslatable cues never leave the machine
+            units.append('')
+        else:
+            units.append('\n'.join(lines))
+
+    return subs, units
+
+
+def do_translate(args):
+
+    input_file = Path(args.input_file)
+
+    source_language: str
+    target_language: str
+    source_language, target_language = args.lang_pair.split(':')
+
+    input_text = input_file.read_text(encoding='utf-8')
+
+    params = {
+        'target_lang': target_language.upper(),
+        'tag_handling': 'xml',
+        'ignore_tags': 'notr',
+        'outline_detection': '0',
+        'split_sentences': 'nonewlines',
+    }
+
+    if source_language:
+        params['source_lang'] = source_language.upper()
+
+    if args.formality != 'default':
+        if args.formality in ('more', 'less', 'prefer_more', 'prefer_less'):
+            params['formality'] = args.formality
+        else:
+            print(f'WARNING: invalid formality value {args.formality}!')
+
+    tm = None
+    if not args.no_tm:
+        tm = TranslationMemory(args.tm_file or DEFAULT_TM_FILE,
+                               source_lang=source_language,
+                               target_lang=target_language,
+                               formality=params.get('formality', 'default'))
+
+    client = DeeplClient(endpoint=args.endpoint,
+                         auth_key=args.auth_key,
+                         concurrency=args.concurrency,
+                         rate=args.rate,
+                         max_retries=args.max_retries,
+                         backoff=args.backoff)
+
+    started = time.perf_counter()
+    try:
+        if args.srt:
+            # only cue text is sent, packed up to the request size limit; timings come from the original
+            subs, units = srt_units(input_text, source_language, target_language)
+            make_batches = lambda texts: pack_by_size(texts, args.max_request_bytes)  # noqa: E731
+            translations, failed, requests_sent, sent_chars = translate_units(units, make_batches, client, params, tm)
+            for sub, unit in zip(subs, units):
+                if unit:
+                    sub.content = strip_notr(translations[unit])
+
+            output_text = srt.compose(subs, reindex=False)
+        else:
+            lines = mark_untranslatable_lines(input_text.split('\n'), source_language, target_language)
+            make_batches = lambda texts: chunked(texts, chunk_size=args.chunk_size)  # noqa: E731
+            translations, failed, requests_sent, sent_chars = translate_units(lines, make_batches, client, params, tm)
+
+            output_text = strip_notr('\n'.join(translations[line] for line in lines))
+    finally:
+        client.close()
+        if tm:
+            tm.close()
 
     if args.output_file:
         out = Path(args.output_file)
     else:
         out = input_file.with_suffix(f'.{target_language}{input_file.suffix}')
 
-    chunks_reassembled = '\n'.join(translated_chunks)
-    chunks_reassembled = chunks_reassembled.replace(NOTR_START, '').replace(NOTR_END, '')
-    out.write_text(chunks_reassembled)
+    out.write_text(output_text)
     print(f'Wrote file {out.absolute()}')
+    print(f'{requests_sent} requests in {time.perf_counter() - started:.1f}s '
+          f'(concurrency {args.concurrency}, {client.retries} retries); '
+          f'sent {sent_chars} of {len(input_text)} input characters')
+
+    if tm:
+        lookups = tm.hits + tm.misses
+        print(f'Translation memory: {tm.hits} hits, {tm.misses} misses '
+              f'({100.0 * tm.hits / lookups if lookups else 0.0:.1f}% hit rate) in {tm.path}')
+
+    if failed:
+        raise Exception(f'{failed} of {requests_sent} requests could not be translated while processing '
+                        f'{input_file.absolute()}; their source text was kept in {out.absolute()}')
 
 
 if __name__ == '__main__':
@@ -163,6 +423,17 @@ API: https://www.deepl.com/docs-api/translate-text/
                         action='store',
                         help='lines in a batch for large files')
 
+    parser.add_argument('--srt',
+                        action='store_true',
+                        default=False,
+                        help='parse the input as SRT and send only cue text, packed by request size instead of '
+                             '--chunk-size; the output keeps the original indices and timings')
+
+    parser.add_argument('--max-request-bytes',
+                        default=MAX_REQUEST_BYTES,
+                        type=int,
+                        help='--srt only: max url-encoded size of the texts in one request')
+
     parser.add_argument('--preserve-formatting',
                         default="0",
                         help='Sets whether the translation engine should respect the original formatting, even if it would usually correct some aspects. Possible values are: 0 (default), 1',
@@ -184,6 +455,47 @@ API: https://www.deepl.com/docs-api/translate-text/
                         metavar='filename',
                         help='Output filename')
 
+    parser.add_argument('--endpoint',
+                        default=DEFAULT_ENDPOINT,
+                        help='translate API URL, e.g. https://api.deepl.com/v2/translate for the paid API '
+                             'or a local stub server for testing')
+
+    parser.add_argument('--auth-key',
+                        default=os.environ.get('DEEPL_AUTH_KEY', DEFAULT_AUTH_KEY),
+                        help='DeepL API key (default: $DEEPL_AUTH_KEY)')
+
+    parser.add_argument('--concurrency', '-c',
+                        default=4,
+                        type=int,
+                        help='chunks translated in parallel over one pooled connection')
+
+    parser.add_argument('--rate',
+                        default=None,
+                        type=float,
+                        help='max requests per second (token bucket); default: unlimited')
+
+    parser.add_argument('--max-retries',
+                        default=5,
+                        type=int,
+                        help='retries per chunk on 429/5xx responses and connection errors')
+
+    parser.add_argument('--tm-file',
+                        default=None,
+                        help=f'SQLite translation memory (default: {DEFAULT_TM_FILE})')
+
+    parser.add_argument('--no-tm',
+                        action='store_true',
+                        default=False,
+                        help='do not look up or store translations in the translation memory')
+
+    parser.add_argument('--backoff',
+                        default=1.0,
+                        type=float,
+                        help='base delay in seconds of the exponential backoff (unless the server sends Retry-After)')
+
+    instrumentation.add_arguments(parser)
+
     args = parser.parse_args(sys.argv[1:])
 
-    do_translate(args)
+    with instrumentation.session(args):
+        do_translate(args)
@@ -10,8 +10,16 @@
 read -p "Generate cropped video $1_video-cropped.mp4? (Y/N).." answer
 case ${answer:0:1} in
     y|Y )
-        ################### TODO: adjust crop area for input video #########################
-        ffmpeg -i "$1" -filter:v "crop=1738:115:100:965" -c:a copy "$1_video-cropped.mp4"
+        # subtitle band detected by autocrop.py; override with `CROP=1738:115:100:965 ./do-all.sh video.mp4`
+        if [ -z "$CROP" ]; then
+            # stop here rather than run ffmpeg with an empty crop=
+            CROP=$(python3 autocrop.py "$1" --fallback 1738:115:100:965) || {
+                echo "ERROR: autocrop.py failed; pass the crop area with CROP=W:H:X:Y ./do-all.sh $1"
+                exit 1
+            }
+        fi
+        echo "Crop area: $CROP"
+        ffmpeg -i "$1" -filter:v "crop=$CROP" -c:a copy "$1_video-cropped.mp4"
     ;;
     * )
         echo Skipping...
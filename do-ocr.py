@@ -1,65 +1,577 @@
 #!/usr/bin/env python3
 
-from pathlib import Path
-import subprocess
+import argparse
 import json
+from pathlib import Path
+import random
 import sys
+import tempfile
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
+import instrumentation
+from instrumentation import metrics
+from ocr_backends import BACKENDS
+from ocr_backends import DEFAULT_OCR_BINARY
+from ocr_backends import OcrError
+from ocr_backends import OcrTimeout
+from ocr_backends import create_backend
+from ocr_cache import DEFAULT_CACHE_FILE
+from ocr_cache import OcrCache
+from ocr_cache import cache_key
+from ocr_journal import OcrJournal
+from ocr_scheduler import AdaptiveLimit
+from ocr_scheduler import RetryPolicy
+
 
 lock = threading.Lock()
 
 
-def ocr_file(image):
-    bucket_key = image.stem.replace("snap_", '')
+def frame_key(image: Path):
+    return image.stem.replace("snap_", '')
+
+
+def frame_sort_key(image: Path):
+    key = frame_key(image)
+    return int(key) if key.isdigit() else key
+
+
+def record(bucket_key, recognized_text):
+    with metrics.locked(lock, 'results'):
+        print(bucket_key, recognized_text)
+        ocr_dict[bucket_key] = recognized_text
+
+    # one appended line per frame instead of rewriting the whole results file
+    with metrics.timer('journal_append_seconds'):
+        journal.append(bucket_key, recognized_text)
+
+
+def prepare(gray):
+    # the pixels the OCR engine gets, and that the cache key is computed from
+    if not args.preprocess:
+        return gray
+
+    with metrics.timer('preprocess_seconds'):
+        return preprocess(gray, args.binarize_threshold, args.text_color, args.glyph_height)
+
+
+def recognize_pixels(pixels, image: Path):
+    if backend.needs_file:
+        # the backend can only read files: write a throwaway PNG just for this call
+        Image.fromarray(pixels).save(image)
+        try:
+            return backend.recognize_file(image)
+        finally:
+            image.unlink(missing_ok=True)
+
+    return backend.recognize_array(pixels)
+
+
+def ocr_cached(pixels, recognize):
+    # pixels: gray frame the cache key is computed from (None = no cache lookup)
+    key = None
+    if pixels is not None and (cache or args.preprocess):
+        key = cache_key(pixels, backend.cache_id())
+
+    if key and args.preprocess:
+        # normalized buffers of the same subtitle are identical: OCR each of them once per run
+        with lock:
+            recognized_text = known_texts.get(key)
+        if recognized_text is not None:
+            metrics.inc('ocr_cache_lookups', result='run')
+            return recognized_text
+
+    if key and cache:
+        recognized_text = cache.get(key)
+        metrics.inc('ocr_cache_lookups', result='miss' if recognized_text is None else 'hit')
+        if recognized_text is not None:
+            return recognized_text
+
+    def attempt():
+        # the concurrency limit covers only the OCR call itself
+        with limiter.slot():
+            return recognize()
+
+    def failed(e, attempt_number):
+        metrics.inc('ocr_timeouts' if isinstance(e, OcrTimeout) else 'ocr_errors', backend=backend.name)
+        print("😱", e, f'(attempt {attempt_number + 1} of {args.retries + 1})')
+
+    # raises OcrError once every attempt failed
+    started = time.perf_counter()
+    recognized_text = retry.call(attempt, on_error=failed)
+    ocr_seconds.append(time.perf_counter() - started)
+    metrics.observe('ocr_frame_seconds', ocr_seconds[-1], backend=backend.name)
+
+    if key and args.preprocess:
+        with lock:
+            known_texts[key] = recognized_text
+
+    if key and cache:
+        cache.put(key, recognized_text)
+
+    return recognized_text
 
+
+def ocr_frame(gray, pixels, recognize, name):
+    # gray: the frame as cropped, for the blank check; pixels: what the cache key is computed from
+    audited = False
+    if blank_detector and blank_detector.is_blank(gray):
+        with lock:
+            stats['blank_frames'] += 1
+        if not (args.blank_audit and random.random() < args.blank_audit):
+            return ''
+        # audit: OCR some of the frames called blank anyway, to catch subtitles the filter misses
+        audited = True
+
+    recognized_text = ocr_cached(pixels, recognize)
+
+    if audited:
+        with lock:
+            stats['blank_audited'] += 1
+            if recognized_text.strip():
+                blank_misses.append(name)
+        if recognized_text.strip():
+            metrics.inc('blank_false_negatives')
+            print(f'WARN: {name} classified blank, but OCR found text: {recognized_text.strip()}')
+
+    return recognized_text
+
+
+def ocr_file(image: Path):
+    gray = load_gray(image) if cache or args.preprocess or blank_detector else None
+
+    if not args.preprocess:
+        return ocr_frame(gray, gray, lambda: backend.recognize_file(image), image.name)
+
+    pixels = prepare(gray)
+    return ocr_frame(gray, pixels, lambda: recognize_pixels(pixels, scratch_dir / image.name), image.name)
+
+
+def ocr_group(group):
     try:
-        lock.acquire()
-        # check if the file name is already in the dictionary, and skip it if so
-        if bucket_key in ocr_dict:
-            lock.release()
+        ocr_group_frames(group)
+    finally:
+        metrics.gauge_add('ocr_queue_depth', -1)
+
+
+def representative(group):
+    return frame_signature.representative(group) if frame_signature else group[0]
+
+
+def known_group_text(group):
+    # (done, text): the frames of the group already in the dictionary, and their text if any
+    with metrics.locked(lock, 'results'):
+        done = [frame_key(img) for img in group if frame_key(img) in ocr_dict]
+        return done, ocr_dict[done[0]] if done else None
+
+
+def record_group(group, recognized_text, done=()):
+    for img in group:
+        if frame_key(img) not in done:
+            record(frame_key(img), recognized_text)
+
+
+def mark_failed(keys, error):
+    # kept out of the results, listed for a targeted rerun with --only-failed
+    with lock:
+        for key in keys:
+            failed_frames[key] = str(error)
+    metrics.inc('ocr_failed_frames', len(keys))
+
+
+def ocr_group_frames(group):
+    # OCR one representative frame and fan the text out to every frame of the group
+    # check if the frames are already in the dictionary, and skip them if so
+    done, known_text = known_group_text(group)
+    if len(done) == len(group):
+        return
+
+    if known_text is None:
+        try:
+            known_text = ocr_file(representative(group))
+        except OcrError as e:
+            mark_failed([frame_key(img) for img in group if frame_key(img) not in done], e)
             return
 
-        lock.release()
+    record_group(group, known_text, done)
 
-        # run the ocr command on the file, and capture the output from stdout
-        # !! mac m1/m2 only: use the version from https://github.com/glowinthedark/macOCR/releases or the OCR binary in this repo
-        proc = subprocess.run(["/usr/local/bin/OCR", "zh", "false", "false", image.absolute()],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
 
-        recognized_text = proc.stdout.decode()
-        err = proc.stderr.decode()
+def queue_group(jobs, group):
+    # --serve: remote workers OCR the representative frame, record_group() stores their result
+    done, known_text = known_group_text(group)
+    if len(done) == len(group):
+        return
 
-        if err:
-            print("😱", err)
-        else:
-            lock.acquire()
-            
-            print(bucket_key, recognized_text)
-            ocr_dict[bucket_key] = recognized_text
-            
-            with open(results_file, "w") as f:
-                json.dump(ocr_dict, f, ensure_ascii=False, indent=1)
+    if known_text is None:
+        jobs.add(group)
+    else:
+        record_group(group, known_text, done)
+
+
+def ocr_buffer(stream, frame, keys):
+    try:
+        pixels = prepare(frame)
+        recognized_text = ocr_frame(frame, pixels,
+                                    lambda: recognize_pixels(pixels, scratch_dir / f'snap_{keys[0]}.png'), keys[0])
+    except OcrError as e:
+        mark_failed(keys, e)
+        recognized_text = None
     finally:
-        lock.release()
+        stream.release(frame)
+        metrics.gauge_add('ocr_queue_depth', -1)
+
+    if recognized_text is not None:
+        for key in keys:
+            record(key, recognized_text)
+
+
+def ocr_folder(executor, folder):
+    images = sorted(Path(folder).glob("*.png"), key=frame_sort_key)
+    if only_failed is not None:
+        images = [img for img in images if frame_key(img) in only_failed]
+
+    if frame_signature:
+        with metrics.stage('signatures'):
+            signatures = dict(zip(images, executor.map(lambda img: frame_signature.signature(frame_signature.load_gray(img)), images)))
+            groups = frame_signature.group_similar(images, signatures.get, args.dedup_threshold)
+    else:
+        groups = [[img] for img in images]
+
+    stats['frames'] = len(images)
+    stats['groups'] = len(groups)
+    stats['pending_frames'] = sum(1 for img in images if frame_key(img) not in ocr_dict)
+    stats['ocr_calls'] = sum(1 for group in groups if any(frame_key(img) not in ocr_dict for img in group))
+
+    if args.serve:
+        from ocr_queue import JobQueue, run_coordinator
+
+        jobs = JobQueue(lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+        for group in groups:
+            queue_group(jobs, group)
+        run_coordinator(jobs, args.serve, representative, record_group)
+        for job_id, error in jobs.failed.items():
+            mark_failed([frame_key(img) for img in jobs.payloads[job_id] if frame_key(img) not in ocr_dict], error)
+        return
+
+    for group in groups:
+        metrics.gauge_add('ocr_queue_depth', 1)
+        executor.submit(ocr_group, group)
+
+
+def ocr_stream(executor, video):
+    # the number of frame buffers bounds how many frames can be queued or in flight
+    stream = FrameStream(video, fps=args.fps, buffers=args.queue_size)
+
+    def flush(keys, frame):
+        stats['groups'] += 1
+        pending = [key for key in keys if key not in ocr_dict]
+        stats['pending_frames'] += len(pending)
+
+        if len(pending) < len(keys):
+            # resumed in the middle of a group: reuse the text that is already known
+            known_text = ocr_dict[next(key for key in keys if key in ocr_dict)]
+            for key in pending:
+                record(key, known_text)
+            stream.release(frame)
+            return
+
+        stats['ocr_calls'] += 1
+        metrics.gauge_add('ocr_queue_depth', 1)
+        executor.submit(ocr_buffer, stream, frame, pending)
+
+    group_keys, group_frame, anchor = [], None, None
+
+    for key, frame in stream:
+        stats['frames'] += 1
+        sig = frame_signature.signature(frame) if frame_signature else None
+
+        if anchor is not None and frame_signature.distance(anchor, sig) <= args.dedup_threshold:
+            group_keys.append(key)
+            stream.release(frame)
+            continue
+
+        if group_keys:
+            flush(group_keys, group_frame)
+
+        # the first frame of every group is kept as the group's representative
+        group_keys, group_frame, anchor = [key], frame, sig
+
+    if group_keys:
+        flush(group_keys, group_frame)
 
 
 if __name__ == '__main__':
 
-    folder_name = sys.argv[1]
-    results_file = sys.argv[2]
+    parser = argparse.ArgumentParser(description='OCR a folder of PNG snapshots, or a video streamed from ffmpeg, '
+                                                 'into a JSON results file')
+    parser.add_argument('source',
+                        help='folder with snap_NNNN.png images, or a (cropped) video file to stream frames from')
+    parser.add_argument('results_file',
+                        help='JSON results file; resumed if it (or its journal) already exists')
+    parser.add_argument('--fsync-every',
+                        default=50,
+                        type=int,
+                        help='fsync the results journal after this many frames')
+    parser.add_argument('--dedup-threshold',
+                        default=2,
+                        type=int,
+                        help='group consecutive frames whose perceptual signatures differ in at most this many '
+                             'cells (of 24x192) and OCR only one frame per group; one changed character changes '
+                             '6 or more; negative = no dedup')
+    parser.add_argument('--backend', '-b',
+                        default='cli',
+                        choices=list(BACKENDS),
+                        help='OCR backend: cli = macOCR binary per image (Apple Silicon), worker = pool of persistent '
+                             'OCR worker processes, tesseract = in-process Tesseract, stub = deterministic fake OCR')
+    parser.add_argument('--lang', '-l',
+                        default='zh',
+                        help='OCR language')
+    parser.add_argument('--ocr-binary',
+                        default=DEFAULT_OCR_BINARY,
+                        help='cli backend only: path to the macOCR binary')
+    parser.add_argument('--worker-cmd',
+                        default=None,
+                        help='worker backend only: command line of a worker speaking the ocr_worker.py protocol '
+                             '(default: ocr_worker.py with --worker-backend)')
+    parser.add_argument('--worker-backend',
+                        default='tesseract',
+                        help='worker backend only: in-process backend run by the default ocr_worker.py workers')
+    parser.add_argument('--worker-processes',
+                        default=4,
+                        type=int,
+                        help='worker backend only: number of persistent worker processes')
+    parser.add_argument('--stub-delay',
+                        default=0.0,
+                        type=float,
+                        help='stub backend only: simulated seconds of OCR per frame')
+    parser.add_argument('--cache-file',
+                        default=None,
+                        help=f'SQLite OCR cache shared across videos and runs (default: {DEFAULT_CACHE_FILE})')
+    parser.add_argument('--cache-max-mb',
+                        default=256,
+                        type=int,
+                        help='OCR cache size cap; least recently used entries are evicted first')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help='do not look up or store OCR results in the cache')
+    parser.add_argument('--fps',
+                        default=1.0,
+                        type=float,
+                        help='video source only: frames per second to decode')
+    parser.add_argument('--threads',
+                        default=20,
+                        type=int,
+                        help='OCR calls in flight at the same time (with --adaptive: the starting point)')
+    parser.add_argument('--adaptive',
+                        action='store_true',
+                        default=False,
+                        help='adjust the OCR calls in flight between --min-threads and --max-threads from the measured '
+                             'frames per second, timeouts/errors and load average (see ocr_scheduler.py)')
+    parser.add_argument('--min-threads',
+                        default=1,
+                        type=int,
+                        help='--adaptive only: lower bound of OCR calls in flight')
+    parser.add_argument('--max-threads',
+                        default=64,
+                        type=int,
+                        help='--adaptive only: upper bound of OCR calls in flight')
+    parser.add_argument('--max-load',
+                        default=0.0,
+                        type=float,
+                        help='--adaptive only: back off while the 1-minute load average per CPU is above this '
+                             '(0 = ignore the load)')
+    parser.add_argument('--ocr-timeout',
+                        default=60.0,
+                        type=float,
+                        help='seconds one OCR call may take; a hung OCR process is killed (0 = no limit)')
+    parser.add_argument('--retries',
+                        default=2,
+                        type=int,
+                        help='retry a frame whose OCR failed or timed out this many times; frames that still fail '
+                             'are listed in RESULTS.failed.json')
+    parser.add_argument('--only-failed',
+                        action='store_true',
+                        default=False,
+                        help='snapshot folder only: OCR just the frames listed in RESULTS.failed.json by an earlier run')
+    parser.add_argument('--queue-size',
+                        default=40,
+                        type=int,
+                        help='video source only: number of decoded frame buffers that may be queued or in flight (at least 2)')
+    parser.add_argument('--preprocess',
+                        action='store_true',
+                        default=False,
+                        help='binarize, trim and downscale every frame before OCR (see preprocess.py); the '
+                             'normalized image is also the cache key, so identical subtitles are OCR\'ed once')
+    parser.add_argument('--binarize-threshold',
+                        default=None,
+                        type=int,
+                        help='--preprocess only: gray level (0..255) separating glyphs from background '
+                             '(default: Otsu per frame)')
+    parser.add_argument('--text-color',
+                        default='light',
+                        choices=('light', 'dark'),
+                        help='--preprocess and --skip-blank: subtitle text lighter or darker than the background')
+    parser.add_argument('--glyph-height',
+                        default=32,
+                        type=int,
+                        help='--preprocess only: downscale until a text line is at most this many pixels high '
+                             '(0 = keep size)')
+    parser.add_argument('--skip-blank',
+                        action='store_true',
+                        default=False,
+                        help='record frames without subtitle-like pixels as empty without OCR (see blank_frames.py)')
+    parser.add_argument('--blank-sensitivity',
+                        default=1.0,
+                        type=float,
+                        help='--skip-blank only: higher = fewer frames classified blank')
+    parser.add_argument('--blank-audit',
+                        default=0.0,
+                        type=float,
+                        help='--skip-blank only: fraction (0..1) of the frames classified blank to OCR anyway; '
+                             'the ones where OCR finds text are reported as false negatives')
+    parser.add_argument('--serve',
+                        default=None,
+                        metavar='[HOST]:PORT',
+                        help='snapshot folder only: do not OCR locally, serve the frames to ocr_queue.py workers '
+                             'on this address and write their results (see ocr_queue.py); the workers pick their own '
+                             'backend, so --backend and its options are ignored and the OCR cache is not used')
+    parser.add_argument('--lease-seconds',
+                        default=60.0,
+                        type=float,
+                        help='--serve only: a job not completed or renewed by its worker within this time is '
+                             'handed to another worker')
+    parser.add_argument('--max-attempts',
+                        default=3,
+                        type=int,
+                        help='--serve only: give up a frame after this many failed OCR attempts (retried on the next run)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
 
-    # load the existing dictionary from json file, or create an empty one
-    res_file = Path(results_file)
-    if res_file.exists():
-        ocr_dict = json.load(res_file.open(encoding='utf-8'))
+    if args.dedup_threshold >= 0:
+        try:
+            import frame_signature
+        except ImportError:
+            print('WARN: frame deduplication disabled! numpy/pillow not installed! -- pip install numpy pillow')
+            frame_signature = None
     else:
-        ocr_dict = {}
+        frame_signature = None
+
+    cache = None
+    # --serve: the cache key depends on the backend, which only the workers know
+    if not args.no_cache and not args.serve:
+        try:
+            from frame_signature import load_gray
+        except ImportError:
+            print('WARN: OCR cache disabled! numpy/pillow not installed! -- pip install numpy pillow')
+        else:
+            cache = OcrCache(args.cache_file or DEFAULT_CACHE_FILE, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    streaming = not Path(args.source).is_dir()
+
+    if streaming and args.serve:
+        parser.error('--serve needs a folder of snapshots, not a video')
+    if streaming and args.only_failed:
+        parser.error('--only-failed needs a folder of snapshots; a video resumes from its journal instead')
+    if args.serve and (args.preprocess or args.skip_blank or args.blank_audit):
+        # the workers OCR the snapshots as they are, and a coordinator-side blank skip would go unaudited
+        parser.error('--preprocess, --skip-blank and --blank-audit are not supported with --serve')
+    if streaming and args.queue_size < 2:
+        # one buffer is held as the representative of the open group while the next frame is read
+        parser.error('--queue-size must be at least 2')
+
+    if streaming or args.preprocess or args.skip_blank:
+        # pip install numpy pillow
+        from PIL import Image
+        from blank_frames import BlankDetector
+        from frame_signature import load_gray
+        from frame_stream import FrameStream
+        from preprocess import preprocess
+
+    known_texts = {}
+
+    blank_detector = BlankDetector(args.blank_sensitivity, args.text_color) if args.skip_blank else None
+    blank_misses = []
+
+    # --serve: the workers bring their own backend
+    backend = None if args.serve else create_backend(args.backend,
+                                                     lang=args.lang,
+                                                     binary=args.ocr_binary,
+                                                     worker_cmd=args.worker_cmd,
+                                                     processes=args.worker_processes,
+                                                     worker_backend=args.worker_backend,
+                                                     delay=args.stub_delay,
+                                                     timeout=args.ocr_timeout or None)
+
+    results_file = args.results_file
+
+    # load the existing dictionary and replay the journal left behind by an interrupted run
+    journal = OcrJournal(results_file, fsync_every=args.fsync_every)
+    ocr_dict = journal.load()
+
+    failed_file = Path(results_file).with_name(f'{Path(results_file).stem}.failed.json')
+    failed_frames = {}
+
+    only_failed = None
+    if args.only_failed:
+        if not failed_file.exists():
+            sys.exit(f'Nothing to rerun: {failed_file} not found')
+        only_failed = set(json.loads(failed_file.read_text(encoding='utf-8')))
+
+    if args.adaptive:
+        limiter = AdaptiveLimit(args.threads, args.min_threads, args.max_threads, max_load=args.max_load or None)
+    else:
+        limiter = AdaptiveLimit(args.threads, args.threads, args.threads, adaptive=False)
+    retry = RetryPolicy(args.retries)
+
+    stats = dict(frames=0, groups=0, pending_frames=0, ocr_calls=0, blank_frames=0, blank_audited=0)
+    ocr_seconds = []
+
+    with instrumentation.session(args):
+        try:
+            ##### TODO: tweak --threads to your liking depending on available system resources, or let --adaptive find it
+            with metrics.stage('ocr'), tempfile.TemporaryDirectory() as tmp, \
+                    ThreadPoolExecutor(max_workers=args.max_threads if args.adaptive else args.threads) as executor:
+                # throwaway PNGs for backends that can only read files
+                scratch_dir = Path(tmp)
+                if streaming:
+                    ocr_stream(executor, args.source)
+                else:
+                    ocr_folder(executor, args.source)
+        finally:
+            if backend:
+                backend.close()
+            if cache:
+                cache.close()
+            with metrics.stage('compact'):
+                journal.compact(ocr_dict)
+            print(f'Wrote {len(ocr_dict)} results to {Path(results_file).absolute()}')
+
+            if failed_frames:
+                failed_file.write_text(json.dumps(failed_frames, ensure_ascii=False, indent=1), encoding='utf-8')
+                print(f'WARN: {len(failed_frames)} frames failed OCR (every attempt); listed in {failed_file} '
+                      f'-- rerun them with --only-failed')
+            else:
+                failed_file.unlink(missing_ok=True)
+
+        for name in ('frames', 'ocr_calls', 'blank_frames'):
+            metrics.inc(name, stats[name])
+
+        if frame_signature:
+            print(f"Dedup: {stats['frames']} frames in {stats['groups']} groups; "
+                  f"{stats['ocr_calls']} OCR calls for {stats['pending_frames']} pending frames "
+                  f"({stats['pending_frames'] - stats['ocr_calls']} saved)")
+
+        if blank_detector:
+            print(f"Blank filter: {stats['blank_frames']} of {stats['ocr_calls']} OCR calls classified blank "
+                  f"({stats['blank_frames'] - stats['blank_audited']} skipped)")
+            if stats['blank_audited']:
+                print(f"Blank audit: {len(blank_misses)} of {stats['blank_audited']} audited blank frames had text"
+                      + (': ' + ', '.join(sorted(blank_misses)) if blank_misses else ''))
+
+        if args.adaptive:
+            print(limiter.summary())
 
-    ##### TODO: tweak the threadpool size to your liking depending on available system resources
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        img: Path
-        for img in Path(folder_name).glob("*.png"):
-            executor.submit(ocr_file, img)
+        if cache:
+            print(cache.summary(seconds_per_ocr=sum(ocr_seconds) / len(ocr_seconds) if ocr_seconds else None))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Cheap perceptual signatures for cropped subtitle frames.
+#
+# A frame is reduced to a small grid of block-mean gray levels. The distance between two
+# frames is the number of cells whose gray level changed noticeably. It is an absolute count,
+# not a fraction of the text: one changed character of a long line changes as many cells as one
+# changed character of a short line (6 or more cells for rendered one-character changes in a
+# 1738x115 band), while compression noise and a drifting background change none. Two frames show the same
+# subtitle when the count stays at or below a threshold. Runs of near-identical consecutive
+# frames are grouped so that only one representative per group needs to be OCR'ed.
+
+# DEPENDENCIES:
+# pip install -U numpy pillow
+
+from typing import Callable
+from typing import List
+from typing import Sequence
+
+import numpy as np
+from PIL import Image
+
+SIGNATURE_ROWS = 24
+SIGNATURE_COLS = 192
+
+# minimum change of a cell's mean gray level (0..1) for the cell to count as changed
+CELL_TOLERANCE = 0.08
+
+
+def load_gray(image_path) -> np.ndarray:
+    with Image.open(image_path) as im:
+        return np.asarray(im.convert('L'))
+
+
+def block_mean(gray: np.ndarray, rows=SIGNATURE_ROWS, cols=SIGNATURE_COLS) -> np.ndarray:
+    height, width = gray.shape[:2]
+    rows = min(rows, height)
+    cols = min(cols, width)
+
+    row_edges = np.linspace(0, height, rows + 1).astype(int)
+    col_edges = np.linspace(0, width, cols + 1).astype(int)
+
+    sums = np.add.reduceat(np.add.reduceat(gray.astype(np.float32), row_edges[:-1], axis=0),
+                           col_edges[:-1], axis=1)
+    counts = np.outer(np.diff(row_edges), np.diff(col_edges))
+
+    return sums / counts
+
+
+def signature(gray: np.ndarray) -> np.ndarray:
+    return block_mean(gray) / 255.0
+
+
+def distance(sig1: np.ndarray, sig2: np.ndarray) -> int:
+    """Number of signature cells whose gray level changed by more than CELL_TOLERANCE."""
+    if sig1.shape != sig2.shape:
+        return sig1.size + sig2.size
+
+    return int(np.count_nonzero(np.abs(sig1 - sig2) > CELL_TOLERANCE))
+
+
+def group_similar(items: Sequence, signature_of: Callable, threshold: int) -> List[list]:
+    """Group consecutive items that differ from the group's first item in at most `threshold` cells.
+
+    Items must already be in playback order; a threshold of 0 only groups frames without a changed cell.
+    """
+    groups = []
+    anchor = None
+
+    for item in items:
+        sig = signature_of(item)
+
+        if anchor is not None and distance(anchor, sig) <= threshold:
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+            anchor = sig
+
+    return groups
+
+
+def representative(group: list):
+    # the middle frame is the least likely to catch a fade in/out
+    return group[len(group) // 2]
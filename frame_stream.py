@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Stream decoded gray frames from ffmpeg without writing snapshots to disk.
+#
+# ffmpeg decodes the (cropped) video with `-f rawvideo -pix_fmt gray` into a pipe; frames are
+# read straight into a fixed pool of preallocated NumPy buffers. A consumer hands each buffer
+# back with release() once it is done with it; when every buffer is in use the reader blocks,
+# so memory stays flat no matter how long the video is.
+
+# DEPENDENCIES:
+# ffmpeg + ffprobe on PATH
+# pip install -U numpy
+
+import json
+import queue
+import subprocess
+from fractions import Fraction
+
+import numpy as np
+
+from instrumentation import metrics
+
+
+def probe_video(video):
+    proc = subprocess.run(['ffprobe', '-v', 'error',
+                           '-select_streams', 'v:0',
+                           '-show_entries', 'stream=width,height,r_frame_rate,duration:format=duration',
+                           '-of', 'json', str(video)],
+                          stdout=subprocess.PIPE,
+                          check=True)
+    info = json.loads(proc.stdout)
+    stream = info['streams'][0]
+
+    # the container duration can run past the video stream (e.g. audio copied with -c:a copy);
+    # matroska has no per-stream duration, so fall back to it
+    duration = stream.get('duration')
+    if duration in (None, 'N/A'):
+        duration = info['format']['duration']
+
+    return stream['width'], stream['height'], Fraction(stream['r_frame_rate']), float(duration)
+
+
+class FrameStream:
+
+    def __init__(self, video, fps=1.0, buffers=8):
+        self.video = video
+        self.fps = fps
+        self.width, self.height, self.video_fps, self.duration = probe_video(video)
+        self.frames_read = 0
+
+        self.buffers = buffers
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(np.empty((self.height, self.width), dtype=np.uint8))
+
+    def frame_key(self, frame_number) -> str:
+        # millisecond timestamp keys, as understood by gensrt.py
+        return f'{round(frame_number * 1000 / self.fps):08d}ms'
+
+    def release(self, buffer: np.ndarray):
+        self._free.put(buffer)
+
+    def __iter__(self):
+        """Yield (key, buffer) pairs; every yielded buffer must be handed back with release()."""
+        proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', str(self.video),
+                                 '-vf', f'fps={self.fps}',
+                                 '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                                stdout=subprocess.PIPE)
+        try:
+            frame_number = 0
+            while True:
+                # blocks while all buffers are still queued or being OCR'ed (backpressure)
+                with metrics.timer('frame_buffer_wait_seconds'):
+                    buffer = self._free.get()
+                metrics.gauge('frame_buffers_in_use', self.buffers - self._free.qsize())
+
+                with metrics.timer('frame_decode_seconds'):
+                    complete = self._read_into(proc.stdout, buffer)
+
+                if not complete:
+                    self.release(buffer)
+                    break
+
+                self.frames_read += 1
+                yield self.frame_key(frame_number), buffer
+                frame_number += 1
+
+            # a decode error also ends the pipe: don't pass it off as the end of the video
+            if proc.wait():
+                raise RuntimeError(f'ffmpeg failed with exit code {proc.returncode} after {self.frames_read} frames '
+                                   f'of {self.video}')
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    @staticmethod
+    def _read_into(pipe, buffer: np.ndarray) -> bool:
+        view = memoryview(buffer).cast('B')
+        filled = 0
+
+        while filled < len(view):
+            n = pipe.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+
+        return True
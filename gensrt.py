@@ -1,62 +1,337 @@
 #!/usr/bin/env python3
 
+# Turn OCR results JSON into SRT cues.
+#
+# --incremental keeps the frames and cues of the last run in a state file next to the SRT output
+# (FILE.srt.gensrt.json). A later run compares the frames with the remembered ones and rebuilds
+# cues only from the start of the last cue before the first changed frame, stopping as soon as a
+# rebuilt cue starts on an unchanged frame where an old cue started after the last change; the
+# cues outside that window are copied from the state. Re-running while OCR is still filling in
+# frames, or after re-OCR'ing a range, then costs time proportional to the change.
+
+import argparse
+import bisect
 import datetime
 import json
 import sys
+from collections import Counter
 from pathlib import Path
 
 import srt
 
-def generate_srt(json_input_file=None):
-    # get the list of image files in the img folder, sorted by their names
+import instrumentation
+from instrumentation import metrics
+
+
+def frame_time(key: str, fps=1.0, start_number=1) -> datetime.timedelta:
+    # snap_00012345ms.png: millisecond timestamp keys written by adaptive_sample.py / do-ocr.py streaming
+    if key.endswith('ms'):
+        return datetime.timedelta(milliseconds=int(key[:-2]))
+
+    # snap_0001.png: frame numbers of `ffmpeg -vf fps=N -start_number 1`
+    return datetime.timedelta(seconds=(int(key) - start_number) / fps)
+
+
+def normalize(text: str) -> str:
+    # OCR noise in whitespace and latin case should not split a cue
+    return ''.join(text.split()).lower()
+
+
+def edit_distance(s1: str, s2: str) -> int:
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (c1 != c2)))
+        previous = current
+
+    return previous[-1]
+
+
+def similarity(s1: str, s2: str) -> float:
+    # 1.0 = identical, 0.0 = nothing in common
+    if not s1 and not s2:
+        return 1.0
+    return 1.0 - edit_distance(s1, s2) / max(len(s1), len(s2))
+
+
+class CueGroup:
+    """Consecutive frames that show (approximately) the same line."""
+
+    def __init__(self, start, end, body):
+        self.start = start
+        self.end = end
+        self.votes = Counter()
+        self.bodies = {}
+        self.leader = None
+        self.add(end, body)
+
+    def add(self, end, body):
+        self.end = end
+
+        key = normalize(body)
+        self.votes[key] += 1
+        # remember the most frequent raw spelling of every normalized variant
+        self.bodies.setdefault(key, Counter())[body] += 1
+
+        if self.leader is None or self.votes[key] > self.votes[self.leader]:
+            self.leader = key
 
-    with open(json_input_file, "r") as f:
-        ocr_dict: dict = json.load(f)
+    def consensus(self) -> str:
+        # majority vote; ties are broken by the medoid among the tied variants
+        best = self.votes[self.leader]
+        tied = [key for key, count in self.votes.items() if count == best]
 
-    subtitles = []
-    start_time = datetime.timedelta()
+        if len(tied) > 1:
+            winner = min(tied, key=lambda candidate: sum(count * edit_distance(candidate, other)
+                                                         for other, count in self.votes.items()))
+        else:
+            winner = self.leader
+
+        return self.bodies[winner].most_common(1)[0][0]
+
+    def to_subtitle(self) -> srt.Subtitle:
+        return srt.Subtitle(None, self.start, self.end, self.consensus())
 
-    sorted_int_keys = sorted([int(k) for k in ocr_dict.keys()])
 
-    current_sub: srt.Subtitle = None
+def iter_groups(frames, min_similarity=0.7):
+    """Group a sorted stream of (start, end, body) frames in one linear pass; yield (index of first frame, group).
 
-    for frame_number in sorted(ocr_dict.keys()):
+    A frame joins the current group when its normalized text is at least `min_similarity`
+    similar to the group's current majority text; a blank frame closes the group.
+    """
+    current: CueGroup = None
+    first = None
 
-        start_time: datetime.timedelta = datetime.timedelta(milliseconds=int(1000 * (float(frame_number) / 4 )))
-        end_time = start_time + datetime.timedelta(milliseconds=500)
-        body: str = ocr_dict.get(str(frame_number)).strip()
+    for i, (start, end, body) in enumerate(frames):
+        if body and current and similarity(normalize(body), current.leader) >= min_similarity:
+            current.add(end, body)
+            continue
+
+        if current:
+            yield first, current
+            current = None
 
         if body:
-            start_time: datetime.timedelta = datetime.timedelta(seconds=frame_number)
-            end_time = start_time + datetime.timedelta(milliseconds=1000)
+            current, first = CueGroup(start, end, body), i
+
+    if current:
+        yield first, current
+
+
+def build_cues(frames, min_similarity=0.7):
+    return [group.to_subtitle() for _, group in iter_groups(frames, min_similarity)]
+
+
+def iter_frames(ocr_dict: dict, fps=1.0, start_number=1):
+    def to_time(key):
+        return frame_time(key, fps, start_number)
+
+    sorted_keys = sorted(ocr_dict.keys(), key=to_time)
+    frame_duration = datetime.timedelta(seconds=1 / fps)
+
+    for i, frame_key in enumerate(sorted_keys):
+        start_time = to_time(frame_key)
+
+        # timestamp keys are sampled irregularly: a frame lasts until the next sampled frame
+        if frame_key.endswith('ms') and i + 1 < len(sorted_keys):
+            end_time = to_time(sorted_keys[i + 1])
+        else:
+            end_time = start_time + frame_duration
+
+        yield start_time, end_time, ocr_dict[frame_key].strip()
+
+
+def load_results(json_input_file) -> dict:
+    with metrics.stage('load'), open(json_input_file, "r") as f:
+        return json.load(f)
+
+
+def generate_srt(json_input_file=None, fps=1.0, start_number=1, min_similarity=0.7):
 
-            sub = srt.Subtitle(None, start_time, end_time, body)
+    ocr_dict = load_results(json_input_file)
 
-            if not current_sub:
-                current_sub = sub
-                continue
+    with metrics.stage('build_cues'):
+        subtitles = build_cues(iter_frames(ocr_dict, fps, start_number), min_similarity=min_similarity)
 
-            # if it's duplicate content then add 1 second to current sub
-            if current_sub.content == body:
-                current_sub.end = current_sub.end + datetime.timedelta(milliseconds=1000)
-            else:
-                subtitles.append(current_sub)
-                print(current_sub.to_srt())
-                current_sub = sub
+    for sub in subtitles:
+        print(sub.to_srt())
 
+    return subtitles
+
+
+def to_micros(delta: datetime.timedelta) -> int:
+    return delta // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros: int) -> datetime.timedelta:
+    return datetime.timedelta(microseconds=micros)
+
+
+def frame_sort_key(key: str):
+    # millisecond keys and frame numbers never mix within one results file
+    return int(key[:-2]) if key.endswith('ms') else int(key)
+
+
+class IncrementalState:
+    """Frames and cues of the last run; cues are [first frame key, start µs, end µs, text]."""
+
+    def __init__(self, path: Path, params: dict):
+        self.path = path
+        self.params = params
+        self.frames = None
+        self.cues = []
+
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return
+
+        # other grouping settings give other cues: start over
+        if data.get('params') == params:
+            self.frames = data['frames']
+            self.cues = data['cues']
+
+    def save(self, frames: dict, cues: list):
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        tmp.write_text(json.dumps({'params': self.params, 'frames': frames, 'cues': cues}, ensure_ascii=False),
+                       encoding='utf-8')
+        tmp.replace(self.path)
+
+
+def changed_range(old_frames: list, new_frames: list, new_index: dict):
+    """(first, last) index into new_frames of the frames that differ from old_frames, or None."""
+    old = {key: frame for key, *frame in old_frames}
+    changed = [i for i, (key, *frame) in enumerate(new_frames) if old.get(key) != frame]
+
+    # a frame that disappeared counts as a change at the position it used to have
+    for key in old.keys() - new_index.keys():
+        position = bisect.bisect_left(new_frames, frame_sort_key(key), key=lambda frame: frame_sort_key(frame[0]))
+        changed.append(min(position, len(new_frames) - 1))
+
+    if not changed:
+        return None
+    return min(changed), max(changed)
+
+
+def generate_srt_incremental(json_input_file, state_file: Path, fps=1.0, start_number=1, min_similarity=0.7):
+
+    ocr_dict = load_results(json_input_file)
+    state = IncrementalState(state_file, {'fps': fps, 'start_number': start_number,
+                                          'min_similarity': min_similarity})
+
+    def frame_list(frames_dict):
+        keys = sorted(frames_dict, key=frame_sort_key)
+        return [(key, *frame) for key, frame in zip(keys, iter_frames(frames_dict, fps, start_number))]
+
+    with metrics.stage('diff'):
+        new_frames = frame_list(ocr_dict)
+        new_index = {key: i for i, (key, *_) in enumerate(new_frames)}
+
+        if state.frames is None or not new_frames:
+            # first run (or other settings): everything is new
+            old_cues, window = [], (0, len(new_frames) - 1)
         else:
-            if current_sub:
-                subtitles.append(current_sub)
-                print(current_sub.to_srt())
-                current_sub = None
+            old_cues, window = state.cues, changed_range(frame_list(state.frames), new_frames, new_index)
+
+    cues, rebuilt = old_cues, []
+    if window and new_frames:
+        first_changed, last_changed = window
+
+        with metrics.stage('build_cues'):
+            # restart at the last old cue that began before the first change: the frames up to it are unchanged,
+            # so it begins a new group now just as it did then
+            kept, restart = 0, 0
+            for i, (key, *_) in enumerate(old_cues):
+                if new_index.get(key, first_changed) >= first_changed:
+                    break
+                kept, restart = i, new_index[key]
+
+            # once a rebuilt cue begins on an unchanged frame where an old cue began, the rest is what it was
+            resume_at = {new_index[key]: i for i, (key, *_) in enumerate(old_cues)
+                         if new_index.get(key, -1) > last_changed}
+
+            tail = []
+            for first, group in iter_groups((frame[1:] for frame in new_frames[restart:]), min_similarity):
+                position = restart + first
+                if position in resume_at:
+                    tail = old_cues[resume_at[position]:]
+                    break
+                rebuilt.append([new_frames[position][0], to_micros(group.start), to_micros(group.end),
+                                group.consensus()])
+
+            cues = old_cues[:kept] + rebuilt + tail
+
+    elif not new_frames:
+        cues = []
+
+    subtitles = [srt.Subtitle(None, from_micros(start), from_micros(end), text) for _, start, end, text in cues]
+
+    for _, start, end, text in rebuilt:
+        print(srt.Subtitle(None, from_micros(start), from_micros(end), text).to_srt())
+
+    if window and new_frames:
+        print(f'Rebuilt {len(rebuilt)} of {len(cues)} cues '
+              f'(frames {new_frames[window[0]][0]}..{new_frames[window[1]][0]} changed)')
+    else:
+        print(f'No changed frames, {len(cues)} cues unchanged')
+    metrics.inc('cues_rebuilt', len(rebuilt))
+
+    state.save(ocr_dict, cues)
 
     return subtitles
 
-json_input = sys.argv[1]
-srt_output=sys.argv[2]
 
-subtitles = generate_srt(json_input_file=json_input)
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate SRT subtitles from OCR results JSON')
+    parser.add_argument('json_input',
+                        help='OCR results JSON written by do-ocr.py')
+    parser.add_argument('srt_output',
+                        help='SRT output file')
+    parser.add_argument('--fps',
+                        default=1.0,
+                        type=float,
+                        help='snapshot rate of frame-number keys (snap_0001.png); ignored for millisecond keys')
+    parser.add_argument('--start-number',
+                        default=1,
+                        type=int,
+                        help='frame number of the snapshot at 00:00:00 (ffmpeg -start_number)')
+    parser.add_argument('--min-similarity',
+                        default=0.7,
+                        type=float,
+                        help='consecutive frames whose normalized texts are at least this similar (0..1, by edit '
+                             'distance) belong to the same cue; 1 = exact matches only')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        default=False,
+                        help='remember frames and cues in a state file and on the next run rebuild only the cues '
+                             'around frames that changed')
+    parser.add_argument('--state-file',
+                        default=None,
+                        help='--incremental state file (default: SRT_OUTPUT.gensrt.json)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    with instrumentation.session(args):
+        if args.incremental:
+            subtitles = generate_srt_incremental(args.json_input,
+                                                 Path(args.state_file or f'{args.srt_output}.gensrt.json'),
+                                                 fps=args.fps,
+                                                 start_number=args.start_number,
+                                                 min_similarity=args.min_similarity)
+        else:
+            subtitles = generate_srt(json_input_file=args.json_input,
+                                     fps=args.fps,
+                                     start_number=args.start_number,
+                                     min_similarity=args.min_similarity)
 
-print('JSON input:', json_input)
-print('SRT output:', srt_output)
-Path(srt_output).write_text(srt.compose(subtitles), encoding='utf-8')
+        print('JSON input:', args.json_input)
+        print('SRT output:', args.srt_output)
+        with metrics.stage('write'):
+            Path(args.srt_output).write_text(srt.compose(subtitles), encoding='utf-8')
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# Shared performance instrumentation for do-ocr.py, gensrt.py, srt_subs_zh2pinyin.py,
+# srt_merge.py and deepl.py.
+#
+# One process-wide `metrics` registry collects:
+#   stages      wall and CPU seconds of the named phases of a run
+#   histograms  latency distributions (per-frame OCR, lock waits, HTTP requests, ...)
+#   counters    events (cache hits, retries, process spawns, ...)
+#   gauges      current and peak values (queue depths, frames in flight)
+# Every metric may carry labels, e.g. metrics.inc('http_responses', status=429).
+#
+# --metrics FILE dumps the registry at exit as JSON, or in the Prometheus text format when FILE
+# ends in .prom (for the node_exporter textfile collector). --profile FILE captures cProfile
+# stats of the main thread and of every thread started while profiling (thread pools included),
+# saves them for `python -m pstats FILE` and prints the hottest functions.
+
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+from pathlib import Path
+
+# seconds; upper bounds of the histogram buckets (Prometheus `le`)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = 'subtitles_ocr_'
+
+
+def label_key(labels: dict):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile; the max for the overflow bucket
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            _, peak = self.gauges.get(key, (0, value))
+            self.gauges[key] = (value, max(peak, value))
+
+    def gauge_add(self, name, delta, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            value, peak = self.gauges.get(key, (0, 0))
+            value += delta
+            self.gauges[key] = (value, max(peak, value))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Wall and (process) CPU seconds of a phase; repeated phases accumulate."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self._lock:
+                totals = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+                totals['calls'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, fn, name, **labels):
+        """Wrap fn so that every call is observed in histogram `name`."""
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - started, **labels)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def locked(self, lock, name):
+        """`with lock:` that records how long the caller waited for the lock."""
+        started = time.perf_counter()
+        with lock:
+            self.observe('lock_wait_seconds', time.perf_counter() - started, lock=name)
+            yield
+
+    def report(self) -> dict:
+        def labelled(items, convert):
+            out = {}
+            for (name, labels), value in sorted(items):
+                entry = dict(labels)
+                entry.update(convert(value))
+                out.setdefault(name, []).append(entry)
+            return out
+
+        with self._lock:
+            return {
+                'script': Path(sys.argv[0]).stem,
+                'stages': {name: dict(totals) for name, totals in self.stages.items()},
+                'histograms': labelled(self.histograms.items(), Histogram.to_dict),
+                'counters': labelled(self.counters.items(), lambda value: {'value': value}),
+                'gauges': labelled(self.gauges.items(), lambda value: {'value': value[0], 'max': value[1]}),
+            }
+
+    def prometheus(self) -> str:
+        script = Path(sys.argv[0]).stem
+        lines = []
+
+        def series(name, labels=(), suffix=''):
+            pairs = (('script', script),) + tuple(labels)
+            rendered = ','.join(f'{key}="{value}"' for key, value in pairs)
+            return f'{PROMETHEUS_PREFIX}{name}{suffix}{{{rendered}}}'
+
+        with self._lock:
+            for metric, field in (('stage_wall_seconds', 'wall_seconds'), ('stage_cpu_seconds', 'cpu_seconds')):
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{metric} gauge')
+                for name, totals in sorted(self.stages.items()):
+                    lines.append(f"{series(metric, [('stage', name)])} {totals[field]}")
+
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}_total counter')
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append(f'{series(name, labels, "_total")} {value}')
+
+            for name in sorted({name for name, _ in self.gauges}):
+                for suffix, field in (('', 0), ('_max', 1)):
+                    lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}{suffix} gauge')
+                    for (other, labels), values in sorted(self.gauges.items()):
+                        if other == name:
+                            lines.append(f'{series(name, labels, suffix)} {values[field]}')
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} histogram')
+                for (other, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{series(name, labels + (('le', bound),), '_bucket')} {cumulative}")
+                    lines.append(f'{series(name, labels, "_sum")} {histogram.sum}')
+                    lines.append(f'{series(name, labels, "_count")} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        path = Path(path)
+        if path.suffix == '.prom':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2)
+
+        # atomic, so that a scraper never reads a half-written file
+        tmp = path.with_name(f'{path.name}.tmp')
+        tmp.write_text(text, encoding='utf-8')
+        tmp.replace(path)
+
+
+metrics = Metrics()
+
+
+class Profiler:
+    """cProfile of the calling thread plus every thread started while it is running."""
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self._lock = threading.Lock()
+
+    def _start_thread(self, *_):
+        # runs as the first profile event of a new thread: swap in a per-thread profiler
+        profile = cProfile.Profile()
+        sys.setprofile(None)
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: one profiler already sees every thread
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self.profiles[0].enable()
+
+    def stop(self) -> pstats.Stats:
+        self.profiles[0].disable()
+        threading.setprofile(None)
+
+        stats = pstats.Stats(self.profiles[0], stream=io.StringIO())
+        with self._lock:
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+
+        return stats
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics',
+                        default=None,
+                        metavar='FILE',
+                        help='write timings, latency histograms, counters and queue depths at exit: '
+                             'JSON, or Prometheus text format if FILE ends in .prom')
+    parser.add_argument('--profile',
+                        default=None,
+                        metavar='FILE',
+                        help='capture cProfile stats of all threads into FILE (view with python -m pstats FILE) '
+                             'and print the hottest functions')
+
+
+@contextlib.contextmanager
+def session(args, top=25):
+    """Run the body under the --profile profiler and write --metrics at the end, even on errors."""
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+
+    try:
+        with metrics.stage('total'):
+            yield metrics
+    finally:
+        if profiler:
+            stats = profiler.stop()
+            stats.dump_stats(args.profile)
+            stats.stream = sys.stderr
+            stats.sort_stats('cumulative').print_stats(top)
+            print(f'Wrote profile to {args.profile}', file=sys.stderr)
+
+        if args.metrics:
+            metrics.write(args.metrics)
+            print(f'Wrote metrics to {args.metrics}')
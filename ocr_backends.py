@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Pluggable OCR backends used by do-ocr.py.
+#
+#   cli        the macOCR binary, one process per image (Apple Silicon only)
+#   worker     a pool of long-lived worker processes speaking the line protocol below,
+#              so process spawn and model load are paid once instead of per frame
+#   tesseract  in-process Tesseract through pytesseract (any platform)
+#   stub       deterministic fake OCR to run and benchmark the pipeline on any box
+#
+# Worker protocol (one request per line on stdin, one JSON response line on stdout):
+#   {"id": 1, "path": "/abs/snap_0001.png"}
+#   {"id": 2, "width": 1738, "height": 115}  followed by width*height raw gray bytes
+#   -> {"id": 1, "text": "..."} or {"id": 1, "error": "..."}
+# ocr_worker.py implements the worker side on top of any in-process backend.
+
+import hashlib
+import json
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from instrumentation import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    # only the cli backend works without numpy -- pip install numpy
+    np = None
+
+DEFAULT_OCR_BINARY = '/usr/local/bin/OCR'
+
+# macOCR language codes -> tesseract traineddata names
+TESSERACT_LANGUAGES = {
+    'zh': 'chi_sim',
+    'zh-hant': 'chi_tra',
+    'en': 'eng',
+    'ja': 'jpn',
+    'ko': 'kor',
+}
+
+
+class OcrError(Exception):
+    pass
+
+
+class OcrTimeout(OcrError):
+    pass
+
+
+class OcrBackend:
+    name = None
+
+    # backends that can only read images from disk; callers must write a PNG for them
+    needs_file = True
+
+    def __init__(self, lang='zh', timeout=None):
+        self.lang = lang
+        # seconds one recognition may take before it is killed (None = no limit)
+        self.timeout = timeout
+
+    def recognize_file(self, image_path) -> str:
+        raise NotImplementedError
+
+    def recognize_array(self, gray) -> str:
+        raise NotImplementedError
+
+    def cache_id(self) -> str:
+        # everything that can change the recognized text for the same pixels
+        return f'{self.name}:{self.lang}'
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CliBackend(OcrBackend):
+    name = 'cli'
+
+    def __init__(self, lang='zh', binary=DEFAULT_OCR_BINARY, timeout=None):
+        super().__init__(lang, timeout)
+        self.binary = binary
+
+    def recognize_file(self, image_path) -> str:
+        # !! mac m1/m2 only: use the version from https://github.com/glowinthedark/macOCR/releases or the OCR binary in this repo
+        metrics.inc('ocr_process_spawns', backend=self.name)
+        try:
+            # on timeout the hung OCR process is killed before TimeoutExpired is raised
+            proc = subprocess.run([self.binary, self.lang, "false", "false", str(Path(image_path).absolute())],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise OcrTimeout(f'{self.binary} timed out after {self.timeout}s on {image_path}')
+        except OSError as e:
+            raise OcrError(str(e))
+
+        err = proc.stderr.decode().strip()
+        text = proc.stdout.decode()
+        if proc.returncode or (err and not text.strip()):
+            raise OcrError(err or f'{self.binary} exited with code {proc.returncode}')
+
+        if err:
+            # diagnostics next to a result: keep the text, but don't hide the message
+            metrics.inc('ocr_stderr_warnings', backend=self.name)
+            sys.stderr.write(f'WARN: {Path(image_path).name}: {err}\n')
+
+        return text
+
+    def cache_id(self) -> str:
+        return f'{super().cache_id()}:{self.binary}'
+
+
+class WorkerBackend(OcrBackend):
+    name = 'worker'
+    needs_file = False
+
+    def __init__(self, lang='zh', worker_cmd=None, processes=4, worker_backend='tesseract', delay=0.0, timeout=None):
+        super().__init__(lang, timeout)
+
+        if worker_cmd:
+            self.worker_cmd = shlex.split(worker_cmd)
+        else:
+            self.worker_cmd = [sys.executable, str(Path(__file__).with_name('ocr_worker.py')),
+                               '--backend', worker_backend, '--lang', lang]
+            if worker_backend == 'stub':
+                self.worker_cmd += ['--stub-delay', str(delay)]
+
+        self._idle = queue.Queue()
+        self._all = []
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+
+        for _ in range(processes):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        metrics.inc('ocr_process_spawns', backend=self.name)
+        proc = subprocess.Popen(self.worker_cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        self._all.append(proc)
+        return proc
+
+    def _request(self, header: dict, payload: bytes = b'') -> str:
+        with self._id_lock:
+            self._next_id += 1
+            header['id'] = self._next_id
+
+        proc = self._idle.get()
+        if proc.poll() is not None:
+            # died while idle: never hand a frame to a dead worker
+            self._all.remove(proc)
+            proc = self._spawn()
+
+        # a hung worker is killed, which ends the readline() below
+        timed_out = threading.Event()
+        answered = threading.Event()
+        watchdog_lock = threading.Lock()
+
+        def kill():
+            with watchdog_lock:
+                if answered.is_set():
+                    return
+                timed_out.set()
+            proc.kill()
+
+        watchdog = threading.Timer(self.timeout, kill) if self.timeout else None
+        try:
+            if watchdog:
+                watchdog.start()
+            proc.stdin.write(json.dumps(header).encode('utf-8') + b'\n' + payload)
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+
+            # disarm the watchdog before the worker can go back to the pool: Timer.cancel() does not
+            # stop a timer that is already firing
+            with watchdog_lock:
+                answered.set()
+
+            if not line:
+                if timed_out.is_set():
+                    raise OcrTimeout(f'OCR worker timed out after {self.timeout}s')
+                raise OcrError(f'OCR worker exited with code {proc.poll()}')
+        except (OSError, OcrError):
+            # replace the dead worker so the pool keeps its size
+            self._all.remove(proc)
+            proc.kill()
+            self._idle.put(self._spawn())
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+
+        if timed_out.is_set():
+            # killed just as it answered: keep the answer, but not the worker
+            self._all.remove(proc)
+            self._idle.put(self._spawn())
+        else:
+            self._idle.put(proc)
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise OcrError(response['error'])
+
+        return response['text']
+
+    def recognize_file(self, image_path) -> str:
+        return self._request({'path': str(Path(image_path).absolute())})
+
+    def recognize_array(self, gray) -> str:
+        gray = np.ascontiguousarray(gray, dtype=np.uint8)
+        height, width = gray.shape
+        return self._request({'width': width, 'height': height}, gray.tobytes())
+
+    def cache_id(self) -> str:
+        return f'{super().cache_id()}:{shlex.join(self.worker_cmd)}'
+
+    def close(self):
+        for proc in self._all:
+            proc.stdin.close()
+        for proc in self._all:
+            proc.wait()
+        self._all.clear()
+
+
+class TesseractBackend(OcrBackend):
+    name = 'tesseract'
+    needs_file = False
+
+    def __init__(self, lang='zh', timeout=None):
+        super().__init__(lang, timeout)
+
+        # pip install pytesseract pillow; plus the tesseract binary with the language data
+        import pytesseract
+        from PIL import Image
+
+        self._pytesseract = pytesseract
+        self._image = Image
+        self.tesseract_lang = TESSERACT_LANGUAGES.get(lang.lower(), lang)
+
+    def recognize_array(self, gray) -> str:
+        # --psm 6: a single uniform block of text, which is what a subtitle band is
+        try:
+            text = self._pytesseract.image_to_string(self._image.fromarray(gray), lang=self.tesseract_lang,
+                                                     config='--psm 6', timeout=self.timeout or 0)
+        except RuntimeError as e:
+            # on timeout pytesseract kills tesseract and raises a plain RuntimeError('Tesseract process timeout');
+            # its TesseractError (also a RuntimeError) is a real failure, e.g. missing language data
+            if str(e) == 'Tesseract process timeout':
+                raise OcrTimeout(f'tesseract timed out after {self.timeout}s')
+            raise OcrError(f'tesseract: {e}')
+        return text.strip()
+
+    def cache_id(self) -> str:
+        return f'{super().cache_id()}:{self.tesseract_lang}:psm6'
+
+    def recognize_file(self, image_path) -> str:
+        with self._image.open(image_path) as im:
+            return self.recognize_array(np.asarray(im.convert('L')))
+
+
+class StubBackend(OcrBackend):
+    """Deterministic fake OCR.
+
+    Frames rendered by the benchmark carry their ground truth in a `subtitle` PNG text chunk,
+    which is returned as is. Any other frame is blank if its gray levels are (nearly) flat,
+    otherwise it "reads" as a token derived from a hash of its downsampled pixels, so identical
+    frames always give identical text.
+    """
+    name = 'stub'
+    needs_file = False
+
+    def __init__(self, lang='zh', delay=0.0, timeout=None):
+        super().__init__(lang, timeout)
+        self.delay = delay
+
+    def _simulate(self):
+        if self.timeout and self.delay > self.timeout:
+            time.sleep(self.timeout)
+            raise OcrTimeout(f'stub OCR timed out after {self.timeout}s')
+        if self.delay:
+            time.sleep(self.delay)
+
+    def recognize_array(self, gray) -> str:
+        self._simulate()
+
+        if gray.std() < 8:
+            return ''
+
+        quantized = (gray[::4, ::4] // 64).astype(np.uint8)
+        return f'STUB-{hashlib.sha1(quantized.tobytes()).hexdigest()[:8]}'
+
+    def recognize_file(self, image_path) -> str:
+        from PIL import Image
+
+        with Image.open(image_path) as im:
+            if 'subtitle' in im.info:
+                self._simulate()
+                return im.info['subtitle']
+            return self.recognize_array(np.asarray(im.convert('L')))
+
+
+BACKENDS = {backend.name: backend for backend in (CliBackend, WorkerBackend, TesseractBackend, StubBackend)}
+
+
+def create_backend(name, lang='zh', binary=DEFAULT_OCR_BINARY, worker_cmd=None, processes=4,
+                   worker_backend='tesseract', delay=0.0, timeout=None) -> OcrBackend:
+    if name == 'cli':
+        return CliBackend(lang, binary=binary, timeout=timeout)
+    if name == 'worker':
+        return WorkerBackend(lang, worker_cmd=worker_cmd, processes=processes, worker_backend=worker_backend,
+                             delay=delay, timeout=timeout)
+    if name == 'tesseract':
+        return TesseractBackend(lang, timeout=timeout)
+    if name == 'stub':
+        return StubBackend(lang, delay=delay, timeout=timeout)
+
+    raise ValueError(f'Unknown OCR backend {name!r}; available: {", ".join(BACKENDS)}')
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Content-addressed OCR cache shared across videos and runs.
+#
+# Entries are keyed by a hash of the normalized (gray, uint8) cropped pixels plus the
+# identity of the OCR backend, language and options, and live in a single SQLite file.
+# The file is capped in size; the least recently used entries are evicted first.
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    # cache keys are computed from numpy frames -- pip install numpy
+    np = None
+
+DEFAULT_CACHE_FILE = Path.home() / '.cache' / 'subtitles-ocr' / 'ocr_cache.sqlite'
+
+
+def cache_key(gray, backend_id: str) -> str:
+    gray = np.ascontiguousarray(gray, dtype=np.uint8)
+
+    digest = hashlib.sha256(backend_id.encode('utf-8'))
+    digest.update(repr(gray.shape).encode('ascii'))
+    digest.update(gray.tobytes())
+
+    return digest.hexdigest()
+
+
+class OcrCache:
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_bytes=256 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS ocr_cache (
+                                key TEXT PRIMARY KEY,
+                                text TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_used REAL NOT NULL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)')
+
+        self._total_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM ocr_cache').fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT text FROM ocr_cache WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute('UPDATE ocr_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+
+            return row[0]
+
+    def put(self, key, text):
+        size = len(key) + len(text.encode('utf-8'))
+
+        with self._lock:
+            old = self._db.execute('SELECT size FROM ocr_cache WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO ocr_cache (key, text, size, last_used) VALUES (?, ?, ?, ?)',
+                             (key, text, size, time.time()))
+            self._total_bytes += size - (old[0] if old else 0)
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # evict down to 90% of the cap so that eviction does not run on every insert
+        target = self.max_bytes * 0.9
+        rows = self._db.execute('SELECT key, size FROM ocr_cache ORDER BY last_used')
+
+        victims = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            victims.append((key,))
+            self._total_bytes -= size
+
+        self._db.executemany('DELETE FROM ocr_cache WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def summary(self, seconds_per_ocr=None) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        text = (f'OCR cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), '
+                f'{self.evictions} evicted, {self._total_bytes / 1024:.0f} KiB in {self.path}')
+
+        if seconds_per_ocr:
+            text += f'; ~{self.hits * seconds_per_ocr:.1f}s of OCR saved'
+
+        return text
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Append-only journal for OCR results.
+#
+# do-ocr.py appends one JSON line per recognized frame instead of rewriting the whole
+# results JSON after every frame; lines are fsynced in batches. On resume the journal is
+# replayed on top of the last compacted results file, and a truncated last line left
+# behind by a crash is cut off. When OCR finishes the journal is compacted into the
+# plain `*_results.json` dictionary that gensrt.py reads.
+
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+
+def journal_path_for(results_file) -> Path:
+    # movie.mp4_results.json -> movie.mp4_results.journal.jsonl
+    results_path = Path(results_file)
+    return results_path.with_name(f'{results_path.stem}.journal.jsonl')
+
+
+class OcrJournal:
+
+    def __init__(self, results_file, fsync_every=50):
+        self.results_path = Path(results_file)
+        self.journal_path = journal_path_for(results_file)
+        self.fsync_every = fsync_every
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._fh = None
+
+    def load(self) -> dict:
+        """Return the compacted results merged with every complete record in the journal."""
+        ocr_dict = {}
+
+        if self.results_path.exists():
+            with self.results_path.open(encoding='utf-8') as f:
+                ocr_dict = json.load(f)
+
+        if not self.journal_path.exists():
+            return ocr_dict
+
+        good_offset = 0
+        replayed = 0
+
+        with self.journal_path.open('rb') as f:
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'):
+                    # torn write: the process died in the middle of this record
+                    break
+                try:
+                    record = json.loads(raw_line)
+                except ValueError:
+                    sys.stderr.write(f'WARN: skipping corrupt journal record at byte {good_offset}\n')
+                else:
+                    ocr_dict[record['key']] = record['text']
+                    replayed += 1
+                good_offset += len(raw_line)
+
+        if good_offset < self.journal_path.stat().st_size:
+            sys.stderr.write(f'WARN: dropping truncated last record of {self.journal_path}\n')
+            with self.journal_path.open('r+b') as f:
+                f.truncate(good_offset)
+
+        print(f'Replayed {replayed} journal records from {self.journal_path}')
+
+        return ocr_dict
+
+    def append(self, key, text):
+        line = json.dumps({'key': key, 'text': text}, ensure_ascii=False) + '\n'
+
+        with self._lock:
+            if self._fh is None:
+                self._fh = self.journal_path.open('ab')
+            self._fh.write(line.encode('utf-8'))
+            self._unsynced += 1
+
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        if self._fh is not None and self._unsynced:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def compact(self, ocr_dict: dict):
+        """Atomically write the full dictionary to the results file and drop the journal."""
+        self.close()
+
+        tmp_path = self.results_path.with_name(f'{self.results_path.name}.tmp')
+
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(ocr_dict, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.results_path)
+
+        # a crash before this point is harmless: replaying the journal on top of the
+        # freshly compacted results yields the same dictionary
+        self.journal_path.unlink(missing_ok=True)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+# Share the OCR of one film between processes and machines.
+#
+# do-ocr.py runs the coordinator: it groups the snapshots as usual and, instead of OCR'ing them
+# itself, serves one job per group over HTTP. Workers (this script, on any number of hosts) lease
+# jobs, download the representative snapshot, OCR it with their own backend and post the text
+# back; the coordinator writes it into the results journal, so gensrt.py and resuming work as
+# with a local run. A lease that is not renewed or completed in time (worker crashed, host gone)
+# expires and its job is handed out again; a job that fails --max-attempts times is given up and
+# left for the next run.
+#
+# Protocol (JSON bodies):
+#   POST /lease   {"worker": "host:pid", "max": 1}   -> {"jobs": [{"id": 7, "lease": "...", "frame": "0012"}],
+#                                                        "finished": false, "lease_seconds": 60}
+#   GET  /frame/<id>?lease=...                        -> PNG bytes of the snapshot to OCR
+#   POST /renew   {"id": 7, "lease": "..."}           -> extends the lease while OCR is still running
+#   POST /result  {"id": 7, "lease": "...", "text": "..."}
+#   POST /fail    {"id": 7, "lease": "...", "error": "..."}
+#   GET  /status                                      -> queue counters
+# A stale lease (the job was completed or handed to another worker) is answered with 409.
+
+# USAGE (one Linux box, stub OCR):
+# do-ocr.py video_img video_results.json --serve 127.0.0.1:8700
+# ocr_queue.py http://127.0.0.1:8700 --backend stub --threads 4      (start several, on any host)
+
+import argparse
+import collections
+import json
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+from instrumentation import metrics
+
+# seconds an idle worker waits before asking for work again
+WORKER_POLL_SECONDS = 1.0
+
+
+class JobQueue:
+
+    def __init__(self, lease_seconds=60.0, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self.payloads = {}
+        self.pending = collections.deque()
+        self.leases = {}          # job id -> (lease token, worker, deadline)
+        self.tokens = {}          # job id -> every lease token handed out for it
+        self.attempts = collections.Counter()
+        self.done = set()
+        self.failed = {}          # job id -> last error
+        self.expired = 0
+        self.storing = 0
+
+    def add(self, payload) -> int:
+        with self._lock:
+            job_id = len(self.payloads) + 1
+            self.payloads[job_id] = payload
+            self.pending.append(job_id)
+            return job_id
+
+    def _reap(self):
+        now = time.monotonic()
+        for job_id, (_, worker, deadline) in list(self.leases.items()):
+            if deadline < now:
+                # the worker vanished or hangs: hand the job to someone else
+                del self.leases[job_id]
+                self.pending.appendleft(job_id)
+                self.expired += 1
+                metrics.inc('ocr_leases_expired')
+                print(f'Lease of job {job_id} by {worker} expired: re-queued')
+
+    def lease(self, worker, count=1):
+        """[(job id, lease token, payload)] of up to `count` jobs."""
+        with self._lock:
+            self._reap()
+
+            jobs = []
+            while self.pending and len(jobs) < count:
+                job_id = self.pending.popleft()
+                token = secrets.token_hex(8)
+                self.leases[job_id] = (token, worker, time.monotonic() + self.lease_seconds)
+                self.tokens.setdefault(job_id, set()).add(token)
+                jobs.append((job_id, token, self.payloads[job_id]))
+
+            metrics.gauge('ocr_jobs_leased', len(self.leases))
+            return jobs
+
+    def renew(self, job_id, token) -> bool:
+        with self._lock:
+            lease = self.leases.get(job_id)
+            if not lease or lease[0] != token:
+                return False
+            self.leases[job_id] = (token, lease[1], time.monotonic() + self.lease_seconds)
+            return True
+
+    def is_valid(self, job_id, token) -> bool:
+        with self._lock:
+            return job_id not in self.done and token in self.tokens.get(job_id, ())
+
+    def complete(self, job_id, token, store) -> bool:
+        """Call store(payload) for the first result of a job; False if the job is already done or the lease unknown."""
+        with self._lock:
+            if job_id in self.done or token not in self.tokens.get(job_id, ()):
+                return False
+
+            # an expired lease may still deliver first: the OCR is the same whoever runs it
+            self.done.add(job_id)
+            self.leases.pop(job_id, None)
+            if job_id in self.pending:
+                self.pending.remove(job_id)
+            self.storing += 1
+
+        try:
+            store(self.payloads[job_id])
+        finally:
+            with self._lock:
+                # the queue only counts as finished once every result is stored
+                self.storing -= 1
+                self._notify()
+
+        return True
+
+    def fail(self, job_id, token, error) -> bool:
+        with self._lock:
+            lease = self.leases.get(job_id)
+            if not lease or lease[0] != token:
+                return False
+
+            del self.leases[job_id]
+            self.attempts[job_id] += 1
+            if self.attempts[job_id] >= self.max_attempts:
+                self.failed[job_id] = error
+                print(f'Job {job_id} failed {self.attempts[job_id]} times, giving up: {error}')
+            else:
+                self.pending.append(job_id)
+            self._notify()
+            return True
+
+    def _notify(self):
+        if self._is_finished():
+            self._finished.notify_all()
+
+    def _is_finished(self):
+        return not self.pending and not self.leases and not self.storing
+
+    def is_finished(self) -> bool:
+        with self._lock:
+            self._reap()
+            return self._is_finished()
+
+    def wait(self, poll=1.0):
+        with self._lock:
+            while True:
+                self._reap()
+                if self._is_finished():
+                    return
+                # wake up now and then to expire leases even if no worker calls in
+                self._finished.wait(poll)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'jobs': len(self.payloads), 'pending': len(self.pending), 'leased': len(self.leases),
+                    'done': len(self.done), 'failed': len(self.failed), 'expired_leases': self.expired}
+
+
+def make_handler(jobs: JobQueue, frame_path, on_result):
+    """frame_path(payload) -> path of the PNG to OCR; on_result(payload, text) stores a result."""
+
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=None, content_type='application/json'):
+            payload = body if isinstance(body, bytes) else json.dumps(body or {}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == '/status':
+                self.reply(200, jobs.status())
+                return
+
+            if path.startswith('/frame/'):
+                job_id = int(path[len('/frame/'):])
+                token = dict(part.split('=', 1) for part in query.split('&') if '=' in part).get('lease')
+                if not jobs.is_valid(job_id, token):
+                    self.reply(409, {'error': 'stale lease'})
+                    return
+                self.reply(200, Path(frame_path(jobs.payloads[job_id])).read_bytes(), 'image/png')
+                return
+
+            self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+            if self.path == '/lease':
+                leased = jobs.lease(request.get('worker', self.client_address[0]), request.get('max', 1))
+                self.reply(200, {'jobs': [{'id': job_id, 'lease': token, 'frame': Path(frame_path(payload)).stem}
+                                          for job_id, token, payload in leased],
+                                 'finished': not leased and jobs.is_finished(),
+                                 'lease_seconds': jobs.lease_seconds})
+            elif self.path == '/renew':
+                self.reply(200 if jobs.renew(request['id'], request['lease']) else 409)
+            elif self.path == '/result':
+                stored = jobs.complete(request['id'], request['lease'], lambda payload: on_result(payload, request['text']))
+                self.reply(200 if stored else 409)
+            elif self.path == '/fail':
+                metrics.inc('ocr_errors', backend='remote')
+                print(f"😱 job {request['id']}: {request.get('error')}")
+                self.reply(200 if jobs.fail(request['id'], request['lease'], request.get('error')) else 409)
+            else:
+                self.reply(404, {'error': 'not found'})
+
+    return CoordinatorHandler
+
+
+def parse_address(value: str):
+    host, _, port = value.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def run_coordinator(jobs: JobQueue, address, frame_path, on_result):
+    """Serve jobs until every one of them is done or given up."""
+    server = ThreadingHTTPServer(parse_address(address), make_handler(jobs, frame_path, on_result))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    host, port = server.server_address[:2]
+    print(f'Serving {len(jobs.payloads)} OCR jobs on http://{host}:{port} -- start workers with: '
+          f'ocr_queue.py http://{socket.gethostname()}:{port} --backend ...')
+    try:
+        jobs.wait()
+        # let polling workers see that there is nothing left before going away
+        time.sleep(WORKER_POLL_SECONDS * 2)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    status = jobs.status()
+    print(f"Queue: {status['done']} of {status['jobs']} jobs done, {status['failed']} failed, "
+          f"{status['expired_leases']} expired leases re-queued")
+
+
+class Worker:
+
+    def __init__(self, url, backend, name=None, retries=5, timeout=60.0):
+        self.url = url.rstrip('/')
+        self.backend = backend
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.retries = retries
+        self.timeout = timeout
+
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.lease_seconds = None
+        self.done = 0
+        self.failed = 0
+        self.error = None
+
+    def call(self, path, body=None):
+        """(status, response bytes); retries connection errors, gives up after `retries` attempts."""
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+
+        for attempt in range(self.retries):
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return response.status, response.read()
+            except urllib.error.HTTPError as e:
+                return e.code, e.read()
+            except (urllib.error.URLError, OSError) as e:
+                if attempt + 1 == self.retries:
+                    raise
+                metrics.inc('http_retries')
+                time.sleep(min(2 ** attempt, 10))
+
+    def renew_leases(self):
+        # keep the leases of slow OCR calls alive
+        while not self.stopping.wait((self.lease_seconds or 30) / 3):
+            with self._lock:
+                leases = list(self.in_flight.items())
+            for job_id, token in leases:
+                try:
+                    self.call('/renew', {'id': job_id, 'lease': token})
+                except OSError:
+                    pass
+
+    def run_job(self, job, scratch_dir: Path):
+        job_id, token = job['id'], job['lease']
+        with self._lock:
+            self.in_flight[job_id] = token
+
+        try:
+            status, png = self.call(f'/frame/{job_id}?lease={token}')
+            if status != 200:
+                return
+
+            # keep the snapshot name: file-based backends may read more than the pixels
+            image = scratch_dir / f"{job['frame']}.png"
+            image.write_bytes(png)
+            try:
+                started = time.perf_counter()
+                text = self.backend.recognize_file(image)
+                metrics.observe('ocr_frame_seconds', time.perf_counter() - started, backend=self.backend.name)
+            except Exception as e:
+                self.failed += 1
+                self.call('/fail', {'id': job_id, 'lease': token, 'error': str(e)})
+                print(f"😱 {job['frame']}: {e}")
+                return
+            finally:
+                image.unlink(missing_ok=True)
+
+            status, _ = self.call('/result', {'id': job_id, 'lease': token, 'text': text})
+            if status == 200:
+                self.done += 1
+                print(job['frame'], text)
+            else:
+                print(f"{job['frame']}: result discarded, the job was done by another worker")
+        finally:
+            with self._lock:
+                self.in_flight.pop(job_id, None)
+
+    def run_thread(self, scratch_dir: Path):
+        try:
+            self.lease_loop(scratch_dir)
+        except OSError as e:
+            self.error = e
+            self.stopping.set()
+
+    def lease_loop(self, scratch_dir: Path):
+        while not self.stopping.is_set():
+            status, body = self.call('/lease', {'worker': self.name, 'max': 1})
+            response = json.loads(body)
+            self.lease_seconds = response.get('lease_seconds', self.lease_seconds)
+
+            if response['jobs']:
+                for job in response['jobs']:
+                    self.run_job(job, scratch_dir)
+            elif response['finished']:
+                return
+            else:
+                # everything left is leased by other workers: one of them may still fail or vanish
+                time.sleep(WORKER_POLL_SECONDS)
+
+    def run(self, threads=1):
+        renewer = threading.Thread(target=self.renew_leases, daemon=True)
+        renewer.start()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            workers = [threading.Thread(target=self.run_thread, args=(Path(tmp),)) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+
+        self.stopping.set()
+        if self.error:
+            raise self.error
+
+
+if __name__ == '__main__':
+
+    from ocr_backends import BACKENDS
+    from ocr_backends import DEFAULT_OCR_BINARY
+    from ocr_backends import create_backend
+
+    import instrumentation
+
+    parser = argparse.ArgumentParser(description='OCR worker for a do-ocr.py --serve coordinator')
+    parser.add_argument('url',
+                        help='coordinator URL, e.g. http://192.168.1.10:8700')
+    parser.add_argument('--backend', '-b',
+                        default='cli',
+                        choices=[name for name in BACKENDS if name != 'worker'],
+                        help='OCR backend used by this worker (see do-ocr.py)')
+    parser.add_argument('--lang', '-l',
+                        default='zh',
+                        help='OCR language')
+    parser.add_argument('--ocr-binary',
+                        default=DEFAULT_OCR_BINARY,
+                        help='cli backend only: path to the macOCR binary')
+    parser.add_argument('--stub-delay',
+                        default=0.0,
+                        type=float,
+                        help='stub backend only: simulated seconds of OCR per frame')
+    parser.add_argument('--ocr-timeout',
+                        default=60.0,
+                        type=float,
+                        help='seconds one OCR call may take; a hung OCR process is killed and the job reported as '
+                             'failed (0 = no limit)')
+    parser.add_argument('--threads', '-t',
+                        default=4,
+                        type=int,
+                        help='jobs OCR\'ed at the same time by this worker')
+    parser.add_argument('--name',
+                        default=None,
+                        help='worker name shown by the coordinator (default: host:pid)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    backend = create_backend(args.backend, lang=args.lang, binary=args.ocr_binary, delay=args.stub_delay,
+                             timeout=args.ocr_timeout or None)
+    worker = Worker(args.url, backend, name=args.name)
+
+    with instrumentation.session(args):
+        try:
+            worker.run(args.threads)
+        except OSError as e:
+            sys.exit(f'ERROR: coordinator {args.url} unreachable: {e}')
+        finally:
+            backend.close()
+
+        print(f'Worker {worker.name}: {worker.done} frames OCR\'ed, {worker.failed} failed')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Adaptive cap on the number of OCR calls in flight, used by do-ocr.py --adaptive.
+#
+# The thread pool is sized for the maximum; every OCR call first takes a slot from this limit.
+# After each window (a few seconds, and at least one call per slot) the limit is adjusted:
+#   timeouts/errors in the window, or load average per CPU above --max-load
+#       -> multiplicative decrease (x0.75, at least -1)
+#   the last increase made throughput (frames/s) drop
+#       -> step back by one: past the peak, more parallel OCR processes only contend
+#   otherwise, if calls had to wait for a slot
+#       -> additive increase (+1)
+# so the limit climbs to where throughput stops improving and backs off when OCR calls start
+# to hang or the machine is overloaded.
+
+import contextlib
+import os
+import threading
+import time
+
+from instrumentation import metrics
+from ocr_backends import OcrError
+
+DECREASE_FACTOR = 0.75
+
+# a throughput drop below this fraction of the previous window counts as a drop
+RATE_TOLERANCE = 0.95
+
+
+class AdaptiveLimit:
+
+    def __init__(self, initial, minimum=1, maximum=64, window=3.0, max_load=None, adaptive=True):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.window = window
+        self.max_load = max_load
+        self.adaptive = adaptive
+
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.peak = self.limit
+
+        self._window_started = time.perf_counter()
+        self._completed = 0
+        self._failures = 0
+        self._waited = False
+        self._previous_rate = None
+        self._last_change = 0
+        self.history = [self.limit]
+
+        metrics.gauge('ocr_concurrency_limit', self.limit)
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._waited = True
+                self._cond.wait()
+            self.in_flight += 1
+
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                if ok:
+                    self._completed += 1
+                else:
+                    self._failures += 1
+                self._adjust()
+                self._cond.notify_all()
+
+    def _load(self):
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0.0
+
+    def _adjust(self):
+        # called with the lock held
+        elapsed = time.perf_counter() - self._window_started
+        if not self.adaptive or elapsed < self.window or self._completed + self._failures < self.limit:
+            return
+
+        rate = self._completed / elapsed
+        overloaded = self.max_load and self._load() > self.max_load
+
+        if self._failures or overloaded:
+            limit = min(self.limit - 1, int(self.limit * DECREASE_FACTOR))
+        elif self._previous_rate is not None and self._last_change > 0 and rate < self._previous_rate * RATE_TOLERANCE:
+            limit = self.limit - 1
+        elif self._waited:
+            limit = self.limit + 1
+        else:
+            limit = self.limit
+        limit = max(self.minimum, min(limit, self.maximum))
+
+        metrics.gauge('ocr_frames_per_second', rate)
+        self._last_change = limit - self.limit
+        self._previous_rate = rate
+        self.limit = limit
+        self.peak = max(self.peak, limit)
+        if self._last_change:
+            self.history.append(limit)
+        metrics.gauge('ocr_concurrency_limit', limit)
+
+        self._window_started = time.perf_counter()
+        self._completed = self._failures = 0
+        self._waited = False
+
+    def summary(self) -> str:
+        steps = ' -> '.join(str(limit) for limit in self.history[-12:])
+        return f'Concurrency: limit {self.limit} (peak {self.peak}, range {self.minimum}..{self.maximum}); last steps: {steps}'
+
+
+class RetryPolicy:
+    """Bounded retries with exponential backoff for OcrError (timeouts included)."""
+
+    def __init__(self, retries=2, backoff=0.5):
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(self, fn, on_error=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn()
+            except OcrError as e:
+                if on_error:
+                    on_error(e, attempt)
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
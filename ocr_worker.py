@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Long-lived OCR worker: the server side of the line protocol described in ocr_backends.py.
+#
+# The OCR engine is loaded once and then serves requests from stdin until it is closed, so
+# do-ocr.py --backend worker pays process start and model load once per worker instead of
+# once per frame.
+
+# USAGE (normally spawned by do-ocr.py):
+# ocr_worker.py --backend tesseract --lang zh
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from ocr_backends import create_backend
+
+
+def serve(backend, stdin, stdout):
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+
+        request = json.loads(line)
+        response = {'id': request.get('id')}
+
+        try:
+            if 'path' in request:
+                response['text'] = backend.recognize_file(request['path'])
+            else:
+                width, height = request['width'], request['height']
+                raw = stdin.read(width * height)
+                gray = np.frombuffer(raw, dtype=np.uint8).reshape(height, width)
+                response['text'] = backend.recognize_array(gray)
+        except Exception as e:
+            response['error'] = f'{type(e).__name__}: {e}'
+
+        stdout.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Persistent OCR worker (stdin/stdout JSON line protocol)')
+    parser.add_argument('--backend', '-b',
+                        default='tesseract',
+                        choices=('tesseract', 'stub'),
+                        help='in-process OCR backend to serve')
+    parser.add_argument('--lang', '-l',
+                        default='zh',
+                        help='OCR language')
+    parser.add_argument('--stub-delay',
+                        default=0.0,
+                        type=float,
+                        help='stub backend only: simulated seconds per frame')
+    args = parser.parse_args(sys.argv[1:])
+
+    with create_backend(args.backend, lang=args.lang, delay=args.stub_delay) as ocr_backend:
+        serve(ocr_backend, sys.stdin.buffer, sys.stdout.buffer)
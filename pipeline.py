@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+
+# Non-interactive pipeline runner: the do-all.sh workflow as a DAG of cached stages.
+#
+#   crop -> snapshot -> ocr -> gensrt -> normalize -> pinyin ----> merge
+#                                                  \-> translate -/
+#
+# Every stage records a fingerprint of its command line (all parameters) and of the content
+# of its inputs in <video>.pipeline.json. A stage is skipped when its fingerprint is unchanged
+# and its outputs are still the ones it wrote; otherwise it is re-run from scratch.
+# Independent branches (pinyin and translate) run concurrently.
+#
+# Several videos (or folders of videos) can be given at once: their stages share one scheduler
+# with separate limits for ffmpeg decoding, OCR, network translation and the remaining CPU work,
+# so that one video's OCR overlaps with the next video's decoding without oversubscribing the box.
+# All concurrently running OCR stages share one global budget of OCR threads.
+
+# USAGE:
+# pipeline.py video.mp4
+# pipeline.py video.mp4 --crop 1738:115:100:965
+# pipeline.py video.mp4 --skip translate --force ocr
+# pipeline.py season1/ --ocr-jobs 2 --ocr-threads 16
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from collections import Counter
+from pathlib import Path
+
+from ocr_journal import journal_path_for
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+STAGES = ('crop', 'snapshot', 'ocr', 'gensrt', 'normalize', 'pinyin', 'translate', 'merge')
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm', '.ts', '.m4v')
+
+
+def python_script(name):
+    return [sys.executable, str(SCRIPT_DIR / name)]
+
+
+class Stage:
+
+    def __init__(self, name, command, inputs, outputs, deps=(), clean=(), mkdir=(), resource='cpu', tuning=(),
+                 resumable=False):
+        self.name = name
+        self.command = [str(arg) for arg in command]
+        # arguments that only affect speed, not output: not part of the fingerprint
+        self.tuning = [str(arg) for arg in tuning]
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.deps = list(deps)
+        # files/folders removed before the stage re-runs (stale results it would otherwise resume from)
+        self.clean = [Path(path) for path in clean]
+        self.mkdir = [Path(path) for path in mkdir]
+        self.resource = resource
+        # an interrupted run with the same fingerprint continues from its own checkpoint instead of starting over
+        self.resumable = resumable
+
+
+class StateFile:
+    """Per-video record of stage fingerprints and output digests."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.data = {'stages': {}, 'digests': {}, 'running': {}}
+
+        if self.path.exists():
+            self.data.update(json.loads(self.path.read_text(encoding='utf-8')))
+
+    def digest(self, path: Path) -> str:
+        if not path.exists():
+            return 'missing'
+
+        if path.is_dir():
+            # snapshot folders hold thousands of files: their listing stands in for their content
+            h = hashlib.sha256()
+            for child in sorted(path.rglob('*')):
+                if child.is_file():
+                    stat = child.stat()
+                    h.update(f'{child.relative_to(path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+            return h.hexdigest()
+
+        # content hash, memoized by (size, mtime) so multi-GB videos are only hashed once
+        stat = path.stat()
+        key = str(path.absolute())
+        with self._lock:
+            cached = self.data['digests'].get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        h = hashlib.sha256()
+        with path.open('rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+
+        with self._lock:
+            self.data['digests'][key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+
+        return h.hexdigest()
+
+    def fingerprint(self, stage: Stage) -> str:
+        h = hashlib.sha256(json.dumps(stage.command).encode('utf-8'))
+        for path in stage.inputs:
+            h.update(f'{path}:{self.digest(path)}\n'.encode('utf-8'))
+        return h.hexdigest()
+
+    def is_fresh(self, stage: Stage, fingerprint: str) -> bool:
+        with self._lock:
+            recorded = self.data['stages'].get(stage.name)
+
+        if not recorded or recorded['fingerprint'] != fingerprint:
+            return False
+
+        return all(recorded['outputs'].get(str(path)) == self.digest(path) for path in stage.outputs)
+
+    def was_interrupted(self, stage: Stage, fingerprint: str) -> bool:
+        with self._lock:
+            return self.data['running'].get(stage.name) == fingerprint
+
+    def start(self, stage: Stage, fingerprint: str):
+        with self._lock:
+            self.data['stages'].pop(stage.name, None)
+            self.data['running'][stage.name] = fingerprint
+            self.save()
+
+    def record(self, stage: Stage, fingerprint: str):
+        outputs = {str(path): self.digest(path) for path in stage.outputs}
+
+        with self._lock:
+            self.data['running'].pop(stage.name, None)
+            self.data['stages'][stage.name] = {'fingerprint': fingerprint, 'outputs': outputs, 'finished': time.time()}
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        tmp.write_text(json.dumps(self.data, indent=1), encoding='utf-8')
+        tmp.replace(self.path)
+
+
+def build_stages(args, video: Path, ocr_threads=20):
+    base = str(video)
+    cropped = Path(f'{base}_video-cropped.mp4')
+    img_dir = Path(f'{base}_img')
+    results = Path(f'{base}_results.json')
+    raw_srt = Path(f'{base}.ocr.raw.srt')
+    ocr_srt = Path(f'{base}.ocr.srt')
+    pinyin_srt = Path(f'{base}.ocr.pinyin.srt')
+    source_lang, target_lang = args.lang_pair.split(':')
+    translated_srt = Path(f'{base}.ocr.{target_lang}.srt')
+    merged_srt = Path(f'{base}.ocr.merged.srt')
+
+    if args.crop == 'auto':
+        crop_cmd = python_script('autocrop.py') + [video, '--output', cropped, '--fallback', args.crop_fallback]
+    else:
+        crop_cmd = ['ffmpeg', '-y', '-v', 'error', '-i', video, '-filter:v', f'crop={args.crop}', '-c:a', 'copy', cropped]
+
+    stages = [
+        Stage('crop', crop_cmd, inputs=[video], outputs=[cropped], resource='decode'),
+    ]
+
+    ocr_args = args.ocr_args.split() if args.ocr_args else []
+    ocr_tuning = ['--threads', ocr_threads]
+    # a fresh (not resumed) OCR run must not replay the journal or rerun the failed list of another crop
+    ocr_clean = [results, journal_path_for(results), results.with_name(f'{results.stem}.failed.json')]
+
+    if args.snapshots == 'stream':
+        # frames are piped from ffmpeg straight into the OCR workers: no snapshot stage
+        stages.append(Stage('ocr',
+                            python_script('do-ocr.py') + [cropped, results, '--fps', args.fps] + ocr_args,
+                            inputs=[cropped], outputs=[results], deps=['crop'], clean=ocr_clean,
+                            resource='ocr', tuning=ocr_tuning, resumable=True))
+    else:
+        if args.snapshots == 'adaptive':
+            snapshot_cmd = python_script('adaptive_sample.py') + [cropped, img_dir, '--interval', 1 / args.fps]
+        else:
+            snapshot_cmd = ['ffmpeg', '-v', 'error', '-i', cropped, '-start_number', '1', '-vf', f'fps={args.fps}',
+                            '-q:v', '2', img_dir / 'snap_%04d.png']
+
+        stages.append(Stage('snapshot', snapshot_cmd,
+                            inputs=[cropped], outputs=[img_dir], deps=['crop'], clean=[img_dir], mkdir=[img_dir],
+                            resource='decode'))
+        stages.append(Stage('ocr',
+                            python_script('do-ocr.py') + [img_dir, results] + ocr_args,
+                            inputs=[img_dir], outputs=[results], deps=['snapshot'], clean=ocr_clean,
+                            resource='ocr', tuning=ocr_tuning, resumable=True))
+
+    stages += [
+        Stage('gensrt',
+              python_script('gensrt.py') + [results, raw_srt, '--fps', args.fps],
+              inputs=[results], outputs=[raw_srt], deps=['ocr']),
+        Stage('normalize',
+              ['srt-normalise', '-i', raw_srt, '-o', ocr_srt],
+              inputs=[raw_srt], outputs=[ocr_srt], deps=['gensrt']),
+        Stage('pinyin',
+              python_script('srt_subs_zh2pinyin.py') + [ocr_srt, '--force-normalize-input-to-simplified', '-t',
+                                                         '-o', pinyin_srt],
+              inputs=[ocr_srt], outputs=[pinyin_srt], deps=['normalize']),
+        Stage('translate',
+              python_script('deepl.py') + [args.lang_pair, ocr_srt, '--srt', '-o', translated_srt] +
+              (args.deepl_args.split() if args.deepl_args else []),
+              inputs=[ocr_srt], outputs=[translated_srt], deps=['normalize'], resource='network'),
+        Stage('merge',
+              python_script('srt_merge.py') + [pinyin_srt, translated_srt, '-o', merged_srt],
+              inputs=[pinyin_srt, translated_srt], outputs=[merged_srt], deps=['pinyin', 'translate']),
+    ]
+
+    return stages
+
+
+class Pipeline:
+    """The stages of one video; checkpointed in its own <video>.pipeline.json."""
+
+    def __init__(self, video, stages, force=(), skip=(), dry_run=False):
+        self.video = Path(video)
+        self.state = StateFile(f'{video}.pipeline.json')
+        self.stages = {stage.name: stage for stage in stages}
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.results = {}
+        self.running = set()
+
+        # skipping a stage also skips everything that depends on it
+        self.skipped = set()
+        for stage in stages:
+            if stage.name in skip or any(dep in self.skipped for dep in stage.deps):
+                self.skipped.add(stage.name)
+
+    def log(self, stage, message):
+        print(f'[{self.video.name}] {stage.name:<10} {message}', flush=True)
+
+    def run_stage(self, stage: Stage) -> str:
+        fingerprint = self.state.fingerprint(stage)
+
+        if stage.name not in self.force and 'all' not in self.force and self.state.is_fresh(stage, fingerprint):
+            self.log(stage, 'up to date, skipping')
+            return 'cached'
+
+        self.log(stage, ' '.join(stage.command + stage.tuning))
+        if self.dry_run:
+            return 'dry-run'
+
+        if stage.resumable and stage.name not in self.force and self.state.was_interrupted(stage, fingerprint):
+            self.log(stage, 'resuming interrupted run')
+        else:
+            for path in stage.clean:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+
+        for path in stage.mkdir:
+            path.mkdir(parents=True, exist_ok=True)
+
+        self.state.start(stage, fingerprint)
+        started = time.perf_counter()
+        subprocess.run(stage.command + stage.tuning, check=True)
+        self.state.record(stage, fingerprint)
+        self.log(stage, f'done in {time.perf_counter() - started:.1f}s')
+
+        return 'ran'
+
+    def ready(self):
+        """Stages whose dependencies have all finished successfully and that have not started yet."""
+        return [stage for name, stage in self.stages.items()
+                if name not in self.results and name not in self.skipped and name not in self.running
+                and all(self.results.get(dep) in ('ran', 'cached', 'dry-run') for dep in stage.deps)]
+
+    def fail_blocked(self):
+        for name, stage in self.stages.items():
+            if name not in self.results and name not in self.skipped \
+                    and any(self.results.get(dep) == 'failed' for dep in stage.deps):
+                self.results[name] = 'failed'
+                self.log(stage, 'not run: a dependency failed')
+
+    def finish(self, name, future):
+        self.running.discard(name)
+        try:
+            self.results[name] = future.result()
+        except Exception as e:
+            self.results[name] = 'failed'
+            self.log(self.stages[name], f'FAILED: {e}')
+
+    def ok(self) -> bool:
+        return 'failed' not in self.results.values()
+
+
+class Scheduler:
+    """Runs the stages of many pipelines, with at most limits[resource] stages of each resource at a time."""
+
+    def __init__(self, pipelines, limits: dict):
+        self.pipelines = pipelines
+        self.limits = limits
+
+    def run(self, executor) -> bool:
+        running = {}
+        busy = Counter()
+
+        while True:
+            # earlier videos get free slots first, so that videos finish one after another instead of all at the end
+            for pipeline in self.pipelines:
+                pipeline.fail_blocked()
+
+                for stage in pipeline.ready():
+                    if busy[stage.resource] < self.limits[stage.resource]:
+                        busy[stage.resource] += 1
+                        pipeline.running.add(stage.name)
+                        running[executor.submit(pipeline.run_stage, stage)] = pipeline, stage
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pipeline, stage = running.pop(future)
+                busy[stage.resource] -= 1
+                pipeline.finish(stage.name, future)
+
+        for pipeline in self.pipelines:
+            for name in pipeline.skipped:
+                pipeline.results[name] = 'skipped'
+
+        return all(pipeline.ok() for pipeline in self.pipelines)
+
+
+def find_videos(paths):
+    videos = []
+
+    for path in map(Path, paths):
+        if path.is_dir():
+            videos += sorted(child for child in path.iterdir()
+                             if child.suffix.lower() in VIDEO_EXTENSIONS and not child.name.endswith('_video-cropped.mp4'))
+        else:
+            videos.append(path)
+
+    return videos
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the subtitle OCR pipeline unattended, skipping unchanged stages',
+                                     usage="""
+    Run everything, re-running only the stages whose inputs or parameters changed:
+    \t{0} video.mp4
+    \t{0} video.mp4 --crop 1738:115:100:965
+ """.format(Path(sys.argv[0]).name))
+
+    parser.add_argument('videos',
+                        nargs='+',
+                        help='input videos with hard-burned subtitles, or folders containing them')
+    parser.add_argument('--crop',
+                        default='auto',
+                        help='subtitle area as ffmpeg crop geometry W:H:X:Y, or auto = detect it with autocrop.py')
+    parser.add_argument('--crop-fallback',
+                        default='1738:115:100:965',
+                        help='crop geometry used when --crop auto finds no subtitle band')
+    parser.add_argument('--fps',
+                        default=1.0,
+                        type=float,
+                        help='snapshots per second (coarse rate for --snapshots adaptive)')
+    parser.add_argument('--snapshots',
+                        default='fps',
+                        choices=('fps', 'adaptive', 'stream'),
+                        help='fps = fixed-rate PNG snapshots, adaptive = boundary-seeking sampler, '
+                             'stream = no snapshots, OCR reads frames from ffmpeg')
+    parser.add_argument('--ocr-args',
+                        default='',
+                        help='extra arguments for do-ocr.py, e.g. "--backend worker"')
+    parser.add_argument('--lang-pair',
+                        default='zh:en',
+                        help='<source:target> language codes for deepl.py')
+    parser.add_argument('--deepl-args',
+                        default='',
+                        help='extra arguments for deepl.py')
+    parser.add_argument('--skip',
+                        action='append',
+                        default=[],
+                        choices=STAGES,
+                        help='do not run this stage (nor anything depending on it); repeatable')
+    parser.add_argument('--force',
+                        action='append',
+                        default=[],
+                        choices=STAGES + ('all',),
+                        help='re-run this stage even if it is up to date; repeatable')
+    parser.add_argument('--decode-jobs',
+                        default=2,
+                        type=int,
+                        help='ffmpeg crop/snapshot stages allowed to run at the same time')
+    parser.add_argument('--ocr-jobs',
+                        default=1,
+                        type=int,
+                        help='OCR stages (videos) allowed to run at the same time')
+    parser.add_argument('--ocr-threads',
+                        default=20,
+                        type=int,
+                        help='global OCR thread budget, split evenly between the concurrent OCR stages')
+    parser.add_argument('--network-jobs',
+                        default=2,
+                        type=int,
+                        help='translation stages allowed to run at the same time')
+    parser.add_argument('--cpu-jobs',
+                        default=os.cpu_count() or 2,
+                        type=int,
+                        help='other stages (gensrt, normalize, pinyin, merge) allowed to run at the same time')
+    parser.add_argument('--dry-run', '-n',
+                        action='store_true',
+                        default=False,
+                        help='only print what would run')
+    args = parser.parse_args(sys.argv[1:])
+
+    limits = dict(decode=args.decode_jobs, ocr=args.ocr_jobs, network=args.network_jobs, cpu=args.cpu_jobs)
+    ocr_threads = max(1, args.ocr_threads // args.ocr_jobs)
+
+    pipelines = [Pipeline(video, build_stages(args, video, ocr_threads), force=args.force, skip=args.skip,
+                          dry_run=args.dry_run)
+                 for video in find_videos(args.videos)]
+
+    scheduler = Scheduler(pipelines, limits)
+    with ThreadPoolExecutor(max_workers=sum(limits.values())) as executor:
+        ok = scheduler.run(executor)
+
+    for pipeline in pipelines:
+        print(f'{pipeline.video}:')
+        for name in pipeline.stages:
+            print(f'    {name:<10} {pipeline.results.get(name)}')
+
+    sys.exit(0 if ok else 1)
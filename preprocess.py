@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Clean up cropped subtitle frames before OCR.
+#
+#   grayscale -> threshold (Otsu, or a fixed level) to isolate the glyphs from the background video
+#             -> drop isolated specks -> trim the empty margins -> downscale to a target glyph height
+#
+# The result is a small binary image, dark text on white, which is what OCR engines read best.
+# Because background video and compression noise are thresholded away, the normalized buffer of
+# the same subtitle is (nearly always) byte-identical from frame to frame, so its hash doubles as
+# the OCR cache key and as an exact dedup key.
+
+# DEPENDENCIES:
+# pip install -U numpy pillow
+
+# USAGE (preview what the OCR engine will get):
+# preprocess.py video_img/snap_0001.png preview.png --glyph-height 32
+
+import argparse
+import sys
+
+import numpy as np
+
+from frame_signature import block_mean
+
+# blank frames still get a (tiny) image so that every backend sees a valid input
+BLANK_SIZE = 8
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * levels)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+
+    # maximize the between-class variance
+    return int(np.argmax(weight_bg * weight_fg * (mean_bg - mean_fg) ** 2))
+
+
+def despeckle(ink: np.ndarray, min_neighbours=2) -> np.ndarray:
+    padded = np.pad(ink, 1).astype(np.uint8)
+    height, width = ink.shape
+    neighbours = sum(padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+                     for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx)
+    return ink & (neighbours >= min_neighbours)
+
+
+def glyph_height(ink: np.ndarray) -> int:
+    # the longest run of inked rows: one text line, also for two-line subtitles
+    rows = np.concatenate(([0], ink.any(axis=1).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(rows))
+    return int((edges[1::2] - edges[0::2]).max()) if len(edges) else 0
+
+
+def preprocess(gray: np.ndarray, threshold=None, text_color='light', glyph_target=32, margin=4) -> np.ndarray:
+    """Normalized binary uint8 image (0 = ink, 255 = paper) of a gray subtitle frame."""
+    if text_color == 'dark':
+        gray = 255 - gray
+
+    # light subtitles: never let Otsu settle on a level inside the darker background video
+    level = threshold if threshold is not None else max(128, min(otsu_threshold(gray), 240))
+    ink = despeckle(gray > level)
+
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        return np.full((BLANK_SIZE, BLANK_SIZE), 255, dtype=np.uint8)
+
+    ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+    height = glyph_height(ink)
+    if glyph_target and height > glyph_target:
+        scale = glyph_target / height
+        out_rows = max(1, round(ink.shape[0] * scale))
+        out_cols = max(1, round(ink.shape[1] * scale))
+        # area averaging, then back to binary so that the buffer stays stable
+        ink = block_mean(ink, out_rows, out_cols) >= 0.5
+
+    ink = np.pad(ink, margin)
+    return np.where(ink, 0, 255).astype(np.uint8)
+
+
+if __name__ == '__main__':
+
+    from PIL import Image
+
+    from frame_signature import load_gray
+
+    parser = argparse.ArgumentParser(description='Preview the preprocessed image an OCR engine gets for a snapshot')
+    parser.add_argument('image',
+                        help='cropped subtitle snapshot')
+    parser.add_argument('output',
+                        help='preprocessed PNG')
+    parser.add_argument('--threshold',
+                        default=None,
+                        type=int,
+                        help='fixed gray level (0..255) separating glyphs from background (default: Otsu)')
+    parser.add_argument('--text-color',
+                        default='light',
+                        choices=('light', 'dark'))
+    parser.add_argument('--glyph-height',
+                        default=32,
+                        type=int,
+                        help='downscale until a text line is at most this many pixels high (0 = keep size)')
+    args = parser.parse_args(sys.argv[1:])
+
+    gray = load_gray(args.image)
+    result = preprocess(gray, args.threshold, args.text_color, args.glyph_height)
+    Image.fromarray(result).save(args.output)
+    print(f'{args.image}: {gray.shape[1]}x{gray.shape[0]} -> {result.shape[1]}x{result.shape[0]} {args.output}')
@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 
+# Merge SRT tracks into the time slots of the first one.
+#
+# Two tracks are merged in memory (file B into the slots of file A). With more tracks, or with
+# --stream, all files are read cue by cue and swept in one k-way pass ordered by start time
+# (heapq.merge): a cue of track 2..N waits only until the next slot of track 1 arrives, is then
+# attached to the nearer of the two slots (or kept as its own slot if both are further away than
+# that track's --tolerance), and every slot is written as soon as nothing can attach to it any
+# more. Memory stays proportional to the cues between two slots of track 1, not to the file sizes.
+
 import argparse
+import heapq
+import re
 import sys
+from bisect import bisect_left
+from bisect import bisect_right
 from datetime import timedelta
 from pathlib import Path
 
 # pip3 install srt
 import srt
 
+import instrumentation
+from instrumentation import metrics
+
 # if the difference between sub1 an sub2 slots are more than this value
 # then sub2 will NOT be merged into the same sub1 time slot, but have its own slot
 MAX_NEAREST_SECONDS = 3
@@ -18,45 +34,96 @@ def nearest(items, pivot):
     return min(items, key=lambda x: abs(x.start - pivot))
 
 
+class SlotIndex:
+    """Sorted start-time index over the slots of file A.
+
+    nearest() returns exactly what nearest(slots, pivot) returns (on equal distance the slot
+    that comes first in A wins) with a bisect lookup instead of a full scan.
+    """
+
+    def __init__(self, slots):
+        # first slot in file order for every distinct start time
+        first_at = {}
+        for order, slot in enumerate(slots):
+            first_at.setdefault(slot.start, (order, slot))
+
+        self.starts = sorted(first_at)
+        self.first_at = first_at
+        self.by_start = sorted(slots, key=lambda x: x.start)
+        self.sorted_starts = [slot.start for slot in self.by_start]
+        self.max_duration = max((slot.end - slot.start for slot in slots), default=timedelta())
+
+    def nearest(self, pivot: timedelta) -> srt.Subtitle:
+        i = bisect_left(self.starts, pivot)
+        candidates = [self.starts[j] for j in (i - 1, i) if 0 <= j < len(self.starts)]
+
+        best = min(abs(start - pivot) for start in candidates)
+        order, slot = min(self.first_at[start] for start in candidates if abs(start - pivot) == best)
+
+        return slot
+
+    def most_overlapping(self, sub: srt.Subtitle) -> srt.Subtitle:
+        # only slots starting in [sub.start - longest slot, sub.end) can overlap sub
+        lo = bisect_left(self.sorted_starts, sub.start - self.max_duration)
+        hi = bisect_right(self.sorted_starts, sub.end)
+
+        best_slot, best_overlap = None, timedelta()
+        for slot in self.by_start[lo:hi]:
+            overlap = min(slot.end, sub.end) - max(slot.start, sub.start)
+            if overlap > best_overlap:
+                best_slot, best_overlap = slot, overlap
+
+        # no overlapping slot: fall back to the nearest start time
+        return best_slot or self.nearest(sub.start)
+
+
 def merge_files(args):
     srt1_path = Path(args.srt1)
     srt2_path = Path(args.srt2)
     num_mismatched_slots = 0
     unmatched_subs2 = []
 
-    with srt1_path.open(encoding=args.encoding1) as fi1:
-        subs1 = {s.index: s for s in srt.parse(fi1)}
-        subs1_orig_length = len(subs1.keys())
+    with metrics.stage('parse'):
+        with srt1_path.open(encoding=args.encoding1) as fi1:
+            subs1 = {s.index: s for s in srt.parse(fi1)}
+            subs1_orig_length = len(subs1.keys())
+
+        with srt2_path.open(encoding=args.encoding2) as fi2:
+            subs2 = {s.index: s for s in srt.parse(fi2)}
 
-    with srt2_path.open(encoding=args.encoding2) as fi2:
-        subs2 = {s.index: s for s in srt.parse(fi2)}
+    with metrics.stage('index'):
+        slot_index = SlotIndex(list(subs1.values()))
 
     # iterate all subs in srt2 and find the closest EXISTING slot in srt1
     sub2: srt.Subtitle
     idx: int
-    for idx, sub2 in subs2.items():
-        start_sub2: timedelta = sub2.start
+    with metrics.stage('merge'):
+        for idx, sub2 in subs2.items():
+            start_sub2: timedelta = sub2.start
 
-        # get the nearest sub by time
-        sub1_nearest_slot: srt.Subtitle = nearest(subs1.values(), start_sub2)
+            # get the nearest sub by time
+            if args.match == 'overlap':
+                sub1_nearest_slot: srt.Subtitle = slot_index.most_overlapping(sub2)
+            else:
+                sub1_nearest_slot: srt.Subtitle = slot_index.nearest(start_sub2)
 
-        # only allow a MAX deviation between two slots in order to merge, otherwise add new slot
-        diff_seconds = int(abs(sub1_nearest_slot.start.total_seconds() - sub2.start.total_seconds()))
+            # only allow a MAX deviation between two slots in order to merge, otherwise add new slot
+            diff_seconds = int(abs(sub1_nearest_slot.start.total_seconds() - sub2.start.total_seconds()))
 
-        if sub1_nearest_slot.content.strip() == sub2.content.strip() or sub2.content.strip() in sub1_nearest_slot.content:
-            print(f'''B already in A: SKIP merging!
+            if sub1_nearest_slot.content.strip() == sub2.content.strip() or sub2.content.strip() in sub1_nearest_slot.content:
+                print(f'''B already in A: SKIP merging!
                  A: {sub1_nearest_slot.content}
                  B: {sub2.content}      
     ''')
-            continue
+                continue
 
-        if args.nearest_slot and diff_seconds < MAX_NEAREST_SECONDS:
-            sub1_nearest_slot.content = f'{sub1_nearest_slot.content}<br>{sub2.content}'
-            subs1[sub1_nearest_slot.index] = sub1_nearest_slot
-        else:
-            num_mismatched_slots += 1
-            unmatched_subs2.append(sub2)
-            sys.stderr.write(f'''🚨 Frames are too far apart to merge❗️❗️❗️
+            if args.nearest_slot and diff_seconds < MAX_NEAREST_SECONDS:
+                sub1_nearest_slot.content = f'{sub1_nearest_slot.content}<br>{sub2.content}'
+                subs1[sub1_nearest_slot.index] = sub1_nearest_slot
+            else:
+                num_mismatched_slots += 1
+                unmatched_subs2.append(sub2)
+                sys.stderr.write(f'''🚨 Frames are too far apart to merge❗️❗️❗️
 INDEX: {idx}
 SUB #1 (NEAREST SLOT): {sub1_nearest_slot.to_srt()}
 SUB #2: {sub2.to_srt()}
@@ -69,12 +136,13 @@ DIFF SECONDS: {diff_seconds}
     else:
         generated_srt = Path(args.output_file)
 
-    with generated_srt.open(mode='w', encoding='utf-8') as fout:
+    with metrics.stage('write'):
+        with generated_srt.open(mode='w', encoding='utf-8') as fout:
 
-        all_subs_including_unmatched = list(subs1.values()) + unmatched_subs2
-        subs1_modified_length = len(all_subs_including_unmatched)
-        fout.write(srt.compose(all_subs_including_unmatched))
-        print(f'Generated file: {generated_srt.absolute()}')
+            all_subs_including_unmatched = list(subs1.values()) + unmatched_subs2
+            subs1_modified_length = len(all_subs_including_unmatched)
+            fout.write(srt.compose(all_subs_including_unmatched))
+            print(f'Generated file: {generated_srt.absolute()}')
 
     sys.stderr.write(f"{'SRT #A':<22}{args.srt1}\n")
     sys.stderr.write(f"{'SRT #B':<22}{args.srt2}\n")
@@ -84,6 +152,176 @@ DIFF SECONDS: {diff_seconds}
     sys.stderr.write(f"{'Mismatched slots':<22}{num_mismatched_slots} (slots in #B with more than {MAX_NEAREST_SECONDS}s drift from #A)\n")
 
 
+PATTERN_TIMING = re.compile(r'^\s*\d+:\d+:\d+[,.]\d+\s*-->')
+
+# cues a track may be out of start time order by (drifted OCR cues, hand-edited files)
+REORDER_WINDOW = 64
+
+
+def stream_subtitles(path: Path, encoding='utf-8', batch=256):
+    """Parse an SRT file `batch` cues at a time instead of reading it whole."""
+    block = []
+    complete = 0
+    with path.open(encoding=encoding) as fi:
+        for line in fi:
+            block.append(line)
+            # a blank line, then an index and a timing line: the previous cue is complete
+            if len(block) >= 4 and PATTERN_TIMING.match(block[-1]) and block[-2].strip().isdigit() \
+                    and not block[-3].strip():
+                complete += 1
+                if complete == batch:
+                    yield from srt.parse(''.join(block[:-2]))
+                    block, complete = block[-2:], 0
+
+    yield from srt.parse(''.join(block))
+
+
+def by_start(subs, path, window=REORDER_WINDOW):
+    """(position in file, cue) pairs, re-sorted by start time; cues may be at most `window` cues out of order."""
+    heap = []
+    last = None
+
+    def pop():
+        start, order, sub = heapq.heappop(heap)
+        if last is not None and start < last:
+            sys.exit(f'ERROR: {path}: cue {sub.index} is more than {window} cues out of start time order; '
+                     f'sort the file first (srt-normalise)')
+        return start, (order, sub)
+
+    for order, sub in enumerate(subs):
+        heapq.heappush(heap, (sub.start, order, sub))
+        if len(heap) > window:
+            last, item = pop()
+            yield item
+
+    while heap:
+        last, item = pop()
+        yield item
+
+
+class Slot:
+    """A cue of track 1 and the cues of the other tracks attached to it, grouped by track."""
+
+    def __init__(self, sub: srt.Subtitle):
+        self.sub = sub
+        self.parts = {}
+
+    @property
+    def start(self):
+        return self.sub.start
+
+    def content(self):
+        contents = [self.sub.content]
+        for track in sorted(self.parts):
+            # in file order within a track, like the two-file merge
+            contents.extend(content for _, content in sorted(self.parts[track]))
+        return '<br>'.join(contents)
+
+    def attach(self, track, order, content):
+        self.parts.setdefault(track, []).append((order, content))
+
+
+class SortedWriter:
+    """Write cues in start time order once no cue starting earlier can arrive any more."""
+
+    def __init__(self, fout):
+        self.fout = fout
+        self.heap = []
+        self.seq = 0
+        self.written = 0
+
+    def push(self, start, end, track, content):
+        self.seq += 1
+        heapq.heappush(self.heap, (start, end, track, self.seq, content))
+
+    def flush(self, watermark=None):
+        while self.heap and (watermark is None or self.heap[0][0] < watermark):
+            start, end, _, _, content = heapq.heappop(self.heap)
+            # what srt.compose() leaves out as well
+            if not content.strip() or start < timedelta() or start >= end:
+                continue
+            self.written += 1
+            self.fout.write(srt.Subtitle(self.written, start, end, content).to_srt())
+
+
+def merge_tracks(args, paths, encodings, tolerances, output: Path):
+    stats = [{'cues': 0, 'merged': 0, 'unmatched': 0, 'duplicate': 0} for _ in paths]
+
+    def tagged(track, path, encoding):
+        for order, sub in by_start(stream_subtitles(path, encoding), path):
+            stats[track]['cues'] += 1
+            yield track, order, sub
+
+    # on equal start times track 1 comes first, so a cue starting with a slot is matched to it
+    cues = heapq.merge(*(tagged(track, path, encoding) for track, (path, encoding) in enumerate(zip(paths, encodings))),
+                       key=lambda item: (item[2].start, item[0]))
+
+    previous = None
+    pending = []
+
+    def resolve(following):
+        # the nearest slot of a waiting cue is the last slot before it or the first one after it;
+        # on equal distance the earlier slot wins, as in SlotIndex.nearest()
+        for track, order, sub in pending:
+            if previous and (following is None or sub.start - previous.start <= following.start - sub.start):
+                slot = previous
+            else:
+                slot = following
+
+            content = slot.content() if slot else ''
+            if slot and (content.strip() == sub.content.strip() or sub.content.strip() in content):
+                stats[track]['duplicate'] += 1
+                continue
+
+            drift = abs(slot.start - sub.start).total_seconds() if slot else None
+            if args.nearest_slot and slot and drift < tolerances[track]:
+                slot.attach(track, order, sub.content)
+                stats[track]['merged'] += 1
+            else:
+                stats[track]['unmatched'] += 1
+                writer.push(sub.start, sub.end, track, sub.content)
+                sys.stderr.write(f'🚨 Frames are too far apart to merge❗️ track #{track + 1} cue {sub.index} '
+                                 f'({sub.start}), nearest slot drift: {drift}s\n')
+        pending.clear()
+
+    with output.open(mode='w', encoding='utf-8') as fout:
+        writer = SortedWriter(fout)
+
+        for track, order, sub in cues:
+            if track:
+                pending.append((track, order, sub))
+                continue
+
+            slot = Slot(sub)
+            resolve(slot)
+
+            if previous and sub.start == previous.start:
+                # equal start times: later cues always go to the first of these slots
+                writer.push(sub.start, sub.end, 0, slot.content())
+            else:
+                if previous:
+                    # everything after this slot is nearer to it than to the previous one
+                    writer.push(previous.start, previous.sub.end, 0, previous.content())
+                previous = slot
+
+            writer.flush(previous.start)
+
+        resolve(None)
+        if previous:
+            writer.push(previous.start, previous.sub.end, 0, previous.content())
+        writer.flush()
+
+    print(f'Generated file: {output.absolute()}')
+
+    for track, (path, track_stats) in enumerate(zip(paths, stats)):
+        sys.stderr.write(f"SRT #{track + 1:<4}{track_stats['cues']:>7} cues  ")
+        if track:
+            sys.stderr.write(f"merged {track_stats['merged']}, own slot {track_stats['unmatched']} "
+                             f"(drift >= {tolerances[track]}s), duplicate {track_stats['duplicate']}  ")
+        sys.stderr.write(f'{path}\n')
+    sys.stderr.write(f"{'Total slots written':<22}{writer.written}\n")
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='merge SRT subtitles',
@@ -96,6 +334,9 @@ if __name__ == '__main__':
                         help='SRT-file-1')
     parser.add_argument('srt2',
                         help='SRT-file-2')
+    parser.add_argument('srt_more',
+                        nargs='*',
+                        help='further SRT files, merged into the slots of SRT-file-1 in the same pass (implies --stream)')
     parser.add_argument('--output-file', '-o',
                         default=None,
                         help='Output filename')
@@ -103,14 +344,48 @@ if __name__ == '__main__':
                         type=lambda x: (str(x).lower() in ['true', '1', 'yes', 'y']),
                         default=True,
                         help='Append B to nearest slot in A')
+    parser.add_argument('--match', '-m',
+                        choices=('start', 'overlap'),
+                        default='start',
+                        help='pick the slot in A with the nearest start time (default), '
+                             'or the slot that overlaps B the most')
     parser.add_argument('--encoding1', '-e1',
                         default='utf-8',
                         help='Input file #1 encoding')
     parser.add_argument('--encoding2', '-e2',
                         default='utf-8',
-                        help='Input file #2 encoding')
+                        help='Input file #2 encoding (and of the further files)')
+    parser.add_argument('--stream', '-s',
+                        action='store_true',
+                        default=False,
+                        help='merge in one streaming pass ordered by start time (--match start only)')
+    parser.add_argument('--tolerance', '-t',
+                        action='append',
+                        type=float,
+                        default=None,
+                        help=f'seconds of drift up to which a cue is merged into a slot of file #1; repeat once per '
+                             f'file #2, #3, ... (default: {MAX_NEAREST_SECONDS}); --stream only')
+    instrumentation.add_arguments(parser)
     args = parser.parse_args(sys.argv[1:])
 
     print(args)
 
-    merge_files(args)
\ No newline at end of file
+    paths = [Path(args.srt1), Path(args.srt2)] + [Path(path) for path in args.srt_more]
+    streaming = args.stream or len(paths) > 2
+
+    if streaming and args.match != 'start':
+        parser.error('--match overlap is not supported by the streaming merge')
+    if args.tolerance and not streaming:
+        parser.error('--tolerance requires --stream (or more than two files)')
+
+    with instrumentation.session(args):
+        if streaming:
+            tolerances = [None] + (args.tolerance or [])
+            tolerances += [MAX_NEAREST_SECONDS] * (len(paths) - len(tolerances))
+            output = Path(args.output_file) if args.output_file else \
+                paths[0].parent / f'{paths[0].stem}_MERGED_{paths[0].suffix}'
+
+            with metrics.stage('merge'):
+                merge_tracks(args, paths, [args.encoding1] + [args.encoding2] * (len(paths) - 1), tolerances, output)
+        else:
+            merge_files(args)
\ No newline at end of file
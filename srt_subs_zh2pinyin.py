@@ -21,29 +21,175 @@
 # python -m pip install -U srt opencc pypinyin
 
 import argparse
+import contextlib
+import datetime
+import functools
+import json
+import re
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from difflib import SequenceMatcher
 from pathlib import Path
 from typing import Generator
 from typing import List
 
 import srt                   # https://github.com/cdown/srt
-from opencc import OpenCC    # https://github.com/BYVoid/OpenCC
-from pypinyin import pinyin  # https://github.com/mozillazg/python-pinyin
 
-try:
-    import hanzidentifier
-except ImportError:
-    print('WARN: cannot do simp/trad normalization! hanzidentifier not installed! -- pip install hanzidentifier')
-    hanzidentifier = None
+import instrumentation
+from instrumentation import metrics
+from srt_merge import stream_subtitles
 
 
-simp2trad = OpenCC('s2twp')
-trad2simp = OpenCC('tw2sp')
+# converters are imported and built lazily: a run only pays for the ones it actually uses
+
+@functools.lru_cache(maxsize=None)
+def get_opencc(config):
+    from opencc import OpenCC    # https://github.com/BYVoid/OpenCC
+    return OpenCC(config)
+
+
+def get_simp2trad():
+    return get_opencc('s2twp')
+
+
+def get_trad2simp():
+    return get_opencc('tw2sp')
+
+
+@functools.lru_cache(maxsize=None)
+def get_pinyin():
+    from pypinyin import pinyin  # https://github.com/mozillazg/python-pinyin
+    return pinyin
+
+
+@functools.lru_cache(maxsize=None)
+def get_hanzidentifier():
+    try:
+        import hanzidentifier
+    except ImportError:
+        print('WARN: cannot do simp/trad normalization! hanzidentifier not installed! -- pip install hanzidentifier')
+        hanzidentifier = None
+    return hanzidentifier
+
+
+def warm_up(args):
+    """Import and build only the converters this run needs (once per worker process)."""
+    if args.force_normalize_input_to_simplified or args.force_normalize_input_to_traditional:
+        get_hanzidentifier()
+    if args.simp_to_trad or args.force_normalize_input_to_traditional:
+        get_simp2trad()
+    if args.trad_to_simp or args.force_normalize_input_to_simplified:
+        get_trad2simp()
+    if not args.no_pinyin:
+        get_pinyin()
 
 
 def to_pinyin(chin):
-    return ' '.join([seg[0] for seg in pinyin(chin)])
+    return ' '.join([seg[0] for seg in get_pinyin()(chin)])
+
+
+# runs of hanzi: pypinyin segments words within a run but never across non-hanzi characters,
+# so converting run by run gives exactly the same result as converting the whole line
+PATTERN_HANZI_RUN = re.compile('([\u3007\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ebef]+)')
+
+
+class LruMemo:
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            if self.max_entries > 0:
+                self.entries[key] = value
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return value
+
+
+class ConversionEngine:
+    """Memoized pinyin / OpenCC / hanzidentifier conversions.
+
+    OCR'ed subtitles repeat the same lines and phrases all the time: every unique line is
+    converted once, and pinyin is additionally memoized per unique hanzi run (phrase).
+    The memo is bounded (LRU) and can be persisted to a JSON file across runs.
+    """
+
+    def __init__(self, max_entries=100_000, memo_file=None):
+        self.memo_file = Path(memo_file) if memo_file else None
+        self.memos = {name: LruMemo(max_entries)
+                      for name in ('pinyin', 'phrase', 'trad', 'simp', 'is_trad', 'is_simp')}
+
+        # the library calls behind memo misses, timed per library
+        self._phrase = metrics.timed(self._phrase_pinyin, 'conversion_seconds', library='pypinyin')
+        self._simp2trad = metrics.timed(lambda line: get_simp2trad().convert(line), 'conversion_seconds', library='opencc')
+        self._trad2simp = metrics.timed(lambda line: get_trad2simp().convert(line), 'conversion_seconds', library='opencc')
+        self._is_trad = metrics.timed(lambda line: get_hanzidentifier().is_traditional(line), 'conversion_seconds',
+                                      library='hanzidentifier')
+        self._is_simp = metrics.timed(lambda line: get_hanzidentifier().is_simplified(line), 'conversion_seconds',
+                                      library='hanzidentifier')
+
+        if self.memo_file:
+            self.load(self.memo_file)
+
+    def load(self, memo_file):
+        memo_file = Path(memo_file)
+        if memo_file.exists():
+            saved = json.loads(memo_file.read_text(encoding='utf-8'))
+            for name, entries in saved.items():
+                if name in self.memos:
+                    self.memos[name].entries.update(entries)
+
+    def _phrase_pinyin(self, phrase):
+        return [seg[0] for seg in get_pinyin()(phrase)]
+
+    def _line_pinyin(self, line):
+        segments = []
+        for part in PATTERN_HANZI_RUN.split(line):
+            if part:
+                segments.extend(self.memos['phrase'].get(part, self._phrase))
+        return ' '.join(segments)
+
+    def to_pinyin(self, line):
+        if self.memos['pinyin'].max_entries <= 0:
+            return to_pinyin(line)
+        return self.memos['pinyin'].get(line, self._line_pinyin)
+
+    def to_traditional(self, line):
+        return self.memos['trad'].get(line, self._simp2trad)
+
+    def to_simplified(self, line):
+        return self.memos['simp'].get(line, self._trad2simp)
+
+    def is_traditional(self, line):
+        return self.memos['is_trad'].get(line, self._is_trad)
+
+    def is_simplified(self, line):
+        return self.memos['is_simp'].get(line, self._is_simp)
+
+    def save(self):
+        if self.memo_file:
+            self.memo_file.write_text(json.dumps({name: memo.entries for name, memo in self.memos.items()},
+                                                 ensure_ascii=False),
+                                      encoding='utf-8')
+
+    def summary(self):
+        return ', '.join(f'{name}: {memo.hits}/{memo.hits + memo.misses} hits'
+                         for name, memo in self.memos.items() if memo.hits + memo.misses)
 
 
 def put(lst, line):
@@ -72,119 +218,262 @@ def get_similarity_percent(string1, string2):
     return to_percent(tot_len, match_size)
 
 
-def append_pinyin_subs(args):
+# one engine per process, so that batch workers keep their memos across files
+engine: 'ConversionEngine' = None
 
-    if args.plain:
-        plain_lines = []
-    else:
-        plain_lines = None
 
-    print(args)
+def init_worker(args, save_memo=True):
+    global engine
+    warm_up(args)
+    engine = ConversionEngine(max_entries=args.memo_size, memo_file=args.memo_file if save_memo else None)
+    if not save_memo and args.memo_file:
+        # workers only read the shared memo file; concurrent writers would clobber each other
+        engine.load(args.memo_file)
 
-    # allow glob patterns
-    if '*' in args.srt_file:
-        input_files = sorted(Path(args.work_dir).glob(args.srt_file))
-    else:
-        input_files = [Path(args.srt_file)]
 
-    for input_path in input_files:
+def output_files(input_path: Path, args):
+    """(SRT output, plain text output or None) of one input file."""
+    filename_suffix = '.'
 
-        converted_subs = []
+    if args.no_pinyin:
+        if args.simp_to_trad:
+            filename_suffix += 'trad'
+        if args.trad_to_simp:
+            filename_suffix += 'simp'
+    else:
+        filename_suffix += 'pinyin'
 
-        with input_path.open(encoding=args.encoding or 'utf-8') as fi:
-            subs: Generator[srt.Subtitle] = srt.parse(fi)
-            srt.sort_and_reindex(subs, start_index=1, in_place=True, skip=True)
+    if not args.output_file:
+        generated_srt_file = input_path.parent / f'{input_path.stem}{filename_suffix}{input_path.suffix}'
+    else:
+        generated_srt_file = Path(args.output_file)
 
-            sub: srt.Subtitle
-            for sub in subs:
-                orig_content = sub.content
+    plain_text_file = input_path.parent / f'{input_path.stem}_PLAIN.txt' if args.plain else None
 
-                if args.force_normalize_input_to_simplified and hanzidentifier and hanzidentifier.is_traditional(orig_content):
-                    orig_content = trad2simp.convert(orig_content)
+    return generated_srt_file, plain_text_file
 
-                if args.force_normalize_input_to_traditional and hanzidentifier and hanzidentifier.is_simplified(orig_content):
-                    orig_content = simp2trad.convert(orig_content)
 
-                new_content = f'<font color="#ffffff">{orig_content}</font><br>'
+def convert_cue(sub: srt.Subtitle, args, hanzidentifier, plain_lines):
+    """Replace the content of sub with the converted lines; collect its plain text lines if plain_lines is a list."""
+    orig_content = sub.content
 
-                if args.plain:
-                    put(plain_lines, orig_content)
+    if args.force_normalize_input_to_simplified and hanzidentifier and engine.is_traditional(orig_content):
+        orig_content = engine.to_simplified(orig_content)
 
-                if args.plain and args.plain_timings:
-                    put(plain_lines, f'{sub.index}\n{sub.start}')
+    if args.force_normalize_input_to_traditional and hanzidentifier and engine.is_simplified(orig_content):
+        orig_content = engine.to_traditional(orig_content)
 
-                # FIX FOR BAD SUBS: if previous_sub.end is GREATER than current_sub.start then make previous_sub.end = current_sub.start
-                if 0 < sub.index and len(converted_subs) != 0:
-                    # get previous converted sub
-                    prev_sub: srt.Subtitle = converted_subs[sub.index - 2]
-                    if prev_sub.end > sub.start:
-                        prev_sub.end = sub.start
+    new_content = f'<font color="#ffffff">{orig_content}</font><br>'
 
-                if args.simp_to_trad:
-                    trad_content = simp2trad.convert(orig_content)
+    if args.plain:
+        put(plain_lines, orig_content)
 
-                    if trad_content != orig_content:
-                        new_content += f'<font color="#d663fd">{trad_content}</font><br>'
+    if args.plain and args.plain_timings:
+        put(plain_lines, f'{sub.index}\n{sub.start}')
 
-                        if args.plain:
-                            put(plain_lines, trad_content)
+    if args.simp_to_trad:
+        trad_content = engine.to_traditional(orig_content)
 
-                if args.trad_to_simp:
-                    simp_content = trad2simp.convert(orig_content)
+        if trad_content != orig_content:
+            new_content += f'<font color="#d663fd">{trad_content}</font><br>'
 
-                    if simp_content.strip() != orig_content:
-                        new_content += f'<font color="#d663fd">{simp_content}</font><br>'
+            if args.plain:
+                put(plain_lines, trad_content)
 
-                        if args.plain:
-                            put(plain_lines, simp_content)
+    if args.trad_to_simp:
+        simp_content = engine.to_simplified(orig_content)
 
-                if not args.no_pinyin:
-                    pinyin_line = to_pinyin(orig_content)
+        if simp_content.strip() != orig_content:
+            new_content += f'<font color="#d663fd">{simp_content}</font><br>'
 
-                    # only append if the conversion result is different from original
-                    if pinyin_line.strip() != orig_content.strip():
-                        if args.max_similarity_percent == 0 or get_similarity_percent(pinyin_line, orig_content) <= args.max_similarity_percent:
-                            new_content += f'<font color="#00ffff">{pinyin_line}</font>'
+            if args.plain:
+                put(plain_lines, simp_content)
 
-                            if args.plain:
-                                put(plain_lines, pinyin_line)
+    if not args.no_pinyin:
+        pinyin_line = engine.to_pinyin(orig_content)
 
-                sub.content = new_content
+        # only append if the conversion result is different from original
+        if pinyin_line.strip() != orig_content.strip():
+            # 0 = no similarity check: SequenceMatcher is never run
+            if args.max_similarity_percent == 0 or get_similarity_percent(pinyin_line, orig_content) <= args.max_similarity_percent:
+                new_content += f'<font color="#00ffff">{pinyin_line}</font>'
 
                 if args.plain:
-                    put(plain_lines, '\n')
+                    put(plain_lines, pinyin_line)
+
+    sub.content = new_content
 
-                converted_subs.append(sub)
+    if args.plain:
+        put(plain_lines, '\n')
+
+
+def convert_file(input_path: Path, args, echo=True):
+    if args.stream:
+        return convert_file_streaming(input_path, args, echo)
+
+    started = time.perf_counter()
+    hanzidentifier = get_hanzidentifier() if (args.force_normalize_input_to_simplified or
+                                              args.force_normalize_input_to_traditional) else None
+
+    if args.plain:
+        plain_lines = []
+    else:
+        plain_lines = None
+
+    converted_subs = []
+
+    with input_path.open(encoding=args.encoding or 'utf-8') as fi:
+        subs: Generator[srt.Subtitle] = srt.parse(fi)
+        srt.sort_and_reindex(subs, start_index=1, in_place=True, skip=True)
+
+        sub: srt.Subtitle
+        for sub in subs:
+            # FIX FOR BAD SUBS: if previous_sub.end is GREATER than current_sub.start then make previous_sub.end = current_sub.start
+            if 0 < sub.index and len(converted_subs) != 0:
+                # get previous converted sub
+                prev_sub: srt.Subtitle = converted_subs[sub.index - 2]
+                if prev_sub.end > sub.start:
+                    prev_sub.end = sub.start
+
+            convert_cue(sub, args, hanzidentifier, plain_lines)
+
+            converted_subs.append(sub)
+        if echo:
             print(srt.compose(converted_subs))
 
-        filename_suffix = '.'
+    generated_srt_file, plain_text_file = output_files(input_path, args)
 
-        if args.no_pinyin:
-            if args.simp_to_trad:
-                filename_suffix += 'trad'
-            if args.trad_to_simp:
-                filename_suffix += 'simp'
-        else:
-            filename_suffix += 'pinyin'
+    with generated_srt_file.open(mode='w', encoding='utf-8') as fout:
+        fout.write(srt.compose(converted_subs))
+        print(f'Wrote {generated_srt_file.absolute()}')
 
-        if not args.output_file:
-            generated_srt_file = input_path.parent / f'{input_path.stem}{filename_suffix}{input_path.suffix}'
-        else:
-            generated_srt_file = Path(args.output_file)
+    if args.plain:
+        with plain_text_file.open(mode='w', encoding='utf-8') as tt:
+            tt.write('\n'.join(plain_lines))
+            print(f'Wrote {plain_text_file.absolute()}')
 
-        with generated_srt_file.open(mode='w', encoding='utf-8') as fout:
-            fout.write(srt.compose(converted_subs))
-            print(f'Wrote {generated_srt_file.absolute()}')
+    return dict(input=str(input_path), output=str(generated_srt_file), cues=len(converted_subs),
+                seconds=time.perf_counter() - started)
 
-        if args.plain:
-            plain_text_file = input_path.parent / f'{input_path.stem}_PLAIN.txt'
-            with plain_text_file.open(mode='w', encoding='utf-8') as tt:
-                tt.write('\n'.join(plain_lines))
-                print(f'Wrote {plain_text_file.absolute()}')
 
+def convert_file_streaming(input_path: Path, args, echo=True):
+    """Read, convert and write one cue at a time: memory stays flat and output starts immediately.
 
-if __name__ == '__main__':
+    Cues are written in input order (sorted input expected, as written by gensrt.py / srt-normalise);
+    the overlap fix only needs the previous cue, which is held back until the next one is read.
+    """
+    started = time.perf_counter()
+    hanzidentifier = get_hanzidentifier() if (args.force_normalize_input_to_simplified or
+                                              args.force_normalize_input_to_traditional) else None
+
+    generated_srt_file, plain_text_file = output_files(input_path, args)
+    plain_lines = [] if args.plain else None
+    written = 0
+
+    with contextlib.ExitStack() as stack:
+        fout = stack.enter_context(generated_srt_file.open(mode='w', encoding='utf-8'))
+        tt = stack.enter_context(plain_text_file.open(mode='w', encoding='utf-8')) if plain_text_file else None
+
+        def write(sub: srt.Subtitle):
+            nonlocal written
+            # what srt.compose() leaves out as well
+            if sub.start < datetime.timedelta() or sub.start >= sub.end:
+                return
+            written += 1
+            sub.index = written
+            text = sub.to_srt()
+            fout.write(text)
+            if echo:
+                print(text, end='')
+
+        previous = None
+        for sub in stream_subtitles(input_path, args.encoding or 'utf-8'):
+            convert_cue(sub, args, hanzidentifier, plain_lines)
+
+            if tt:
+                # same text as '\n'.join() over the whole file
+                tt.write(('\n' if written or previous else '') + '\n'.join(plain_lines))
+                plain_lines.clear()
+
+            if previous:
+                # FIX FOR BAD SUBS: the previous cue must end before this one starts
+                if previous.end > sub.start:
+                    previous.end = sub.start
+                write(previous)
+            previous = sub
+
+        if previous:
+            write(previous)
+
+    print(f'Wrote {generated_srt_file.absolute()}')
+    if plain_text_file:
+        print(f'Wrote {plain_text_file.absolute()}')
 
+    return dict(input=str(input_path), output=str(generated_srt_file), cues=written,
+                seconds=time.perf_counter() - started)
+
+
+def convert_file_in_worker(input_path: Path, args):
+    return convert_file(input_path, args, echo=False)
+
+
+def append_pinyin_subs(args):
+
+    print(args)
+
+    # allow glob patterns
+    if '*' in args.srt_file:
+        input_files = sorted(Path(args.work_dir).glob(args.srt_file))
+    else:
+        input_files = [Path(args.srt_file)]
+
+    if args.jobs <= 1 or len(input_files) <= 1:
+        init_worker(args)
+        with metrics.stage('convert'):
+            for input_path in input_files:
+                metrics.observe('file_seconds', convert_file(input_path, args, echo=not args.no_echo)['seconds'])
+
+        engine.save()
+        sys.stderr.write(f'Conversion memo: {engine.summary()}\n')
+        return
+
+    # batch mode: fan the files out to a process pool, every worker builds its converters once
+    started = time.perf_counter()
+    results, failures = [], []
+
+    # metrics and --profile only cover this process: the workers' conversion time shows up as file_seconds
+    with metrics.stage('convert'), \
+            ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args, False)) as executor:
+        futures = {executor.submit(convert_file_in_worker, input_path, args): input_path for input_path in input_files}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            input_path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures.append(input_path)
+                sys.stderr.write(f'[{done}/{len(input_files)}] FAILED {input_path}: {e}\n')
+            else:
+                results.append(result)
+                metrics.observe('file_seconds', result['seconds'])
+                print(f"[{done}/{len(input_files)}] {result['cues']} cues in {result['seconds']:.1f}s: "
+                      f"{result['input']} -> {result['output']}")
+
+    total_cues = sum(result['cues'] for result in results)
+    elapsed = time.perf_counter() - started
+    slowest = max(results, key=lambda result: result['seconds'], default=None)
+
+    print(f'Converted {len(results)} of {len(input_files)} files ({total_cues} cues) in {elapsed:.1f}s '
+          f'with {args.jobs} workers; {len(failures)} failed')
+    if slowest:
+        print(f"Slowest file: {slowest['input']} ({slowest['seconds']:.1f}s)")
+
+    if failures:
+        sys.exit(1)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    # shared with benchmarks/bench_zh2pinyin.py, so that its arguments cannot drift from the CLI
     parser = argparse.ArgumentParser(description='SRT subtitles Chinese to pinyin converter',
                                      usage="""
     Generate pinyin for Chinese-language subtitles:                                     
@@ -239,9 +528,38 @@ if __name__ == '__main__':
                         type=int,
                         help='Do NOT add pinyin if resulting text is more than N percent similar to the input text. 0 = no similarity check')
 
+    parser.add_argument('--stream',
+                        action='store_true',
+                        default=False,
+                        help='read, convert and write one cue at a time instead of the whole file: constant memory, '
+                             'output starts immediately (input must be sorted by start time)')
+    parser.add_argument('--no-echo',
+                        action='store_true',
+                        default=False,
+                        help='do not print the converted subtitles to the console')
+    parser.add_argument('--jobs', '-j',
+                        default=1,
+                        type=int,
+                        help='convert matched files in parallel with this many worker processes')
+    parser.add_argument('--memo-size',
+                        default=100_000,
+                        type=int,
+                        help='max memoized conversions per kind (LRU); 0 = no memoization')
+    parser.add_argument('--memo-file',
+                        default=None,
+                        help='persist memoized conversions to this JSON file across runs')
+    instrumentation.add_arguments(parser)
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    parser = make_parser()
     cli_args = parser.parse_args(sys.argv[1:])
 
     if cli_args.no_pinyin and not any((cli_args.simp_to_trad, cli_args.trad_to_simp)):
         parser.error('--no-pinyin can only be used with one of --simp-to-trad/--trad-to-simp')
 
-    append_pinyin_subs(cli_args)
+    with instrumentation.session(cli_args):
+        append_pinyin_subs(cli_args)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Persistent translation memory for deepl.py.
+#
+# Translations are stored in a local SQLite file keyed by (source language, target language,
+# formality, normalized text), so lines that were already translated in an earlier run or
+# another episode are never sent (and paid for) again.
+
+import sqlite3
+import threading
+from pathlib import Path
+
+DEFAULT_TM_FILE = Path.home() / '.cache' / 'subtitles-ocr' / 'translation_memory.sqlite'
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.split())
+
+
+class TranslationMemory:
+
+    def __init__(self, path=DEFAULT_TM_FILE, source_lang='', target_lang='', formality='default'):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.source_lang = source_lang.upper()
+        self.target_lang = target_lang.upper()
+        self.formality = formality
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS translations (
+                                source_lang TEXT NOT NULL,
+                                target_lang TEXT NOT NULL,
+                                formality TEXT NOT NULL,
+                                source TEXT NOT NULL,
+                                translation TEXT NOT NULL,
+                                PRIMARY KEY (source_lang, target_lang, formality, source))''')
+
+    def _key(self, text):
+        return self.source_lang, self.target_lang, self.formality, normalize(text)
+
+    def get(self, text):
+        with self._lock:
+            row = self._db.execute('''SELECT translation FROM translations
+                                      WHERE source_lang = ? AND target_lang = ? AND formality = ? AND source = ?''',
+                                   self._key(text)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row[0]
+
+    def put_many(self, pairs):
+        with self._lock, self._db:
+            self._db.executemany('''INSERT OR REPLACE INTO translations
+                                    (source_lang, target_lang, formality, source, translation)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                 [self._key(text) + (translation,) for text, translation in pairs])
+
+    def close(self):
+        with self._lock:
+            self._db.close()